@@ -12,7 +12,9 @@ from MRdataset.config import configure_logger
 logger = logging.getLogger(__name__)
 logger = configure_logger(logger, output_dir=None, mode='w')
 
-from MRdataset.common import import_dataset, load_mr_dataset, save_mr_dataset
+from MRdataset.common import (import_dataset, load_mr_dataset,
+                              save_mr_dataset, update_dataset, iter_import,
+                              merge_shards, merge_datasets)
 from MRdataset.config import MRDS_EXT, DatasetEmptyException
 from MRdataset.dicom_utils import is_dicom_file
 from MRdataset.utils import valid_dirs
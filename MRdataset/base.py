@@ -1,11 +1,20 @@
 from abc import ABC, abstractmethod
-from itertools import product
+from itertools import islice, product
 from pathlib import Path
-from typing import List, Union
+from typing import List, Union, Tuple
 
 from MRdataset import logger
+from MRdataset.columnar import SequenceColumns
+from MRdataset.compact import (CompactIndex, FlatView, TreeView, IdSetView,
+                               SequenceRunsView, SessionSequencesView)
 from MRdataset.config import VALID_DATASET_FORMATS
-from MRdataset.utils import valid_dirs, convert2ascii
+from MRdataset.hashing import ContentHashes
+from MRdataset.indexes import ParameterIndex, matches
+from MRdataset.flyweight import ParameterPool
+from MRdataset.lazy import SequenceHandle, LRUCache
+from MRdataset.utils import (valid_dirs, convert2ascii,
+                             files_in_terminal_folders, folder_signature,
+                             check_shard, shard_of)
 from protocol import BaseSequence
 
 
@@ -67,6 +76,11 @@ from protocol import BaseSequence
 #         self.subject_id = subject_id
 #         self.sessions = sessions
 
+# maps of BaseDataset that are rebuilt from _flat_map when unpickled
+_DERIVED_MAPS = ('_tree_map', '_seqs_map', '_sess_map', '_sess_counts',
+                 '_subj_ids', '_seq_ids')
+
+
 class BaseDataset(ABC):
     """
     Base class for all datasets. The class provides a common interface to access
@@ -83,8 +97,53 @@ class BaseDataset(ABC):
         name of the dataset
     ds_format : str
         format of the dataset. One of ['dicom', 'bids']
+    shard : tuple
+        index and number of shards e.g. (0, 8), to import only the part of
+        the data source assigned to this shard, see utils.shard_of. A
+        sharded dataset is not complete until all its shards are merged.
+    shard_by : str
+        'folder' to assign each terminal folder to a shard, or 'subject'
+        to assign each top-level directory of the data source
+    compact : bool
+        whether to store the runs in a compact form, with every ID interned
+        as an integer code (see compact.py). Uses several times less memory
+        for large datasets, while lookups decode the IDs on the fly. The
+        public methods return strings either way.
+    lazy : bool
+        whether to store a lightweight handle for each run instead of the
+        sequence (see lazy.py). The sequences are built again from the
+        handles when they are accessed through get() or traverse_*, so that
+        memory stays bounded for large datasets.
+    cache_size : int
+        maximum number of sequences built from handles that are kept in
+        memory, in lazy mode
+    dedup : bool
+        whether to intern the parameters of the runs, so that equal
+        parameters are stored once and shared by all the runs (see
+        flyweight.py). Also counts the distinct protocols of each sequence
+        ID as runs are added, see count_protocols. The shared parameters
+        must not be modified in place. In lazy mode, the protocols are
+        counted but the parameters are not interned.
     """
 
+    # compact storage of the runs, None unless the dataset is compact
+    _index = None
+    # sequences built from handles in lazy mode, see _materialize
+    lazy = False
+    cache_size = 128
+    _sequence_cache = None
+    # seq_id -> SequenceColumns, None unless enabled with enable_columns
+    _columns = None
+    _column_params = None
+    # seq_id -> parameter -> ParameterIndex, None unless enabled with
+    #   enable_index
+    _param_indexes = None
+    _indexed_params = ()
+    # hierarchical content hashes, None unless enabled with enable_hashes
+    _hashes = None
+    # shared parameters and protocols of the runs, None unless dedup
+    _pool = None
+
     # self._subj_ids : set
     #     List of unique subject IDs in the entire dataset.
     # self._seq_ids : set
@@ -109,7 +168,13 @@ class BaseDataset(ABC):
                  data_source: Union[List, Path, str] = None,
                  is_complete: bool = True,
                  name: str = 'Dataset',
-                 ds_format: str = 'dicom'):
+                 ds_format: str = 'dicom',
+                 shard: Tuple[int, int] = None,
+                 shard_by: str = 'folder',
+                 compact: bool = False,
+                 lazy: bool = False,
+                 cache_size: int = 128,
+                 dedup: bool = False):
         """constructor"""
 
         self.data_source = valid_dirs(data_source)
@@ -120,15 +185,26 @@ class BaseDataset(ABC):
         self.format = ds_format
 
         self.is_complete = is_complete
-
-        self._subj_ids = set()
-        self._seq_ids = set()
-
-        self._tree_map = dict()
-        self._flat_map = dict()
-
-        self._seqs_map = dict()
-        self._sess_map = dict()
+        if shard is not None:
+            shard = check_shard(shard)
+            self.is_complete = False
+        if shard_by not in ('folder', 'subject'):
+            raise ValueError("Expected shard_by 'folder' or 'subject'. "
+                             f'Got {shard_by}')
+        self.shard = shard
+        self.shard_by = shard_by
+        self.compact = compact
+        if cache_size < 1:
+            raise ValueError('Expected a positive cache_size. '
+                             f'Got {cache_size}')
+        self.lazy = lazy
+        self.cache_size = cache_size
+        if dedup:
+            # in lazy mode, the sequences are built only for a while, and
+            #   their parameters are not worth interning
+            self._pool = ParameterPool(intern=not lazy)
+
+        self._init_indices()
 
         self._saved_path = ''
         # self.data_source[0] / "mrdataset" / "mrdataset.pkl"
@@ -145,6 +221,87 @@ class BaseDataset(ABC):
                               'root',
                               'subjects'])
 
+    def _init_indices(self):
+        """Initializes (or resets) the containers holding the sequences"""
+        if getattr(self, 'compact', False):
+            # the maps are read-only views of the compact index, all the
+            #   changes go through the index
+            self._index = CompactIndex()
+            self._subj_ids = IdSetView(self._index, 'subject')
+            self._seq_ids = IdSetView(self._index, 'sequence')
+            self._tree_map = TreeView(self._index)
+            self._flat_map = FlatView(self._index)
+            self._seqs_map = SequenceRunsView(self._index)
+            self._sess_map = SessionSequencesView(self._index)
+        else:
+            self._index = None
+            self._subj_ids = set()
+            self._seq_ids = set()
+
+            self._tree_map = dict()
+            self._flat_map = dict()
+
+            self._seqs_map = dict()
+            self._sess_map = dict()
+            # number of subjects with runs of a sequence in a session, keyed
+            #   by (session_id, seq_id). Session IDs may be shared by
+            #   subjects e.g. 'ses-01' in BIDS, so _sess_map is pruned only
+            #   when the count drops to zero
+            self._sess_counts = dict()
+
+        # maps each folder read from disk to its signature and the keys of
+        #   the runs read from it. Used to refresh the dataset incrementally
+        self._manifest = dict()
+        if self._columns is not None:
+            self._columns = dict()
+        if self._param_indexes is not None:
+            self._param_indexes = dict()
+        if self._hashes is not None:
+            self._hashes = ContentHashes()
+        if self._pool is not None:
+            self._pool = ParameterPool(self._pool.exclude,
+                                       self._pool.interning)
+        self._sequence_cache = None
+
+    def _empty_copy(self):
+        """
+        Returns a shallow copy of the dataset without any of the sequences.
+        The copy shares the configuration of this dataset, and is light
+        enough to be shipped to worker processes.
+        """
+        dataset = self.__class__.__new__(self.__class__)
+        dataset.__dict__.update(self.__getstate__())
+        dataset._init_indices()
+        return dataset
+
+    def __getstate__(self):
+        """The maps that can be rebuilt from _flat_map are not pickled, see
+        __setstate__"""
+        state = self.__dict__.copy()
+        if self._index is None:
+            for name in _DERIVED_MAPS:
+                state.pop(name, None)
+        # sequences built from handles are built again when needed
+        state.pop('_sequence_cache', None)
+        return state
+
+    def __setstate__(self, state):
+        """Rebuilds the maps that were not pickled, in a single sweep over
+        _flat_map. Datasets pickled with all the maps are restored as is"""
+        self.__dict__.update(state)
+        if self._index is None and '_tree_map' not in state:
+            self._tree_map, self._seqs_map, self._sess_map = {}, {}, {}
+            self._sess_counts = dict()
+            self._subj_ids, self._seq_ids = set(), set()
+            self._build_maps(self._flat_map)
+        elif self._index is None and '_sess_counts' not in state:
+            # pickled with all the maps, before the counts were kept
+            self._sess_counts = dict()
+            for sessions in self._tree_map.values():
+                for session_id, seqs in sessions.items():
+                    for seq_id in seqs:
+                        self._count_session(session_id, seq_id, 1)
+
     def get_sequence_ids(self):
         """Returns a list of all sequence IDs in the dataset"""
         # Cast to list so that it can be indexed, set is not subscript-able
@@ -198,6 +355,247 @@ class BaseDataset(ABC):
     def load(self):
         """default method to load the dataset"""
 
+    def _iter_folders(self):
+        """
+        Walks the data sources, and reads the sequences from each folder as
+        soon as it is found. The sequences are not added to the dataset.
+
+        Yields
+        ------
+        tuple
+            folder, its signature and the list of sequences read from it
+        """
+        for directory in self.data_source:
+            # find all the sub-folders with at least min_count files. Each
+            #   folder is listed only once, and the files are reused below
+            sub_folders = files_in_terminal_folders(directory, self.pattern,
+                                                    self.min_count,
+                                                    self.walk_threads,
+                                                    self._is_pruned)
+            yield from self._read_folders(
+                self._select_shard(directory, sub_folders))
+
+    def _is_pruned(self, folder):
+        """
+        Checks if a folder must be skipped while walking the data sources,
+        along with everything below it e.g. an excluded subject. By default,
+        no folder is skipped.
+
+        Parameters
+        ----------
+        folder : Path
+            The path to a sub-folder of a data source
+        """
+        return False
+
+    def _select_shard(self, directory, sub_folders):
+        """
+        Yields the folders assigned to the shard of this dataset, or all the
+        folders if the dataset is not sharded.
+
+        Parameters
+        ----------
+        directory : Path
+            The data source
+        sub_folders : Iterable[Tuple[Path, List[Path]]]
+            Folders in the data source and the files found in each folder
+        """
+        shard = getattr(self, 'shard', None)
+        if shard is None:
+            yield from sub_folders
+            return
+        index, total = shard
+        for folder, files in sub_folders:
+            if shard_of(folder, directory, total, self.shard_by) == index:
+                yield folder, files
+
+    def _read_folders(self, sub_folders):
+        """
+        Reads the sequences from each folder. Must be implemented by the
+        child classes to support incremental updates.
+
+        Parameters
+        ----------
+        sub_folders : Iterable[Tuple[Path, List[Path]]]
+            Folders and the files found in each folder
+
+        Yields
+        ------
+        tuple
+            folder, its signature and the list of sequences read from it
+        """
+        raise NotImplementedError('Incremental updates are not supported for '
+                                  f'{self.format} datasets')
+
+    def _add_folder(self, folder, signature, sequences):
+        """
+        Adds the sequences read from a folder, and records the folder in the
+        manifest along with the keys of the runs added from it. Runs that
+        already exist in the dataset are neither added nor recorded.
+
+        Parameters
+        ----------
+        folder : Path
+            The path to the folder
+        signature : str
+            Signature of the folder, see utils.folder_signature
+        sequences : List[protocol.BaseSequence]
+            Sequences read from the folder
+        """
+        runs = dict()
+        for seq in sequences:
+            key = (seq.subject_id, seq.session_id, seq.name, seq.run_id)
+            if key not in self._flat_map:
+                runs.setdefault(key, seq)
+        stored = runs
+        if self.lazy:
+            stored = {key: self._make_handle(folder, signature, seq)
+                      for key, seq in runs.items()}
+        self._insert_runs(stored, built=runs)
+        self._manifest[str(folder)] = (signature, list(runs))
+
+    def _folder_signature(self, folder, files) -> str:
+        """
+        Returns the signature of a folder recorded in the manifest, see
+        utils.folder_signature. Child classes may salt it with the options
+        that decide what is read from the folder.
+
+        Parameters
+        ----------
+        folder : Path
+            The path to the folder
+        files : List[Path]
+            files in the folder
+        """
+        return folder_signature(folder, files)
+
+    def _make_handle(self, folder, signature, seq) -> SequenceHandle:
+        """
+        Returns a handle to build a sequence again, in lazy mode. Must be
+        implemented by the child classes to support lazy mode.
+
+        Parameters
+        ----------
+        folder : Path
+            The path to the folder the sequence was read from
+        signature : str
+            Signature of the folder, see utils.folder_signature
+        seq : protocol.BaseSequence
+            Sequence read from the folder
+        """
+        raise NotImplementedError('Lazy mode is not supported for '
+                                  f'{self.format} datasets')
+
+    def _load_sequence(self, handle: SequenceHandle):
+        """
+        Builds the sequence referred to by a handle, see _make_handle.
+        Returns None if the sequence cannot be built e.g. the file was
+        deleted.
+        """
+        raise NotImplementedError('Lazy mode is not supported for '
+                                  f'{self.format} datasets')
+
+    def _materialize(self, seq):
+        """
+        Returns the sequence referred to by a handle, building it if it is
+        not in the cache of recently used sequences. A warning is logged if
+        the file of the handle has changed since it was read, with a single
+        stat of the file. Sequences are returned as is.
+
+        Parameters
+        ----------
+        seq : protocol.BaseSequence | SequenceHandle
+            A value of _flat_map
+
+        Returns
+        -------
+        protocol.BaseSequence
+            None if the sequence cannot be built
+        """
+        if not isinstance(seq, SequenceHandle):
+            return seq
+        if self._sequence_cache is None:
+            self._sequence_cache = LRUCache(self.cache_size)
+        sequence = self._sequence_cache.get(seq, None)
+        if sequence is None:
+            if seq.is_stale():
+                logger.warning(f'{seq.filepath} has changed since it was '
+                               'read. Use update() to read it again')
+            sequence = self._load_sequence(seq)
+            if sequence is not None:
+                self._sequence_cache.put(seq, sequence)
+        return sequence
+
+    def _forget_folder(self, folder):
+        """Removes all the runs read from a folder, and the folder itself
+        from the manifest"""
+        _, keys = self._manifest.pop(str(folder), (None, []))
+        for key in keys:
+            self._remove_run(*key)
+
+    def update(self, data_source=None):
+        """
+        Refreshes the dataset incrementally. The folder tree is walked and
+        compared against the manifest of folders read previously. Only new
+        or changed folders are read, and the runs read from folders that
+        no longer exist are removed.
+
+        Parameters
+        ----------
+        data_source : List | Path | str
+            valid path to the dataset on disk. Default is the data source of
+            this dataset. If a different path is provided, it is added to
+            the data sources, and only the folders in it are refreshed.
+
+        Returns
+        -------
+        dict
+            lists of 'new', 'changed' and 'removed' folders
+        """
+        if data_source is None:
+            sources = self.data_source
+        else:
+            sources = valid_dirs(data_source)
+            self.data_source.extend(d for d in sources
+                                    if d not in self.data_source)
+
+        if not hasattr(self, '_manifest'):
+            # saved before manifests were recorded, all folders are new
+            self._manifest = dict()
+
+        summary = {'new': [], 'changed': [], 'removed': []}
+        seen = set()
+        pending = list()
+        for directory in sources:
+            sub_folders = files_in_terminal_folders(directory, self.pattern,
+                                                    self.min_count,
+                                                    self.walk_threads,
+                                                    self._is_pruned)
+            for folder, files in self._select_shard(directory, sub_folders):
+                seen.add(str(folder))
+                entry = self._manifest.get(str(folder), None)
+                if entry is None:
+                    summary['new'].append(folder)
+                elif entry[0] != self._folder_signature(folder, files):
+                    summary['changed'].append(folder)
+                else:
+                    continue
+                pending.append((folder, files))
+
+        # folders that disappeared from the data sources being refreshed
+        for folder in list(self._manifest.keys()):
+            if folder in seen:
+                continue
+            if any(d in Path(folder).parents for d in sources):
+                summary['removed'].append(Path(folder))
+                self._forget_folder(folder)
+
+        for folder in summary['changed']:
+            self._forget_folder(folder)
+        for folder, signature, sequences in self._read_folders(pending):
+            self._add_folder(folder, signature, sequences)
+        return summary
+
     def _tree_add_node(self, subject_id, session_id, seq_id, run_id,
                        seq_info):
         """
@@ -248,13 +646,21 @@ class BaseDataset(ABC):
 
     def _merge(self, other):
         """
-        Merges two datasets.
+        Merges two datasets. The indices of the other dataset are united
+        with the indices of this dataset directly, rather than adding its
+        runs one at a time. The sequences are shared, not copied.
 
         Parameters
         ----------
         other : BaseDataset
             Another instance of BaseDataset to merge with the current dataset
 
+        Returns
+        -------
+        List[tuple]
+            keys (subject_id, session_id, seq_id, run_id) of the runs
+            present in both datasets, with differing sequences. The sequence
+            in this dataset is kept.
 
         .. note:: Note that the function will add all subjects, sessions, and
             runs from the *other* dataset
@@ -268,11 +674,48 @@ class BaseDataset(ABC):
         if self.format != other.format:
             raise ValueError('Both must be of the same format')
 
-        for seq_id in other.get_sequence_ids():
-            for subj_id, sess_id, run_id, seq in other.traverse_horizontal(
-                    seq_id):
-                self.add(subject_id=subj_id, session_id=sess_id,
-                         seq_id=seq_id, run_id=run_id, seq=seq)
+        conflicts, added = list(), list()
+        for key, seq in other._flat_map.items():
+            existing = self._flat_map.get(key, None)
+            if existing is None:
+                added.append((key, seq))
+            elif (existing is not seq and self._materialize(existing)
+                  != other._materialize(seq)):
+                conflicts.append(key)
+        if conflicts:
+            logger.warning(f'{len(conflicts)} runs differ between '
+                           f'{self.name} and {other.name}, e.g. '
+                           f'{conflicts[0]}. Keeping the runs in {self.name}')
+
+        if self._index is not None or other._index is not None:
+            # the compact index is only changed through add
+            self.add_many((*key, seq) for key, seq in added)
+            self._manifest.update(getattr(other, '_manifest', {}))
+            return conflicts
+
+        # sequences of a session that are new to a subject, counted before
+        #   the trees are united
+        new_branches = {key[:3] for key, _ in added
+                        if key[2] not in self._tree_map.get(
+                            key[0], {}).get(key[1], {})}
+        # every run of other is either added now or already present, so the
+        #   indices are simply united
+        self._flat_map.update(added)
+        for key, seq in added:
+            self._index_run(key, seq)
+        _union_tree(self._tree_map, other._tree_map, depth=4)
+        for seq_id, runs in other._seqs_map.items():
+            self._seqs_map.setdefault(seq_id, set()).update(runs)
+        for session_id, seq_ids in other._sess_map.items():
+            self._sess_map.setdefault(session_id, set()).update(seq_ids)
+        for _, session_id, seq_id in new_branches:
+            self._count_session(session_id, seq_id, 1)
+        self._subj_ids.update(other._subj_ids)
+        self._seq_ids.update(other._seq_ids)
+        # keep track of the folders read by the other dataset, to refresh
+        #   the merged dataset incrementally
+        self._manifest.update(getattr(other, '_manifest', {}))
+        return conflicts
 
     def merge(self, other):
         """
@@ -284,8 +727,13 @@ class BaseDataset(ABC):
         ----------
         other : BaseDataset
             Another instance of BaseDataset to merge with the current dataset
+
+        Returns
+        -------
+        List[tuple]
+            keys of the runs with differing sequences in the two datasets
         """
-        self._merge(other)
+        return self._merge(other)
 
     def add(self, subject_id, session_id, seq_id, run_id, seq):
         """
@@ -312,11 +760,19 @@ class BaseDataset(ABC):
             Instance of the sequence
         """
 
-        if not isinstance(seq, BaseSequence):
+        if not isinstance(seq, (BaseSequence, SequenceHandle)):
             raise TypeError(f'Expected BaseSequence but got {type(seq)}')
 
+        if self._index is not None:
+            if self._index.add(subject_id, session_id, seq_id, run_id, seq):
+                self._index_run((subject_id, session_id, seq_id, run_id), seq)
+            return
+
         if (subject_id, session_id, seq_id, run_id) not in self._flat_map:
             self._flat_map[(subject_id, session_id, seq_id, run_id)] = seq
+            if seq_id not in self._tree_map.get(subject_id, {}).get(
+                    session_id, {}):
+                self._count_session(session_id, seq_id, 1)
             self._tree_add_node(subject_id=subject_id, session_id=session_id,
                                 seq_id=seq_id, run_id=run_id, seq_info=seq)
 
@@ -333,6 +789,521 @@ class BaseDataset(ABC):
             # maintaining ID lists for easy reference
             self._subj_ids.add(subject_id)
             self._seq_ids.add(seq_id)
+            self._index_run((subject_id, session_id, seq_id, run_id), seq)
+
+    def add_many(self, records) -> int:
+        """
+        Adds many runs at once e.g. all the runs read from a folder, or from
+        another dataset. All the records are validated before any is added,
+        and each index is then updated in a single sweep over the new runs.
+        Runs that already exist in the dataset are skipped, as in add().
+
+        Parameters
+        ----------
+        records : Iterable[tuple]
+            subject_id, session_id, seq_id, run_id and the sequence
+            (protocol.BaseSequence) of each run
+
+        Returns
+        -------
+        int
+            number of runs added
+        """
+        new = dict()
+        # the sequences are usually of a few classes, checked only once
+        valid_types = set()
+        for subject_id, session_id, seq_id, run_id, seq in records:
+            if type(seq) not in valid_types:
+                if not isinstance(seq, (BaseSequence, SequenceHandle)):
+                    raise TypeError('Expected BaseSequence but got '
+                                    f'{type(seq)}')
+                valid_types.add(type(seq))
+            key = (subject_id, session_id, seq_id, run_id)
+            if key not in new and key not in self._flat_map:
+                new[key] = seq
+        self._insert_runs(new)
+        return len(new)
+
+    def _insert_runs(self, runs: dict, built: dict = None):
+        """
+        Adds runs that were validated, and are not in the dataset yet, see
+        add_many.
+
+        Parameters
+        ----------
+        runs : dict
+            {(subject_id, session_id, seq_id, run_id): sequence} of the runs
+        built : dict
+            the sequences that the handles in runs were made from, in lazy
+            mode. These are used to update the optional indices, instead
+            of building the sequences again from the handles.
+        """
+        if self._index is not None:
+            for key, seq in runs.items():
+                self._index.add(*key, seq)
+        else:
+            self._flat_map.update(runs)
+            self._build_maps(runs)
+        if built is None:
+            built = runs
+        for key, seq in runs.items():
+            self._index_run(key, built[key])
+
+    def _build_maps(self, runs: dict):
+        """
+        Adds runs to _tree_map, _seqs_map, _sess_map, _subj_ids and _seq_ids,
+        but not to _flat_map. Runs of the same session are looked up in the
+        tree only once.
+
+        Parameters
+        ----------
+        runs : dict
+            {(subject_id, session_id, seq_id, run_id): sequence} of runs
+            that are not in the maps yet
+        """
+        subject_ids = set()
+        seq_runs = dict()
+        # runs usually arrive grouped by session e.g. one folder at a time,
+        #   so the branch of the last session is reused
+        last, session = None, None
+        for key, seq in runs.items():
+            subject_id, session_id, seq_id, run_id = key
+            if key[:2] != last:
+                last = key[:2]
+                subject_ids.add(subject_id)
+                session = self._tree_map.setdefault(
+                    subject_id, dict()).setdefault(session_id, dict())
+            runs_of_seq = session.get(seq_id, None)
+            if runs_of_seq is None:
+                runs_of_seq = session[seq_id] = dict()
+                self._sess_map.setdefault(session_id, set()).add(seq_id)
+                self._count_session(session_id, seq_id, 1)
+            runs_of_seq[run_id] = seq
+            seq_runs.setdefault(seq_id, []).append(
+                (subject_id, session_id, run_id))
+        for seq_id, keys in seq_runs.items():
+            self._seqs_map.setdefault(seq_id, set()).update(keys)
+        self._subj_ids.update(subject_ids)
+        self._seq_ids.update(seq_runs)
+
+    def _index_run(self, key, seq):
+        """
+        Updates the optional indices e.g. columns with a run that was just
+        added to the dataset.
+
+        Parameters
+        ----------
+        key : tuple
+            subject_id, session_id, seq_id and run_id of the run
+        seq : protocol.BaseSequence
+            Instance of the sequence
+        """
+        if (self._columns is None and self._param_indexes is None
+                and self._hashes is None and self._pool is None):
+            return
+        seq = self._materialize(seq)
+        if seq is None:
+            return
+        if self._pool is not None:
+            self._pool.add(key, seq)
+        if self._columns is not None:
+            subject_id, session_id, seq_id, run_id = key
+            columns = self._columns.get(seq_id, None)
+            if columns is None:
+                columns = self._columns[seq_id] = SequenceColumns(
+                    self._column_params)
+            columns.append(subject_id, session_id, run_id, seq)
+        if self._param_indexes is not None:
+            subject_id, session_id, seq_id, run_id = key
+            indexes = self._param_indexes.get(seq_id, None)
+            if indexes is None:
+                indexes = self._param_indexes[seq_id] = {
+                    name: ParameterIndex(name)
+                    for name in self._indexed_params}
+            for index in indexes.values():
+                index.add((subject_id, session_id, run_id), seq)
+        if self._hashes is not None:
+            self._hashes.add(key, seq)
+
+    def _unindex_run(self, key, seq):
+        """Removes a run from the optional indices, see _index_run. The
+        indices are updated by key, so the sequence is not built again in
+        lazy mode"""
+        subject_id, session_id, seq_id, run_id = key
+        if self._columns is not None:
+            columns = self._columns.get(seq_id, None)
+            if columns is not None:
+                columns.remove(subject_id, session_id, run_id)
+                if not len(columns):
+                    del self._columns[seq_id]
+        if self._param_indexes is not None:
+            for index in self._param_indexes.get(seq_id, {}).values():
+                index.remove((subject_id, session_id, run_id))
+        if self._hashes is not None:
+            self._hashes.remove(key)
+        if self._pool is not None:
+            self._pool.remove(key)
+
+    def enable_columns(self, parameters: List[str] = None):
+        """
+        Stores the parameters of the runs column-wise, one SequenceColumns
+        per sequence ID, to allow vectorized queries across all the runs.
+        The columns are built from the runs already in the dataset, and kept
+        up to date as runs are added or removed.
+
+        Parameters
+        ----------
+        parameters : List[str]
+            names of the parameters to store e.g. the include_parameters of
+            the horizontal_audit in the config. If None, all the parameters
+            are stored.
+        """
+        self._column_params = None if parameters is None else list(
+            parameters)
+        self._columns = dict()
+        for key, seq in self._flat_map.items():
+            self._index_run(key, seq)
+
+    def enable_index(self, parameters: List[str]):
+        """
+        Indexes the runs of every sequence ID by the values of the given
+        parameters, so that find() can answer queries on these parameters
+        without scanning the runs. The indexes are built from the runs
+        already in the dataset, and kept up to date as runs are added or
+        removed.
+
+        Parameters
+        ----------
+        parameters : List[str]
+            names of the parameters to index e.g. ['EchoTime',
+            'DeviceSerialNumber']
+        """
+        self._indexed_params = tuple(parameters)
+        self._param_indexes = dict()
+        for key, seq in self._flat_map.items():
+            self._index_run(key, seq)
+
+    def find(self, seq_id, **predicates) -> set:
+        """
+        Returns the runs of a sequence ID whose parameters match all the
+        predicates. A predicate is either a value, matched exactly (numbers
+        are rounded to 3 decimals), or a slice(low, high) matching numeric
+        values such that low <= value <= high, where either bound may be
+        None. Predicates on parameters indexed with enable_index are
+        answered from the indexes, the others by checking the remaining
+        runs one at a time.
+
+        Examples
+        --------
+        >>> dataset.find('fmri', EchoTime=30, RepetitionTime=slice(None, 3000))
+
+        Parameters
+        ----------
+        seq_id : str
+            Name of the Sequence ID
+        predicates : dict
+            parameter names and the values (or slices) to match
+
+        Returns
+        -------
+        set
+            keys (subject_id, session_id, seq_id, run_id) of the matching
+            runs
+        """
+        if seq_id not in self._seqs_map:
+            return set()
+        indexes = (self._param_indexes or {}).get(seq_id, {})
+        # start from the smallest set of runs to keep intersections cheap
+        found = sorted((indexes[name].match(predicate)
+                        for name, predicate in predicates.items()
+                        if name in indexes), key=len)
+        if found:
+            runs = found[0].intersection(*found[1:])
+        else:
+            runs = self._seqs_map[seq_id]
+
+        rest = [(name, predicate) for name, predicate in predicates.items()
+                if name not in indexes]
+        keys = set()
+        for subject_id, session_id, run_id in runs:
+            key = (subject_id, session_id, seq_id, run_id)
+            if rest:
+                seq = self._materialize(self._flat_map[key])
+                if seq is None or not all(matches(seq, name, predicate)
+                                          for name, predicate in rest):
+                    continue
+            keys.add(key)
+        return keys
+
+    def enable_hashes(self):
+        """
+        Maintains a hash of the contents of every run, sequence, session and
+        subject, and of the whole dataset, as runs are added or removed.
+        Datasets that both have hashes are compared in constant time if they
+        are equal, and diff() descends only into the parts that differ.
+        """
+        # assigned once complete, so that a failure leaves no partial hashes
+        self._hashes = self._hash_runs()
+
+    def _hash_runs(self) -> ContentHashes:
+        """Computes the hashes of all the runs, building the sequences from
+        their handles in lazy mode. Runs that cannot be built are skipped"""
+        hashes = ContentHashes()
+        for key, seq in self._flat_map.items():
+            seq = self._materialize(seq)
+            if seq is not None:
+                hashes.add(key, seq)
+        return hashes
+
+    def _content_hashes(self) -> ContentHashes:
+        """Returns the hashes of the dataset, computing them if they are not
+        maintained"""
+        if self._hashes is not None:
+            return self._hashes
+        return self._hash_runs()
+
+    def content_hash(self) -> str:
+        """Returns the hash of the contents of the whole dataset, as a hex
+        string. See enable_hashes"""
+        return f'{self._content_hashes().hash_of():032x}'
+
+    def diff(self, other):
+        """
+        Compares the runs of this dataset with another dataset e.g. an
+        older snapshot, descending only into the subjects, sessions and
+        sequences whose hashes differ. Hashes are computed on the fly for
+        the datasets without enable_hashes.
+
+        Parameters
+        ----------
+        other : BaseDataset
+            Another instance of BaseDataset
+
+        Returns
+        -------
+        dict
+            sorted lists of keys (subject_id, session_id, seq_id, run_id) of
+            the 'added' runs (only in this dataset), the 'removed' runs (only
+            in other) and the 'changed' runs (in both, with different
+            parameters)
+        """
+        if not isinstance(other, BaseDataset):
+            raise TypeError('Both must be a BaseDataset')
+        return self._content_hashes().diff(other._content_hashes())
+
+    def count_protocols(self, seq_id) -> int:
+        """
+        Returns the number of distinct protocols of a sequence ID, i.e. of
+        distinct sets of parameters across its runs, leaving out the
+        demographics and the parameters that change from run to run (see
+        config.RUN_SPECIFIC_PARAMETERS). The counts are maintained as runs
+        are added or removed if the dataset was created with dedup, and
+        computed on the fly otherwise.
+
+        Parameters
+        ----------
+        seq_id : str
+            Name of the Sequence ID
+
+        Returns
+        -------
+        int
+            0 if the sequence ID is not in the dataset
+        """
+        if self._pool is not None:
+            return self._pool.count(seq_id)
+        pool = ParameterPool()
+        protocols = set()
+        for _, _, _, seq in self._runs_of(seq_id):
+            seq = self._materialize(seq)
+            if seq is not None:
+                protocols.add(pool.signature(seq))
+        return len(protocols)
+
+    def columns(self, seq_id) -> SequenceColumns:
+        """
+        Returns the parameters of all the runs of a sequence ID, stored
+        column-wise. See enable_columns.
+
+        Parameters
+        ----------
+        seq_id : str
+            Name of the Sequence ID
+
+        Returns
+        -------
+        columnar.SequenceColumns
+        """
+        if self._columns is None:
+            raise ValueError('Columns are not enabled. Use enable_columns '
+                             'first')
+        return self._columns[seq_id]
+
+    def _remove_run(self, subject_id, session_id, seq_id, run_id):
+        """
+        Removes a run from the dataset, and prunes the branches of the tree
+        (and entries in the cross-mappings) that are left empty.
+
+        Returns
+        -------
+        protocol.BaseSequence
+            the sequence that was removed, or None if the run did not exist
+        """
+        key = (subject_id, session_id, seq_id, run_id)
+        if self._index is not None:
+            seq = self._index.remove(*key)
+            if seq is not None:
+                self._unindex_run(key, seq)
+            return seq
+
+        seq = self._flat_map.pop(key, None)
+        if seq is None:
+            return None
+        self._unindex_run(key, seq)
+
+        self._seqs_map[seq_id].discard((subject_id, session_id, run_id))
+        if not self._seqs_map[seq_id]:
+            del self._seqs_map[seq_id]
+            self._seq_ids.discard(seq_id)
+
+        sessions = self._tree_map[subject_id]
+        runs = sessions[session_id][seq_id]
+        del runs[run_id]
+        if runs:
+            return seq
+        del sessions[session_id][seq_id]
+        if not sessions[session_id]:
+            del sessions[session_id]
+        if not sessions:
+            del self._tree_map[subject_id]
+            self._subj_ids.discard(subject_id)
+
+        # session IDs may be shared by subjects, e.g. 'ses-01' in BIDS
+        if not self._count_session(session_id, seq_id, -1):
+            self._sess_map[session_id].discard(seq_id)
+            if not self._sess_map[session_id]:
+                del self._sess_map[session_id]
+        return seq
+
+    def _count_session(self, session_id, seq_id, change):
+        """Updates the number of subjects with runs of a sequence in a
+        session, see _sess_counts. Returns the new count"""
+        key = (session_id, seq_id)
+        count = self._sess_counts.get(key, 0) + change
+        if count:
+            self._sess_counts[key] = count
+        else:
+            self._sess_counts.pop(key, None)
+        return count
+
+    def remove(self, subject_id, session_id, seq_id=None, run_id=None):
+        """
+        Removes a run, all the runs of a sequence in a session, or a whole
+        session. The branches of the tree left empty are pruned, and all
+        the indices are kept consistent. The folders the runs were read from
+        are not read again by update() unless they change.
+
+        Parameters
+        ----------
+        subject_id : str
+            Unique identifier for the Subject
+        session_id : str
+            Unique identifier the Session
+        seq_id : str
+            Unique identifier the Sequence. If None, the whole session is
+            removed.
+        run_id : str
+            Unique identifier the Run. If None, all the runs of the sequence
+            in the session are removed.
+
+        Returns
+        -------
+        List[tuple]
+            keys (subject_id, session_id, seq_id, run_id) of the runs removed
+        """
+        if run_id is not None:
+            if seq_id is None:
+                raise ValueError('Expected seq_id along with run_id')
+            key = (subject_id, session_id, seq_id, run_id)
+            keys = [key] if key in self._flat_map else []
+        else:
+            keys = self._keys_under(subject_id, session_id, seq_id)
+        for key in keys:
+            self._remove_run(*key)
+        return keys
+
+    def remove_subject(self, subject_id):
+        """
+        Removes all the runs of a subject, see remove()
+
+        Parameters
+        ----------
+        subject_id : str
+            Unique identifier for the Subject
+
+        Returns
+        -------
+        List[tuple]
+            keys (subject_id, session_id, seq_id, run_id) of the runs removed
+        """
+        keys = self._keys_under(subject_id)
+        for key in keys:
+            self._remove_run(*key)
+        return keys
+
+    def _keys_under(self, subject_id, session_id=None, seq_id=None):
+        """Returns the keys of the runs of a subject, optionally only those
+        of a session and sequence"""
+        if subject_id not in self._subj_ids:
+            return []
+        sessions = self._tree_map[subject_id]
+        if session_id is not None:
+            sessions = {session_id: sessions.get(session_id, {})}
+        keys = list()
+        for sess, seqs in sessions.items():
+            for sq, runs in seqs.items():
+                if seq_id is None or sq == seq_id:
+                    keys.extend((subject_id, sess, sq, run) for run in runs)
+        return keys
+
+    def replace(self, subject_id, session_id, seq_id, run_id, seq):
+        """
+        Replaces the sequence of an existing run in place e.g. after its
+        folder was read again, and updates the indices.
+
+        Parameters
+        ----------
+        subject_id : str
+            Unique identifier for the Subject
+        session_id : str
+            Unique identifier the Session
+        seq_id : str
+            Unique identifier the Sequence
+        run_id : str
+            Unique identifier the Run
+        seq : protocol.BaseSequence
+            The new sequence of the run
+
+        Returns
+        -------
+        protocol.BaseSequence
+            the previous sequence of the run
+        """
+        if not isinstance(seq, (BaseSequence, SequenceHandle)):
+            raise TypeError(f'Expected BaseSequence but got {type(seq)}')
+        key = (subject_id, session_id, seq_id, run_id)
+        if key not in self._flat_map:
+            raise KeyError(f'Run {key} does not exist')
+
+        if self._index is not None:
+            previous = self._index.replace(*key, seq)
+        else:
+            previous = self._flat_map[key]
+            self._flat_map[key] = seq
+            self._tree_map[subject_id][session_id][seq_id][run_id] = seq
+        self._unindex_run(key, previous)
+        self._index_run(key, seq)
+        return previous
 
     def get(self, subject_id, session_id, seq_id, run_id, default=None):
         """
@@ -358,14 +1329,20 @@ class BaseDataset(ABC):
             Default value to return if the sequence is not found
         """
         try:
-            return self._tree_map[subject_id][session_id][seq_id][run_id]
+            if self._index is not None:
+                seq = self._flat_map[(subject_id, session_id, seq_id, run_id)]
+            else:
+                seq = self._tree_map[subject_id][session_id][seq_id][run_id]
         except KeyError:
             logger.info('Unable to find '
                         f'{subject_id}/{session_id}/{seq_id}/{run_id}')
             return default
+        seq = self._materialize(seq)
+        return default if seq is None else seq
 
     def __getitem__(self, subject_id):
-        """intuitive getter"""
+        """intuitive getter. In compact mode, the branch of the subject is
+        read-only, use add, replace or remove to change the runs"""
         return self._tree_map[subject_id]
 
     # def save(self, out_path=None):
@@ -388,17 +1365,64 @@ class BaseDataset(ABC):
     #     else:
     #         print('No subjects exist in the dataset. Not saving it!')
 
-    def traverse_horizontal(self, seq_id):
+    def _runs_of(self, seq_id):
+        """Yields subject, session and run IDs and the sequence of every run
+        of a sequence ID, from the index of runs per sequence"""
+        if self._index is not None:
+            yield from self._index.sequence_rows(seq_id)
+            return
+        for subj, sess, run in self._seqs_map.get(seq_id, ()):
+            yield subj, sess, run, self._tree_map[subj][sess][seq_id][run]
+
+    def _count_runs(self, seq_id) -> int:
+        """Returns the number of runs of a sequence ID"""
+        if self._index is not None:
+            return self._index.sequence_count(seq_id)
+        return len(self._seqs_map.get(seq_id, ()))
+
+    def _session_tree(self, subj, sess) -> dict:
+        """Returns {seq_id: {run_id: sequence}} for a session"""
+        if self._index is not None:
+            return self._index.session_tree(subj, sess)
+        return self._tree_map[subj][sess]
+
+    def _sessions_with(self, seq_ids):
+        """
+        Yields the subject and session IDs, and the sequences of each
+        session that has runs of all the sequence IDs. Only the sessions of
+        the sequence ID with the fewest runs are visited, and each is checked
+        against the set of sequence IDs in the session.
+        """
+        seq_ids = set(seq_ids)
+        if not seq_ids or not all(s in self._seq_ids for s in seq_ids):
+            return
+        rarest = min(seq_ids, key=self._count_runs)
+        sessions = dict.fromkeys((subj, sess) for subj, sess, _, _ in
+                                 self._runs_of(rarest))
+        for subj, sess in sessions:
+            tree = self._session_tree(subj, sess)
+            if seq_ids <= tree.keys():
+                yield subj, sess, tree
+
+    def traverse_horizontal(self, seq_id, sort=False, offset=0, limit=None):
         """
         Generator to traverse the dataset horizontally. i.e.,
         all subjects, across sessions and runs for a given sequence.
         The method will yield a tuple of (subject_id, session_id, run_id,
-        sequence) for each sequence in the dataset.
+        sequence) for each sequence in the dataset. Only the runs of the
+        sequence are visited, not the whole dataset.
 
         Parameters
         ----------
         seq_id : str
             Name of the Sequence ID
+        sort : bool
+            whether to yield the runs sorted by subject, session and run
+            IDs. Otherwise, the order is arbitrary.
+        offset : int
+            number of runs to skip, for paging
+        limit : int
+            maximum number of runs to yield, for paging. Default is all.
 
         Yields
         ------
@@ -406,15 +1430,14 @@ class BaseDataset(ABC):
             A tuple of subject_id, session_id, run_id, and protocol.Sequence
             instance
         """
-
-        for subj in self._subj_ids:
-            for sess in self._tree_map[subj]:
-                if seq_id in self._tree_map[subj][sess]:
-                    for run in self._tree_map[subj][sess][seq_id]:
-                        yield (subj, sess, run,
-                               self._tree_map[subj][sess][seq_id][run])
-
-    def traverse_vertical2(self, seq_id1, seq_id2):
+        for subj, sess, run, seq in _paginate(
+                self._runs_of(seq_id),
+                key=(lambda item: item[:3]) if sort else None,
+                offset=offset, limit=limit):
+            yield subj, sess, run, self._materialize(seq)
+
+    def traverse_vertical2(self, seq_id1, seq_id2, sort=False, offset=0,
+                           limit=None):
         """
         Generator to traverse the dataset vertically. i.e.,
         sequences for a particular subject. The method will yield
@@ -427,6 +1450,12 @@ class BaseDataset(ABC):
             Name of the Sequence ID
         seq_id2 : str
             Name of the Sequence ID
+        sort : bool
+            whether to yield sorted by subject, session and run IDs
+        offset : int
+            number of items to skip, for paging
+        limit : int
+            maximum number of items to yield, for paging
 
         Yields
         ------
@@ -434,28 +1463,32 @@ class BaseDataset(ABC):
             A tuple of subj, sess, run, seq_one, seq_two
         """
 
+        def linked_runs():
+            for subj, sess, tree in self._sessions_with((seq_id1, seq_id2)):
+                # two sequences may not have a common run ID
+                #   they might have multiple runs, with different number
+                #   of runs
+                #   so getting all of their linked combinations
+                linked = self._link_runs_across_sequences(tree[seq_id1],
+                                                          tree[seq_id2])
+                for run1, run2 in linked:
+                    yield (subj, sess, run1, run2,
+                           tree[seq_id1][run1], tree[seq_id2][run2])
+
         count = 0
-        for subj in self._subj_ids:
-            for sess in self._tree_map[subj]:
-                # checking for subset relationship
-                if {seq_id1, seq_id2} <= self._tree_map[subj][sess].keys():
-                    # two sequences may not have a common run ID
-                    #   they might have multiple runs, with different number
-                    #   of runs
-                    #   so getting all of their linked combinations
-                    linked_runs = self._link_runs_across_sequences(
-                        self._tree_map[subj][sess][seq_id1],
-                        self._tree_map[subj][sess][seq_id2])
-                    for run1, run2 in linked_runs:
-                        count = count + 1
-                        yield (subj, sess, run1, run2,
-                               self._tree_map[subj][sess][seq_id1][run1],
-                               self._tree_map[subj][sess][seq_id2][run2])
+        for item in _paginate(linked_runs(),
+                              key=(lambda item: item[:4]) if sort else None,
+                              offset=offset, limit=limit):
+            count = count + 1
+            # in lazy mode, only the sequences yielded are built
+            yield (*item[:4], self._materialize(item[4]),
+                   self._materialize(item[5]))
 
         if count < 1:
             logger.info('There were no sessions/runs in these sequences!')
 
-    def traverse_vertical_multi(self, *seq_ids):
+    def traverse_vertical_multi(self, *seq_ids, sort=False, offset=0,
+                                limit=None):
         """
         Generator to traverse the dataset vertically. i.e.,
         sequences for a particular subject. The method will yield multiple
@@ -466,32 +1499,38 @@ class BaseDataset(ABC):
         ----------
         seq_ids : list
             Sequence IDs to retrieve from the dataset
+        sort : bool
+            whether to yield the sessions sorted by subject and session IDs
+        offset : int
+            number of sessions to skip, for paging
+        limit : int
+            maximum number of sessions to yield, for paging
 
         Returns
         -------
         tuple_ids_data : tuple
             A tuple of subj, sess, tuple_runs, tuple_seqs
         """
+        sessions = self._sessions_with(seq_ids)
+        if sort:
+            sessions = sorted(sessions, key=lambda item: item[:2])
 
         count = 0
-        for subj in self._subj_ids:
-            for sess in self._tree_map[subj]:
-                # if all seq IDs exist in session
-                #   checking for subset relationship:
-                if set(seq_ids) <= self._tree_map[subj][sess].keys():
-                    seqs = [self._tree_map[subj][sess][sq] for sq in seq_ids]
+        for subj, sess, tree in _paginate(sessions, key=None, offset=offset,
+                                          limit=limit):
+            seqs = [tree[sq] for sq in seq_ids]
 
-                    # two sequences may not have a common run ID
-                    #   they might have multiple runs, with different number
-                    #   of runs
-                    #   so getting all of their linked combinations
-                    runs = self._first_run_from_sequences(seqs)
+            # two sequences may not have a common run ID
+            #   they might have multiple runs, with different number
+            #   of runs
+            #   so getting all of their linked combinations
+            runs = self._first_run_from_sequences(seqs)
 
-                    out_seqs = [self._tree_map[subj][sess][seq_id][run_id]
-                                for seq_id, run_id in zip(seq_ids, runs)]
+            out_seqs = [self._materialize(tree[seq_id][run_id])
+                        for seq_id, run_id in zip(seq_ids, runs)]
 
-                    count = count + 1
-                    yield subj, sess, runs, out_seqs
+            count = count + 1
+            yield subj, sess, runs, out_seqs
 
         if count < 1:
             logger.warning(
@@ -556,7 +1595,82 @@ class BaseDataset(ABC):
         if self.format != other.format:
             raise ValueError('Both must be of the same format')
 
+        if self._hashes is not None and other._hashes is not None:
+            if self._hashes.hash_of() == other._hashes.hash_of():
+                return True
+            # the hashes are stricter than the comparison of the sequences
+            #   e.g. they include all the parameters, check the runs that
+            #   differ
+            changes = self._hashes.diff(other._hashes)
+            if changes['added'] or changes['removed']:
+                return False
+            return all(self._materialize(self._flat_map[key])
+                       == other._materialize(other._flat_map[key])
+                       for key in changes['changed'])
+
+        if self.lazy or other.lazy:
+            # handles are compared by the sequences they refer to
+            if set(self._flat_map) != set(other._flat_map):
+                return False
+            return all(self._materialize(seq)
+                       == other._materialize(other._flat_map[key])
+                       for key, seq in self._flat_map.items())
+
         if self._flat_map == other._flat_map:
             return True
         else:
             return False
+
+
+def _union_tree(target: dict, source: dict, depth: int):
+    """
+    Adds the branches of a nested dict that are missing from target. Leaves
+    already in target are kept. The nested dicts of source are copied, the
+    leaves (sequences) are shared.
+
+    Parameters
+    ----------
+    target : dict
+        nested dict to add the branches to
+    source : dict
+        nested dict to add the branches from
+    depth : int
+        number of levels of nested dicts e.g. 4 for subject, session,
+        sequence and run
+    """
+    for key, value in source.items():
+        if key not in target:
+            target[key] = _copy_tree(value, depth - 1)
+        elif depth > 1:
+            _union_tree(target[key], value, depth - 1)
+
+
+def _copy_tree(tree, depth: int):
+    """Copies the nested dicts of a tree up to depth, sharing the leaves"""
+    if depth == 0:
+        return tree
+    return {key: _copy_tree(value, depth - 1) for key, value in tree.items()}
+
+
+def _paginate(items, key=None, offset: int = 0, limit: int = None):
+    """
+    Returns a page of items, optionally sorted.
+
+    Parameters
+    ----------
+    items : Iterable
+        items to paginate
+    key : Callable
+        if given, the items are sorted with this key before paging
+    offset : int
+        number of items to skip
+    limit : int
+        maximum number of items to return. Default is all.
+    """
+    if offset < 0 or (limit is not None and limit < 0):
+        raise ValueError('Expected non-negative offset and limit. Got '
+                         f'{offset} and {limit}')
+    if key is not None:
+        items = sorted(items, key=key)
+    stop = None if limit is None else offset + limit
+    return islice(items, offset, stop)
@@ -6,7 +6,8 @@ from MRdataset import logger
 from MRdataset.base import BaseDataset
 from MRdataset.config import VALID_BIDS_DATATYPES, SUPPORTED_BIDS_DATATYPES
 from MRdataset.dicom_utils import is_bids_file
-from MRdataset.utils import folders_with_min_files, valid_dirs, read_json
+from MRdataset.lazy import SequenceHandle, file_stat
+from MRdataset.utils import valid_dirs, read_json, is_excluded_subject
 from protocol import BidsImagingSequence
 
 
@@ -29,6 +30,24 @@ class BidsDataset(BaseDataset, ABC):
         Whether to print verbose output on console.
     ds_format : str
         The format of the dataset. One of ['dicom', 'bids'].
+    walk_threads : int
+        Number of threads used to discover folders in the data source.
+    shard : tuple
+        Index and number of shards e.g. (0, 8), see BaseDataset.
+    shard_by : str
+        'folder' or 'subject', see BaseDataset.
+    compact : bool
+        Whether to store the runs in compact form, see BaseDataset.
+    lazy : bool
+        Whether to store a handle for each run instead of the sequence, see
+        BaseDataset. The sequence is parsed again from its JSON file when it
+        is accessed.
+    cache_size : int
+        Maximum number of sequences parsed from handles kept in memory, in
+        lazy mode.
+    dedup : bool
+        Whether to intern the parameters of the runs, so that equal
+        parameters are shared by all the runs, see BaseDataset.
     """
 
     def __init__(self, data_source, pattern="*.json",
@@ -37,15 +56,25 @@ class BidsDataset(BaseDataset, ABC):
                  verbose=False,
                  output_dir=None,
                  min_count=1,
+                 walk_threads=1,
+                 shard=None,
+                 shard_by='folder',
+                 compact=False,
+                 lazy=False,
+                 cache_size=128,
+                 dedup=False,
                  **kwargs):
 
-        super().__init__(data_source=data_source, name=name, ds_format='bids')
+        super().__init__(data_source=data_source, name=name, ds_format='bids',
+                         shard=shard, shard_by=shard_by, compact=compact,
+                         lazy=lazy, cache_size=cache_size, dedup=dedup)
         self.data_source = valid_dirs(data_source)
         self.pattern = pattern
         self.config_path = config_path
         self.verbose = verbose
         self.config_dict = None
         self.min_count = min_count
+        self.walk_threads = walk_threads
 
         try:
             self.output_dir = Path(output_dir)
@@ -64,6 +93,9 @@ class BidsDataset(BaseDataset, ABC):
 
         self.includes = self.config_dict.get('include_sequence', {})
         self.include_nifti_headers = self.includes.get('nifti_header', False)
+        # subject folders e.g. sub-01 to skip while walking the data source
+        self.exclude_subjects = {str(subject) for subject in
+                                 self.config_dict.get('exclude_subjects', [])}
 
     def load(self):
         """
@@ -73,32 +105,53 @@ class BidsDataset(BaseDataset, ABC):
         sequence to the dataset.
         """
 
-        for directory in self.data_source:
-            # find all sub-folders with at least min_count files matching the
-            # pattern
-            subfolders = folders_with_min_files(directory, self.pattern,
-                                                self.min_count)
-            for folder in subfolders:
-                # process each folder
-                sequences = self._process(folder)
-                for seq in sequences:
-                    self.add(subject_id=seq.subject_id,
-                             session_id=seq.session_id,
-                             run_id=seq.run_id,
-                             seq_id=seq.name, seq=seq)
-
-    def _filter_json_files(self, folder):
-        """Filters the JSON files from the folder."""
-        json_files = sorted(folder.glob(self.pattern))
+        for folder, signature, sequences in self._iter_folders():
+            self._add_folder(folder, signature, sequences)
+
+    def _is_pruned(self, folder):
+        """
+        Skips the folders of subjects listed in the exclude_subjects option
+        of the config e.g. sub-01, without listing them.
+        """
+        return (folder.name.startswith('sub-')
+                and is_excluded_subject(folder.name, self.exclude_subjects))
+
+    def _read_folders(self, sub_folders):
+        """
+        Reads the sequences from each folder.
+
+        Parameters
+        ----------
+        sub_folders : Iterable[Tuple[Path, List[Path]]]
+            Folders and the JSON files found in each folder
+
+        Yields
+        ------
+        tuple
+            folder, its signature and the list of sequences read from it
+        """
+        for folder, files in sub_folders:
+            # process each folder
+            yield (folder, self._folder_signature(folder, files),
+                   self._process(folder, files))
+
+    def _filter_json_files(self, folder, files=None):
+        """
+        Filters the JSON files from the folder. If files is None, the folder
+        is globbed again for files matching the pattern.
+        """
+        if files is None:
+            files = folder.glob(self.pattern)
+        json_files = sorted(files)
         valid_bids_files = list(filter(is_bids_file, json_files))
         if not valid_bids_files:
             logger.info(f'No valid BIDS files found in {folder}')
             return []
         return valid_bids_files
 
-    def _process(self, folder):
+    def _process(self, folder, files=None):
         """Processes the folder and returns a list of sequences."""
-        json_files = self._filter_json_files(folder)
+        json_files = self._filter_json_files(folder, files)
         sequences = []
         last_id = 0
         for i, file in enumerate(json_files):
@@ -127,6 +180,7 @@ class BidsDataset(BaseDataset, ABC):
                                  session_id=session_id,
                                  run_id=run_id,
                                  name=name)
+            seq.reference_file = file
             if seq.is_valid():
                 sequences.append(seq)
             else:
@@ -138,6 +192,34 @@ class BidsDataset(BaseDataset, ABC):
                                    f'not supported yet. Skipping it.')
         return sequences
 
+    def _make_handle(self, folder, signature, seq):
+        """Returns a handle to parse the sequence again from its JSON file,
+        see BaseDataset._make_handle"""
+        return SequenceHandle(folder=folder,
+                              filepath=seq.reference_file,
+                              fingerprint=signature,
+                              subject_id=seq.subject_id,
+                              session_id=seq.session_id,
+                              run_id=seq.run_id,
+                              name=seq.name,
+                              file_stat=file_stat(seq.reference_file))
+
+    def _load_sequence(self, handle):
+        """Parses the sequence referred to by a handle from its JSON file,
+        see BaseDataset._load_sequence"""
+        try:
+            seq = BidsImagingSequence(bidsfile=handle.filepath,
+                                      path=handle.folder)
+        except (ValueError, IOError) as exc:
+            logger.warning(f'Unable to read {handle.filepath}. Got {exc}')
+            return None
+        seq.set_session_info(subject_id=handle.subject_id,
+                             session_id=handle.session_id,
+                             run_id=handle.run_id,
+                             name=handle.name)
+        seq.reference_file = handle.filepath
+        return seq
+
     @staticmethod
     def get_run_id(filename, last_id):
         """
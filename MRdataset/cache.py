@@ -0,0 +1,137 @@
+"""On-disk cache of the sequences read from each folder of dicom slices"""
+import json
+import pickle
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Union, Tuple, Any
+
+from MRdataset import logger
+
+#: Bump the version whenever the format of the cached sequences changes
+CACHE_VERSION = 6
+
+
+class HeaderCache:
+    """
+    SQLite backed cache of sequences read from folders of dicom slices. Each
+    folder is stored along with a fingerprint of its files, i.e. path, size,
+    modification time and inode of each file. If the fingerprint of a
+    folder is unchanged on the next import, the cached sequences are reused
+    and none of the dicom files are read again.
+
+    The cache is safe to share across threads and worker processes. Each
+    thread opens its own connection, and connections are not pickled.
+
+    Parameters
+    ----------
+    db_path : str | Path
+        Path to the SQLite database. Created if it does not exist.
+    """
+
+    def __init__(self, db_path: Union[str, Path]):
+        self.db_path = Path(db_path)
+        self._local = threading.local()
+
+    def _connect(self):
+        """Returns the connection for the current thread"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(str(self.db_path), timeout=60)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS folders ('
+                         'path TEXT PRIMARY KEY, '
+                         'fingerprint TEXT NOT NULL, '
+                         'version INTEGER NOT NULL, '
+                         'status TEXT, '
+                         'sequence BLOB)')
+            conn.commit()
+            self._local.conn = conn
+        return conn
+
+    def get(self, folder: Union[str, Path],
+            fingerprint: str) -> Tuple[bool, Any, Any]:
+        """
+        Looks up the sequences cached for a folder.
+
+        Parameters
+        ----------
+        folder : str | Path
+            The path to the folder containing the dicom slices
+        fingerprint : str
+            Fingerprint of the files currently in the folder
+
+        Returns
+        -------
+        tuple
+            (hit, sequences, status). hit is False if the folder was never
+            cached, or if its files have changed since.
+        """
+        try:
+            row = self._connect().execute(
+                'SELECT fingerprint, version, status, sequence FROM folders '
+                'WHERE path = ?', (str(folder),)).fetchone()
+        except sqlite3.Error as exc:
+            logger.warning(f'Unable to read header cache {self.db_path}. '
+                           f'Got {exc}')
+            return False, None, None
+
+        if row is None or row[0] != fingerprint or row[1] != CACHE_VERSION:
+            return False, None, None
+        try:
+            sequences = pickle.loads(row[3])
+        except (pickle.UnpicklingError, EOFError, AttributeError,
+                ImportError) as exc:
+            logger.info(f'Unable to unpickle cached sequences for {folder}. '
+                        f'Got {exc}')
+            return False, None, None
+        status = None if row[2] is None else json.loads(row[2])
+        return True, sequences, status
+
+    def put(self, folder: Union[str, Path], fingerprint: str,
+            sequences: Any, status: Any = None) -> None:
+        """
+        Stores the sequences read from a folder. An empty list is also
+        cached, so that folders without valid slices are skipped as well.
+
+        Parameters
+        ----------
+        folder : str | Path
+            The path to the folder containing the dicom slices
+        fingerprint : str
+            Fingerprint of the files in the folder
+        sequences : List[protocol.DicomImagingSequence]
+            The sequences read from the folder, including echo information
+        status : list
+            Whether the whole folder must be read on the next run, and the
+            reasons to skip it, see DicomDataset._folder_status
+        """
+        blob = pickle.dumps(sequences, protocol=pickle.HIGHEST_PROTOCOL)
+        if status is not None:
+            status = json.dumps(status)
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute('INSERT OR REPLACE INTO folders VALUES '
+                             '(?, ?, ?, ?, ?)',
+                             (str(folder), fingerprint, CACHE_VERSION,
+                              status, blob))
+        except sqlite3.Error as exc:
+            logger.warning(f'Unable to update header cache {self.db_path}. '
+                           f'Got {exc}')
+
+    def close(self):
+        """Closes the connection opened by the current thread"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    def __getstate__(self):
+        """Connections cannot be pickled, only the path is retained"""
+        return {'db_path': self.db_path}
+
+    def __setstate__(self, state):
+        self.db_path = state['db_path']
+        self._local = threading.local()
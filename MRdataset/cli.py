@@ -1,8 +1,11 @@
 import argparse
+import sys
 from pathlib import Path
 
-from MRdataset import import_dataset, save_mr_dataset, logger
-from MRdataset.utils import is_writable
+from MRdataset import (import_dataset, save_mr_dataset, update_dataset,
+                       merge_datasets, merge_shards, logger)
+from MRdataset.config import SCAN_BUFFER_SIZE
+from MRdataset.utils import is_writable, parse_shard
 
 
 def get_parser():
@@ -33,6 +36,114 @@ def get_parser():
                           help='flag dataset as a partial dataset')
     optional.add_argument('-v', '--verbose', action='store_true',
                           help='allow verbose output on console')
+    optional.add_argument('--walk-threads', type=int, default=1,
+                          help='number of threads used to discover folders '
+                               'in data source. Useful on network/parallel '
+                               'filesystems.')
+    optional.add_argument('-j', '--jobs', type=int, default=1,
+                          help='number of worker processes used to read '
+                               'the DICOM files. Use -1 for all cores.')
+    optional.add_argument('--cache', action='store_true',
+                          help='cache DICOM headers in output directory, '
+                               'unchanged folders are not read again on '
+                               'the next run')
+    optional.add_argument('--fast-read', action='store_true',
+                          help='read only the DICOM tags required to '
+                               'validate the slices, except for the first '
+                               'slice in each folder')
+    optional.add_argument('--sampling-patience', type=int, default=None,
+                          help='sample the slices in each folder, and stop '
+                               'after these many consecutive slices without '
+                               'a new echo. Default is to read all slices.')
+    optional.add_argument('--prefetch', type=int, default=0,
+                          help='number of DICOM files read ahead of the '
+                               'parser. Useful on spinning disks and NFS.')
+    optional.add_argument('--prefetch-size', type=int,
+                          default=SCAN_BUFFER_SIZE,
+                          help='number of bytes prefetched from each file')
+    optional.add_argument('--fadvise', action='store_true',
+                          help='advise the kernel to read ahead prefetched '
+                               'files (posix_fadvise)')
+    optional.add_argument('--shard', type=parse_shard, default=None,
+                          help='import only shard i of N, given as i/N '
+                               'e.g. 0/8, for cluster array jobs')
+    optional.add_argument('--shard-by', type=str, default='folder',
+                          choices=['folder', 'subject'],
+                          help='assign each folder, or each subject '
+                               'directory, to a shard')
+    optional.add_argument('--compact', action='store_true',
+                          help='store the runs in compact form, to save '
+                               'memory on very large datasets')
+    optional.add_argument('--lazy', action='store_true',
+                          help='store a handle to each run instead of the '
+                               'sequence, sequences are read again when '
+                               'accessed')
+    optional.add_argument('--dedup', action='store_true',
+                          help='share equal parameters across runs, to '
+                               'save memory when most runs have the same '
+                               'protocol')
+    return parser
+
+
+def get_update_parser():
+    """Parser for mrds update"""
+    parser = argparse.ArgumentParser(
+        prog='mrds update',
+        description='MRdataset : refreshes a saved dataset with the folders '
+                    'that were added, changed or removed since it was saved',
+        add_help=False)
+    required = parser.add_argument_group('required arguments')
+    optional = parser.add_argument_group('optional arguments')
+
+    required.add_argument('-e', '--existing', type=str, required=True,
+                          help='path to a saved dataset (.mrds.pkl) to '
+                               'refresh')
+    optional.add_argument('-d', '--data-source', type=str,
+                          help='directory containing the dataset. Default '
+                               'is the directory the dataset was imported '
+                               'from.')
+    optional.add_argument('-o', '--output', type=str,
+                          help='path to save the refreshed dataset. Default '
+                               'is to overwrite the existing dataset.')
+    optional.add_argument('-h', '--help', action='help',
+                          default=argparse.SUPPRESS,
+                          help='show this help message and exit')
+    optional.add_argument('-v', '--verbose', action='store_true',
+                          help='allow verbose output on console')
+    optional.add_argument('--walk-threads', type=int, default=1,
+                          help='number of threads used to discover folders '
+                               'in data source.')
+    optional.add_argument('-j', '--jobs', type=int, default=1,
+                          help='number of worker processes used to read '
+                               'the DICOM files. Use -1 for all cores.')
+    return parser
+
+
+def get_merge_parser():
+    """Parser for mrds merge"""
+    parser = argparse.ArgumentParser(
+        prog='mrds merge',
+        description='MRdataset : merges several saved datasets e.g. the '
+                    'shards imported by the jobs of a cluster array',
+        add_help=False)
+    required = parser.add_argument_group('required arguments')
+    optional = parser.add_argument_group('optional arguments')
+
+    required.add_argument('inputs', type=str, nargs='+',
+                          help='paths to saved datasets (.mrds.pkl) to merge')
+    required.add_argument('-o', '--output', type=str, required=True,
+                          help='path to save the merged dataset')
+    optional.add_argument('-h', '--help', action='help',
+                          default=argparse.SUPPRESS,
+                          help='show this help message and exit')
+    optional.add_argument('-v', '--verbose', action='store_true',
+                          help='allow verbose output on console')
+    optional.add_argument('--shards', action='store_true',
+                          help='inputs are the shards of a dataset, check '
+                               'that all the shards are present')
+    optional.add_argument('--allow-partial', action='store_true',
+                          help='with --shards, merge even if some shards '
+                               'are missing')
     return parser
 
 
@@ -68,6 +179,89 @@ def parse_args():
     return args
 
 
+def update_cli(argv=None):
+    """
+    Refreshes a saved dataset incrementally. Only folders that are new or
+    have changed since the dataset was saved are read, and runs read from
+    folders that no longer exist are removed.
+
+    -e, --existing : str
+        path to a saved dataset (.mrds.pkl) to refresh
+    -d, --data-source : str
+        directory containing the dataset. Default is the directory the
+        dataset was imported from.
+    -o, --output : str
+        path to save the refreshed dataset. Default is to overwrite the
+        existing dataset.
+    --walk-threads : int
+        number of threads used to discover folders in the data source.
+    -j, --jobs : int
+        number of worker processes used to read the DICOM files.
+
+    Examples
+    --------
+    .. code :: bash
+
+        mrds update -e /path/to/my/output/dir/abcd_baseline.mrds.pkl
+    """
+    args = get_update_parser().parse_args(argv)
+    if args.data_source and not Path(args.data_source).is_dir():
+        raise OSError('Expected valid directory for --data_source argument, '
+                      f'Got {args.data_source}')
+    dataset = update_dataset(args.existing,
+                             data_source=args.data_source,
+                             verbose=args.verbose,
+                             walk_threads=args.walk_threads,
+                             n_jobs=args.jobs)
+    output = args.output if args.output else args.existing
+    save_mr_dataset(output, dataset)
+    return dataset
+
+
+def merge_cli(argv=None):
+    """
+    Merges several saved datasets into one. The datasets are loaded one at
+    a time, and united directly. Runs present in several datasets with
+    differing sequences are reported, and the sequence from the first
+    dataset is kept.
+
+    inputs : str
+        paths to saved datasets (.mrds.pkl) to merge
+    -o, --output : str
+        path to save the merged dataset
+    --shards : bool
+        the inputs are the shards of a dataset, imported with --shard. The
+        merged dataset is marked complete once all the shards are present.
+    --allow-partial : bool
+        with --shards, merge the shards even if some are missing.
+
+    Examples
+    --------
+    .. code :: bash
+
+        mrds merge --shards -o abcd_baseline.mrds.pkl abcd_baseline_shard-*
+    """
+    args = get_merge_parser().parse_args(argv)
+    if args.shards:
+        dataset = merge_shards(args.inputs, allow_partial=args.allow_partial)
+    else:
+        dataset, conflicts = merge_datasets(args.inputs)
+        if conflicts:
+            logger.warning(f'{len(conflicts)} runs hold differing sequences '
+                           f'in the datasets e.g. {conflicts[0]}')
+    if args.verbose:
+        print(dataset)
+    save_mr_dataset(args.output, dataset)
+    return dataset
+
+
+#: sub-commands of mrds, the default is to import a dataset
+SUBCOMMANDS = {
+    'update': update_cli,
+    'merge': merge_cli,
+}
+
+
 def cli():
     """
     The following arguments are supported:
@@ -88,6 +282,45 @@ def cli():
         flag dataset as a partial dataset. The flag is useful while reading a
         dataset in chunks e.g. when the dataset is too large to fit in memory.
         If the dataset is complete, the flag should not be set.
+    --walk-threads : int
+        number of threads used to discover folders in the data source.
+        Useful on network/parallel filesystems e.g. NFS, Lustre.
+    -j, --jobs : int
+        number of worker processes used to read the DICOM files. Use -1 to
+        use all the cores.
+    --cache : bool
+        cache the DICOM headers read from each folder in the output
+        directory. Folders that are unchanged since the previous run are not
+        read again.
+    --fast-read : bool
+        read only the DICOM tags required to validate and compare the slices
+        in a folder. The first valid slice in each folder is read in full.
+    --sampling-patience : int
+        sample the slices evenly across each folder, and stop reading once
+        these many consecutive slices have not shown a new echo.
+    --prefetch : int
+        number of DICOM files read ahead of the parser by a small pool of
+        threads. Useful on spinning disks and network filesystems.
+    --prefetch-size : int
+        number of bytes prefetched from the beginning of each file.
+    --fadvise : bool
+        advise the kernel to read ahead the whole of each prefetched file.
+    --shard : str
+        import only shard i of N, given as i/N e.g. 0/8, counting from 0.
+        Each shard is saved as {name}_shard-{i}-of-{N}.mrds.pkl, to be
+        merged with mrds merge --shards once all the jobs are done.
+    --shard-by : str
+        assign each terminal 'folder', or each 'subject' i.e. top-level
+        directory of the data source, to a shard. Default is folder.
+    --compact : bool
+        store the runs in a compact form, with every ID interned as an
+        integer code. Saves memory on datasets with millions of runs.
+    --lazy : bool
+        store a lightweight handle to each run instead of the sequence. The
+        sequences are read again from disk when they are accessed.
+    --dedup : bool
+        intern the parameters of the runs, so that equal parameters are
+        stored once and shared by all the runs with the same protocol.
 
     Examples
     --------
@@ -95,7 +328,17 @@ def cli():
 
         mrds -d /path/to/my/data/ --format dicom --name abcd_baseline
         --config mri-config.json --output-dir /path/to/my/output/dir/
+
+        # in a SLURM array job with --array=0-7
+        mrds -d /path/to/my/data/ --name abcd_baseline
+        --shard $SLURM_ARRAY_TASK_ID/8
+
+    See update_cli for the sub-command to refresh a saved dataset, and
+    merge_cli for the sub-command to merge saved datasets e.g. shards.
     """
+    if len(sys.argv) > 1 and sys.argv[1] in SUBCOMMANDS:
+        return SUBCOMMANDS[sys.argv[1]](sys.argv[2:])
+
     args = parse_args()
     dataset = import_dataset(data_source=args.data_source,
                              ds_format=args.format,
@@ -103,8 +346,24 @@ def cli():
                              verbose=args.verbose,
                              is_complete=not args.is_partial,
                              config_path=args.config,
-                             output_dir=args.output_dir)
-    save_mr_dataset(f"{args.output_dir}/{dataset.name}.mrds.pkl", dataset)
+                             output_dir=args.output_dir,
+                             walk_threads=args.walk_threads,
+                             n_jobs=args.jobs,
+                             use_cache=args.cache,
+                             fast_read=args.fast_read,
+                             sampling_patience=args.sampling_patience,
+                             prefetch=args.prefetch,
+                             prefetch_size=args.prefetch_size,
+                             fadvise=args.fadvise,
+                             shard=args.shard,
+                             shard_by=args.shard_by,
+                             compact=args.compact,
+                             lazy=args.lazy,
+                             dedup=args.dedup)
+    filename = dataset.name
+    if args.shard is not None:
+        filename = f'{filename}_shard-{args.shard[0]}-of-{args.shard[1]}'
+    save_mr_dataset(f"{args.output_dir}/{filename}.mrds.pkl", dataset)
     return dataset
 
 
@@ -0,0 +1,301 @@
+"""
+Columnar storage of the parameters of the runs of a sequence ID. Each
+parameter is stored as a NumPy array with one element per run, so that
+queries across all the runs e.g. the most common RepetitionTime, or the runs
+where FlipAngle differs from a reference, are vectorized instead of looping
+over the sequences.
+
+Numeric parameters are stored as float64, with NaN for missing values. All
+other parameters are stored as integer codes into a list of categories, with
+-1 for missing values. Multi-valued parameters e.g. EchoTime of a multi-echo
+sequence are stored as categories, with the values as a tuple.
+"""
+from numbers import Number
+from typing import Iterable, List, Optional, Tuple
+
+import numpy as np
+from protocol import BaseSequence, UnspecifiedType
+
+# initial number of rows allocated, the arrays are doubled when full
+_INITIAL_CAPACITY = 16
+# code for missing values in categorical columns
+_MISSING = -1
+
+
+def normalize_value(value, decimals: Optional[int] = None):
+    """
+    Converts the value of a parameter to a hashable form, so that it can be
+    used as a category or a key. Missing values become None, numbers become
+    floats, and lists become tuples.
+
+    Parameters
+    ----------
+    value : Any
+        value of a parameter e.g. from seq[name].get_value()
+    decimals : int
+        if given, numbers are rounded to as many decimals
+
+    Returns
+    -------
+    Any
+    """
+    if value is None or isinstance(value, UnspecifiedType):
+        return None
+    if isinstance(value, (bool, np.bool_)):
+        return bool(value)
+    if isinstance(value, (Number, np.number)):
+        value = float(value)
+        return value if decimals is None else round(value, decimals)
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return tuple(normalize_value(v, decimals) for v in value)
+    if isinstance(value, (set, frozenset)):
+        return frozenset(value)
+    return value
+
+
+class _Column:
+    """A growable column of either numbers or categorical codes"""
+
+    def __init__(self, capacity, numeric):
+        self.numeric = numeric
+        if numeric:
+            self.data = np.full(capacity, np.nan)
+        else:
+            self.data = np.full(capacity, _MISSING, dtype=np.int32)
+        self.categories = list()
+        self._codes = dict()
+
+    def encode(self, value) -> int:
+        """Returns the code of a category, assigning a new code if needed"""
+        code = self._codes.get(value, None)
+        if code is None:
+            code = self._codes[value] = len(self.categories)
+            self.categories.append(value)
+        return code
+
+    def set(self, row, value):
+        """Stores a normalized value at a row"""
+        if value is None:
+            return
+        if self.numeric and not isinstance(value, float):
+            self.to_categorical()
+        self.data[row] = value if self.numeric else self.encode(value)
+
+    def to_categorical(self):
+        """Converts a numeric column to categorical, once a value that is
+        not a number is seen"""
+        values = self.data
+        self.numeric = False
+        self.data = np.full(len(values), _MISSING, dtype=np.int32)
+        for row in np.flatnonzero(~np.isnan(values)):
+            self.data[row] = self.encode(float(values[row]))
+
+    def grow(self, capacity):
+        """Extends the column to a larger capacity"""
+        fill = np.nan if self.numeric else _MISSING
+        extra = np.full(capacity - len(self.data), fill, dtype=self.data.dtype)
+        self.data = np.concatenate([self.data, extra])
+
+    def __getstate__(self):
+        # the dict of codes is rebuilt from the list of categories
+        return self.numeric, self.data, self.categories
+
+    def __setstate__(self, state):
+        self.numeric, self.data, self.categories = state
+        self._codes = {value: code for code, value in
+                       enumerate(self.categories)}
+
+
+class SequenceColumns:
+    """
+    Parameters of all the runs of a sequence ID, stored column-wise. Rows
+    are appended as runs are added to the dataset, and the row index holds
+    the (subject, session, run) of each row. Removed runs are masked, and
+    their rows are not reused.
+
+    Parameters
+    ----------
+    parameters : Iterable[str]
+        names of the parameters to store. If None, all the parameters of
+        every run are stored, and columns are added as new parameters are
+        seen.
+    """
+
+    def __init__(self, parameters: Optional[Iterable[str]] = None):
+        self._fixed = parameters is not None
+        self._capacity = _INITIAL_CAPACITY
+        self._count = 0
+        self._columns = dict()
+        for name in parameters or ():
+            self._columns[name] = _Column(self._capacity, numeric=True)
+        # (subject, session, run) of each row, and the reverse mapping
+        self.index = list()
+        self._rows = dict()
+        self._valid = np.zeros(self._capacity, dtype=bool)
+
+    def __len__(self):
+        return len(self._rows)
+
+    @property
+    def parameters(self) -> List[str]:
+        """Names of the parameters stored"""
+        return sorted(self._columns)
+
+    def append(self, subject_id, session_id, run_id, seq: BaseSequence):
+        """Stores the parameters of a run in a new row"""
+        key = (subject_id, session_id, run_id)
+        if key in self._rows:
+            return
+        if self._count == self._capacity:
+            self._capacity *= 2
+            for column in self._columns.values():
+                column.grow(self._capacity)
+            self._valid = np.concatenate(
+                [self._valid, np.zeros(self._count, dtype=bool)])
+        row = self._count
+        self._count += 1
+        self.index.append(key)
+        self._rows[key] = row
+        self._valid[row] = True
+
+        names = self._columns if self._fixed else seq
+        for name in names:
+            param = seq[name] if name in seq else None
+            value = None if param is None else normalize_value(
+                param.get_value())
+            column = self._columns.get(name, None)
+            if column is None:
+                column = self._columns[name] = _Column(self._capacity,
+                                                       numeric=True)
+            column.set(row, value)
+
+    def remove(self, subject_id, session_id, run_id):
+        """Masks the row of a run"""
+        row = self._rows.pop((subject_id, session_id, run_id), None)
+        if row is not None:
+            self._valid[row] = False
+
+    def _column(self, name) -> _Column:
+        try:
+            return self._columns[name]
+        except KeyError:
+            raise KeyError(f'Parameter {name} is not stored') from None
+
+    @property
+    def valid(self) -> np.ndarray:
+        """Boolean mask of the rows that were not removed"""
+        return self._valid[:self._count]
+
+    def codes(self, name) -> Tuple[np.ndarray, list]:
+        """
+        Returns the codes and the categories of a parameter. The codes of
+        numeric parameters are computed on the fly, from the sorted values.
+
+        Parameters
+        ----------
+        name : str
+            name of the parameter e.g. 'RepetitionTime'
+
+        Returns
+        -------
+        tuple
+            array of codes, one per row (-1 if missing), and the list of
+            categories
+        """
+        column = self._column(name)
+        data = column.data[:self._count]
+        if not column.numeric:
+            return data, column.categories
+        present = ~np.isnan(data)
+        categories, inverse = np.unique(data[present], return_inverse=True)
+        codes = np.full(self._count, _MISSING, dtype=np.int32)
+        codes[present] = inverse
+        return codes, categories.tolist()
+
+    def values(self, name) -> np.ndarray:
+        """
+        Returns the values of a parameter, one per row. Numeric parameters
+        are returned as float64 with NaN if missing, others as an object
+        array with None if missing.
+        """
+        column = self._column(name)
+        data = column.data[:self._count]
+        if column.numeric:
+            return data
+        categories = np.empty(len(column.categories) + 1, dtype=object)
+        categories[:-1] = column.categories
+        # code -1 picks the trailing None
+        return categories[data]
+
+    def missing(self, name) -> np.ndarray:
+        """Boolean mask of the rows where a parameter is missing"""
+        column = self._column(name)
+        data = column.data[:self._count]
+        if column.numeric:
+            return np.isnan(data) & self.valid
+        return (data == _MISSING) & self.valid
+
+    def mode(self, name):
+        """
+        Returns the most common value of a parameter across the runs, and
+        the number of runs with that value. Missing values are ignored.
+
+        Returns
+        -------
+        tuple
+            value (None if missing for all runs) and count
+        """
+        column = self._column(name)
+        data = column.data[:self._count][self.valid]
+        if column.numeric:
+            data = data[~np.isnan(data)]
+            if not data.size:
+                return None, 0
+            values, counts = np.unique(data, return_counts=True)
+            best = np.argmax(counts)
+            return float(values[best]), int(counts[best])
+        data = data[data != _MISSING]
+        if not data.size:
+            return None, 0
+        counts = np.bincount(data)
+        best = int(np.argmax(counts))
+        return column.categories[best], int(counts[best])
+
+    def differs(self, name, reference, decimals: int = 3) -> np.ndarray:
+        """
+        Returns a boolean mask of the rows where the value of a parameter
+        differs from a reference. Rows where the parameter is missing are
+        not included, see missing().
+
+        Parameters
+        ----------
+        name : str
+            name of the parameter e.g. 'FlipAngle'
+        reference : Any
+            reference value, or the parameter of a reference sequence
+        decimals : int
+            numeric values are compared after rounding to as many decimals,
+            as in protocol.NumericParameter
+        """
+        if hasattr(reference, 'get_value'):
+            reference = reference.get_value()
+        reference = normalize_value(reference)
+        column = self._column(name)
+        data = column.data[:self._count]
+        present = ~self.missing(name)
+        if column.numeric:
+            if not isinstance(reference, float):
+                return present & self.valid
+            mask = np.round(data, decimals) != np.round(reference, decimals)
+            return mask & present & self.valid
+        code = column._codes.get(reference, None)
+        if code is None:
+            return present & self.valid
+        return (data != code) & present & self.valid
+
+    def rows(self, mask: Optional[np.ndarray] = None) -> List[tuple]:
+        """Returns the (subject, session, run) of the rows selected by a
+        boolean mask, or of all the rows"""
+        if mask is None:
+            mask = self.valid
+        return [self.index[row] for row in np.flatnonzero(mask & self.valid)]
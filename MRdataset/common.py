@@ -1,11 +1,14 @@
+import inspect
 import pickle
+from concurrent.futures import Executor
 from pathlib import Path
-from typing import Union, List
+from typing import Union, List, Iterator, Tuple
 
 from MRdataset import logger
 from MRdataset.base import BaseDataset
 from MRdataset.bids import BidsDataset
-from MRdataset.config import VALID_DATASET_FORMATS
+from MRdataset.config import (VALID_DATASET_FORMATS, SCAN_BUFFER_SIZE,
+                              UPDATE_OPTIONS, DICOM_ONLY_OPTIONS)
 from MRdataset.dicom import DicomDataset
 from MRdataset.utils import random_name, check_mrds_extension
 
@@ -18,6 +21,21 @@ def import_dataset(data_source: Union[str, Path, List],
                    is_complete: bool = True,
                    config_path: Union[str, Path] = None,
                    output_dir: Union[str, Path] = None,
+                   walk_threads: int = 1,
+                   n_jobs: int = 1,
+                   executor: Executor = None,
+                   use_cache: bool = False,
+                   fast_read: bool = False,
+                   sampling_patience: int = None,
+                   prefetch: int = 0,
+                   prefetch_size: int = SCAN_BUFFER_SIZE,
+                   fadvise: bool = False,
+                   shard: Tuple[int, int] = None,
+                   shard_by: str = 'folder',
+                   compact: bool = False,
+                   lazy: bool = False,
+                   cache_size: int = 128,
+                   dedup: bool = False,
                    **_kwargs) -> 'BaseDataset':
     """
     Create MRdataset from data source as per arguments. This function acts as a
@@ -46,6 +64,63 @@ def import_dataset(data_source: Union[str, Path, List],
         sequences to read, subjects to ignore, etc.
     output_dir: Union[str, Path]
         path to the directory where the output files will be saved.
+    walk_threads: int
+        number of threads used to discover folders in data_source. Folders
+        are streamed to the loader as they are found, in a deterministic
+        order. Useful on network/parallel filesystems e.g. NFS, Lustre.
+    n_jobs: int
+        number of worker processes used to read the DICOM folders. Use -1 to
+        use all the cores. The dataset is identical for any number of jobs.
+    executor: concurrent.futures.Executor
+        user-supplied executor used to read the DICOM folders, e.g. to
+        share a pool across calls. If provided, n_jobs is ignored.
+    use_cache: bool
+        whether to cache the headers read from each DICOM folder in a SQLite
+        database in output_dir. On the next import, folders whose files
+        have the same path, size, mtime and inode are not read again.
+    fast_read: bool
+        whether to read only the DICOM tags required to validate and compare
+        slices, instead of the whole header. Only the first valid slice in
+        each folder is read in full. The dataset is identical either way.
+    sampling_patience: int
+        if provided, the slices in each DICOM folder are sampled evenly
+        across the series, and reading stops once this many consecutive
+        slices show no new echo. By default, all slices are read. The slice
+        counts in the slice_signatures of each sequence then only cover the
+        slices that were read.
+    prefetch: int
+        number of DICOM files read ahead of the parser in a small pool of
+        threads. Overlaps waiting on slow disks or NFS with parsing. By
+        default, files are read one at a time.
+    prefetch_size: int
+        number of bytes prefetched from the beginning of each file.
+    fadvise: bool
+        whether to advise the kernel to read ahead the whole of each
+        prefetched file (posix_fadvise WILLNEED).
+    shard: Tuple[int, int]
+        index and number of shards e.g. (0, 8). Only the folders assigned
+        to this shard are imported, e.g. by one job of a cluster array.
+        Merge the shards with merge_shards.
+    shard_by: str
+        'folder' to assign each terminal folder to a shard, or 'subject'
+        to assign each top-level directory of the data source.
+    compact: bool
+        whether to store the runs in a compact form, with every ID interned
+        as an integer code. Uses several times less memory for datasets
+        with millions of runs.
+    lazy: bool
+        whether to keep only a lightweight handle for each run, i.e. the
+        folder, a representative file and a fingerprint of the folder. The
+        sequences are built again when accessed through get() or
+        traverse_*, so that memory stays bounded.
+    cache_size: int
+        maximum number of sequences built from handles kept in memory, in
+        lazy mode.
+    dedup: bool
+        whether to intern the parameters of the runs, so that equal
+        parameters are stored once and shared by all the runs. Saves memory
+        and disk space when many runs share the same protocol, and keeps
+        count of the distinct protocols of each sequence ID.
 
     Returns
     -------
@@ -71,6 +146,116 @@ def import_dataset(data_source: Union[str, Path, List],
     # else:
     #     logger = configure_logger(logger, output_dir=output_dir,
     #                               mode='w', level='ERROR')
+    dataset = _create_dataset(
+        data_source=data_source,
+        ds_format=ds_format,
+        verbose=verbose,
+        is_complete=is_complete,
+        name=name,
+        config_path=config_path,
+        output_dir=output_dir,
+        walk_threads=walk_threads,
+        n_jobs=n_jobs,
+        executor=executor,
+        use_cache=use_cache,
+        fast_read=fast_read,
+        sampling_patience=sampling_patience,
+        prefetch=prefetch,
+        prefetch_size=prefetch_size,
+        fadvise=fadvise,
+        shard=shard,
+        shard_by=shard_by,
+        compact=compact,
+        lazy=lazy,
+        cache_size=cache_size,
+        dedup=dedup,
+        **_kwargs
+    )
+    dataset.load()
+    # Print dataset summary
+    if verbose:
+        print(dataset)
+    return dataset
+
+
+def iter_import(data_source: Union[str, Path, List],
+                ds_format: str = 'dicom',
+                name: str = None,
+                config_path: Union[str, Path] = None,
+                output_dir: Union[str, Path] = None,
+                **options) -> Iterator[Tuple]:
+    """
+    Import a dataset one run at a time, instead of building the whole
+    dataset in memory. Each run is yielded as soon as its folder has been
+    read, so the runs can be written to disk straight away, e.g. with
+    MRdataset.sinks.JsonLinesSink. The runs are the same as those in the
+    dataset returned by import_dataset, with the same arguments.
+
+    Parameters
+    ----------
+    data_source : Union[str, Path, List]
+        path/to/my/dataset containing files e.g. .dcm
+    ds_format : str
+        Specify dataset type e.g. dicom, bids
+    name : str
+        Name/Identifier for your dataset, like ADNI. If not provided, a random
+        name is generated e.g. 54231
+    config_path: Union[str, Path]
+        path to config file which contains the rules for reading the dataset
+    output_dir: Union[str, Path]
+        path to the directory where the output files will be saved.
+    options : dict
+        other options of import_dataset e.g. walk_threads, n_jobs, use_cache
+
+    Yields
+    ------
+    tuple
+        subject_id, session_id, seq_id, run_id and the sequence
+
+    Notes
+    -----
+    The sequences are not kept once yielded, but the keys of the runs are,
+    so that a run split over several folders is yielded only once, as in
+    import_dataset. The memory used therefore still grows with the number
+    of runs, by one key (four short strings) per run, which is a small
+    fraction of the memory held by the runs in import_dataset.
+
+    Examples
+    --------
+    .. code :: python
+
+        from MRdataset import iter_import
+        from MRdataset.sinks import JsonLinesSink
+        with JsonLinesSink('/path/to/my/output/dataset.jsonl') as sink:
+            sink.write_all(iter_import('/path/to/my/data/'))
+    """
+    options.pop('verbose', None)
+    dataset = _create_dataset(data_source=data_source, ds_format=ds_format,
+                              name=name, config_path=config_path,
+                              output_dir=output_dir, **options)
+    # keys of the runs yielded so far, the only state kept across folders
+    seen = set()
+    for _, _, sequences in dataset._iter_folders():
+        for seq in sequences:
+            key = (seq.subject_id, seq.session_id, seq.name, seq.run_id)
+            # the same run may be split over several folders
+            if key in seen:
+                continue
+            seen.add(key)
+            yield (*key, seq)
+
+
+def _create_dataset(data_source: Union[str, Path, List],
+                    ds_format: str = 'dicom',
+                    name: str = None,
+                    config_path: Union[str, Path] = None,
+                    output_dir: Union[str, Path] = None,
+                    **options) -> 'BaseDataset':
+    """
+    Instantiate the dataset class for ds_format, with default output
+    directory, config file and name. Only the options supported by the
+    format are passed, see _format_options. The dataset is not loaded.
+    """
     if output_dir is None:
         # Use current working directory as output directory
         output_dir = Path.cwd()
@@ -90,24 +275,253 @@ def import_dataset(data_source: Union[str, Path, List],
 
     # Find dataset class using ds_format
     dataset_class = find_dataset_using_ds_format(ds_format.lower())
+    options = _format_options(ds_format.lower(), options)
 
     # Instantiate dataset class
     dataset = dataset_class(
         data_source=data_source,
-        verbose=verbose,
-        is_complete=is_complete,
         name=name,
         config_path=config_path,
         output_dir=output_dir,
-        **_kwargs
+        **options
     )
-    dataset.load()
-    # Print dataset summary
+    return dataset
+
+
+def _format_options(ds_format: str, options: dict) -> dict:
+    """
+    Drops the options that only apply to DICOM datasets, see
+    config.DICOM_ONLY_OPTIONS, if ds_format is not dicom. A single warning
+    is logged if any of them is set to a value other than its default.
+
+    Parameters
+    ----------
+    ds_format : str
+        format of the dataset e.g. 'bids'
+    options : dict
+        options passed to the dataset
+
+    Returns
+    -------
+    dict
+        the options supported by the format
+    """
+    if ds_format == 'dicom':
+        return options
+    defaults = inspect.signature(DicomDataset.__init__).parameters
+    ignored = [key for key in DICOM_ONLY_OPTIONS
+               if key in options and options[key] != defaults[key].default]
+    if ignored:
+        logger.warning(f'Options {", ".join(ignored)} only apply to DICOM '
+                       f'datasets. Ignoring them for {ds_format}.')
+    return {key: value for key, value in options.items()
+            if key not in DICOM_ONLY_OPTIONS}
+
+
+def update_dataset(existing: Union[str, Path, 'BaseDataset'],
+                   data_source: Union[str, Path, List] = None,
+                   verbose: bool = False,
+                   **options) -> 'BaseDataset':
+    """
+    Refresh a previously imported dataset incrementally. The folders in the
+    data source are compared against the manifest of folders stored in the
+    dataset. Only new or changed folders are read, and runs read from
+    folders that no longer exist are removed. See BaseDataset.update.
+
+    Parameters
+    ----------
+    existing : Union[str, Path, BaseDataset]
+        dataset to refresh, or path to a saved dataset with extension
+        .mrds.pkl
+    data_source : Union[str, Path, List]
+        path/to/my/dataset containing files e.g. .dcm. Default is the data
+        source the dataset was imported from.
+    verbose: bool
+        The flag allows you to change the verbosity of execution
+    options : dict
+        options to use for this refresh e.g. walk_threads, n_jobs,
+        executor. These override the options stored in the dataset. Only
+        the options that change how the files are read are accepted, see
+        config.UPDATE_OPTIONS.
+
+    Returns
+    -------
+    dataset : BaseDataset
+        the refreshed dataset
+
+    Raises
+    ------
+    ValueError
+        If an option would change which runs are read or how they are
+        stored e.g. shard or compact. Import the dataset again instead.
+
+    Examples
+    --------
+    .. code :: python
+
+        from MRdataset import update_dataset, save_mr_dataset
+        dataset = update_dataset('/path/to/my/dataset.mrds.pkl')
+        save_mr_dataset('/path/to/my/dataset.mrds.pkl', dataset)
+    """
+    for key in options:
+        if key not in UPDATE_OPTIONS:
+            raise ValueError(f'Option {key} cannot be changed in an update, '
+                             'it changes which runs are read or how they '
+                             'are stored. Import the dataset again instead.')
+
+    if isinstance(existing, BaseDataset):
+        dataset = existing
+    else:
+        dataset = load_mr_dataset(existing)
+
+    options = _format_options(dataset.format, options)
+    for key, value in options.items():
+        if hasattr(dataset, key):
+            setattr(dataset, key, value)
+        else:
+            logger.warning(f'Option {key} is not supported by '
+                           f'{type(dataset).__name__}. Ignoring it.')
+
+    summary = dataset.update(data_source)
     if verbose:
+        print(f"{len(summary['new'])} new, {len(summary['changed'])} changed "
+              f"and {len(summary['removed'])} removed folders")
         print(dataset)
     return dataset
 
 
+def merge_datasets(datasets: List[Union[str, Path, 'BaseDataset']]
+                   ) -> Tuple['BaseDataset', List[Tuple]]:
+    """
+    Merges many datasets e.g. partial datasets imported separately. The
+    indices of the datasets are united directly, see BaseDataset.merge, so
+    the merge is linear in the total number of runs. The datasets are
+    merged one at a time in this process, as shipping them to worker
+    processes costs more than the merge itself. If the same run is present
+    in several datasets, the sequence from the first of them is kept.
+
+    The merged dataset is not sharded, and is complete only if all the
+    datasets are complete and not sharded. See merge_shards to merge all
+    the shards of a dataset.
+
+    Parameters
+    ----------
+    datasets : List[Union[str, Path, BaseDataset]]
+        datasets, or paths to saved datasets with extension .mrds.pkl. The
+        datasets are not modified, and saved datasets are loaded one at a
+        time.
+
+    Returns
+    -------
+    dataset : BaseDataset
+        the merged dataset
+    conflicts : List[Tuple]
+        keys (subject_id, session_id, seq_id, run_id) of the runs that hold
+        differing sequences in different datasets
+
+    Examples
+    --------
+    .. code :: python
+
+        from MRdataset import merge_datasets, save_mr_dataset
+        dataset, conflicts = merge_datasets(['a.mrds.pkl', 'b.mrds.pkl'])
+        save_mr_dataset('/path/to/my/output/merged.mrds.pkl', dataset)
+    """
+    items = list(datasets)
+    if not items:
+        raise ValueError('Expected at least one dataset to merge. Got none')
+
+    conflicts = list()
+    dataset = None
+    is_complete = True
+    for item in items:
+        item = _as_dataset(item)
+        if dataset is None:
+            dataset = item._empty_copy()
+            dataset.merge(item)
+        else:
+            conflicts.extend(dataset.merge(item))
+        is_complete = (is_complete and getattr(item, 'is_complete', True)
+                       and getattr(item, 'shard', None) is None)
+    dataset.shard = None
+    dataset.is_complete = is_complete
+    return dataset, conflicts
+
+
+def _as_dataset(dataset: Union[str, Path, 'BaseDataset']) -> 'BaseDataset':
+    """Loads a saved dataset, unless it is a dataset already"""
+    if isinstance(dataset, BaseDataset):
+        return dataset
+    return load_mr_dataset(dataset)
+
+
+def merge_shards(shards: List[Union[str, Path, 'BaseDataset']],
+                 allow_partial: bool = False) -> 'BaseDataset':
+    """
+    Merges the shards of a dataset, imported separately with the shard
+    option of import_dataset e.g. by the jobs of a cluster array. The merged
+    dataset is marked complete only if all the shards are present.
+
+    Parameters
+    ----------
+    shards : List[Union[str, Path, BaseDataset]]
+        sharded datasets, or paths to saved datasets with extension
+        .mrds.pkl
+    allow_partial : bool
+        whether to merge the shards even if some are missing. The merged
+        dataset is then not complete.
+
+    Returns
+    -------
+    dataset : BaseDataset
+        the merged dataset
+
+    Raises
+    ------
+    ValueError
+        If a dataset is not sharded, the shards disagree on the number of
+        shards, a shard is repeated, or shards are missing and allow_partial
+        is False
+
+    Examples
+    --------
+    .. code :: python
+
+        from MRdataset import merge_shards, save_mr_dataset
+        dataset = merge_shards(glob('/path/to/my/output/*.mrds.pkl'))
+        save_mr_dataset('/path/to/my/output/dataset.mrds.pkl', dataset)
+    """
+    datasets = dict()
+    total = None
+    for shard in shards:
+        shard = _as_dataset(shard)
+        if getattr(shard, 'shard', None) is None:
+            raise ValueError(f'Expected a sharded dataset. Got {shard.name}')
+        index, count = shard.shard
+        if total is None:
+            total = count
+        elif count != total:
+            raise ValueError(f'Expected {total} shards, but {shard.name} is '
+                             f'shard {index} of {count}')
+        if index in datasets:
+            raise ValueError(f'Shard {index} of {total} is repeated')
+        datasets[index] = shard
+    if not datasets:
+        raise ValueError('Expected at least one shard. Got none')
+
+    missing = sorted(set(range(total)) - set(datasets))
+    if missing and not allow_partial:
+        raise ValueError(f'Missing shards {missing} of {total}')
+    if missing:
+        logger.warning(f'Missing shards {missing} of {total}. The merged '
+                       f'dataset is not complete.')
+
+    dataset, _ = merge_datasets([datasets[index]
+                                 for index in sorted(datasets)])
+    dataset.is_complete = not missing
+    return dataset
+
+
 def find_dataset_using_ds_format(dataset_ds_format: str):
     """
     Find dataset class using ds_format. This function is used by
@@ -0,0 +1,353 @@
+"""
+Compact storage of the runs of a dataset. Every identifier, i.e. subject,
+session, sequence and run ID, is interned once in a table of integer codes,
+and the runs are stored as rows of integer arrays instead of nested dicts
+of strings. Read-only views present the storage with the same interface as
+the dicts of BaseDataset (_flat_map, _tree_map, etc.), keyed by strings.
+"""
+from array import array
+from collections.abc import Mapping, Set
+from types import MappingProxyType
+from typing import Iterator, Optional, Tuple
+
+
+class CodeTable:
+    """
+    Interns strings as consecutive integer codes. Each string is stored
+    once, however many runs refer to it.
+    """
+
+    def __init__(self):
+        self._codes = dict()
+        self._names = list()
+
+    def encode(self, name: str) -> int:
+        """Returns the code for a string, assigning a new code if needed"""
+        code = self._codes.get(name, None)
+        if code is None:
+            code = self._codes[name] = len(self._names)
+            self._names.append(name)
+        return code
+
+    def lookup(self, name: str) -> Optional[int]:
+        """Returns the code for a string, or None if it was never seen"""
+        return self._codes.get(name, None)
+
+    def decode(self, code: int) -> str:
+        """Returns the string for a code"""
+        return self._names[code]
+
+    def __len__(self):
+        return len(self._names)
+
+    def __getstate__(self):
+        # the dict is rebuilt from the list of names
+        return self._names
+
+    def __setstate__(self, names):
+        self._names = names
+        self._codes = {name: code for code, name in enumerate(names)}
+
+
+class CompactIndex:
+    """
+    Stores the runs of a dataset as rows of integer codes. Each row holds
+    the codes of the subject, session, sequence and run IDs, and the
+    sequence itself. The rows are grouped by sequence ID and by session. A
+    run is found by scanning the rows of its session, which are few, so
+    that there is no need for a dict with an entry for every run.
+
+    Removed rows are left empty, and are not reused. The version is
+    incremented whenever a run is added or removed, so that the views can
+    cache what they derive from the rows.
+    """
+
+    def __init__(self):
+        self.codes = CodeTable()
+        # codes of subject, session, sequence and run IDs, one per row
+        self._subjects = array('I')
+        self._sessions = array('I')
+        self._seq_ids = array('I')
+        self._run_ids = array('I')
+        # row -> sequence, None if the row was removed
+        self._seqs = list()
+        # number of rows that were not removed
+        self._count = 0
+        # sequence code -> rows of that sequence
+        self._seq_rows = dict()
+        # subject code -> session code -> rows of that session
+        self._session_rows = dict()
+        # incremented whenever a run is added or removed
+        self.version = 0
+
+    def __len__(self):
+        return self._count
+
+    def _scan(self, codes) -> Optional[int]:
+        """Returns the row with the given codes, or None"""
+        sessions = self._session_rows.get(codes[0], {})
+        for row in sessions.get(codes[1], ()):
+            if (self._seq_ids[row] == codes[2]
+                    and self._run_ids[row] == codes[3]):
+                return row
+        return None
+
+    def _find(self, subject_id, session_id, seq_id, run_id) -> Optional[int]:
+        """Returns the row of a run, or None if it does not exist"""
+        codes = [self.codes.lookup(i)
+                 for i in (subject_id, session_id, seq_id, run_id)]
+        if None in codes:
+            return None
+        return self._scan(codes)
+
+    def add(self, subject_id, session_id, seq_id, run_id, seq) -> bool:
+        """Adds a run, unless it exists already. Returns whether added"""
+        codes = [self.codes.encode(i)
+                 for i in (subject_id, session_id, seq_id, run_id)]
+        if self._scan(codes) is not None:
+            return False
+        row = len(self._seqs)
+        self._count += 1
+        self._subjects.append(codes[0])
+        self._sessions.append(codes[1])
+        self._seq_ids.append(codes[2])
+        self._run_ids.append(codes[3])
+        self._seqs.append(seq)
+        self._seq_rows.setdefault(codes[2], array('I')).append(row)
+        sessions = self._session_rows.setdefault(codes[0], dict())
+        sessions.setdefault(codes[1], array('I')).append(row)
+        self.version += 1
+        return True
+
+    def get(self, subject_id, session_id, seq_id, run_id, default=None):
+        """Returns the sequence of a run, or default"""
+        row = self._find(subject_id, session_id, seq_id, run_id)
+        return default if row is None else self._seqs[row]
+
+    def remove(self, subject_id, session_id, seq_id, run_id):
+        """Removes a run, returns its sequence or None if it did not exist"""
+        row = self._find(subject_id, session_id, seq_id, run_id)
+        if row is None:
+            return None
+        codes = self._row_codes(row)
+        self._count -= 1
+        sessions = self._session_rows[codes[0]]
+        for rows, key in ((self._seq_rows, codes[2]), (sessions, codes[1])):
+            rows[key].remove(row)
+            if not rows[key]:
+                del rows[key]
+        if not sessions:
+            del self._session_rows[codes[0]]
+        seq, self._seqs[row] = self._seqs[row], None
+        self.version += 1
+        return seq
+
+    def replace(self, subject_id, session_id, seq_id, run_id, seq):
+        """Replaces the sequence of a run, returns the previous sequence or
+        None if the run does not exist"""
+        row = self._find(subject_id, session_id, seq_id, run_id)
+        if row is None:
+            return None
+        previous, self._seqs[row] = self._seqs[row], seq
+        return previous
+
+    def _row_codes(self, row) -> Tuple[int, int, int, int]:
+        """Returns the codes of the IDs of a row"""
+        return (self._subjects[row], self._sessions[row],
+                self._seq_ids[row], self._run_ids[row])
+
+    def _row_key(self, row) -> Tuple[str, str, str, str]:
+        """Returns the IDs of a row, as strings"""
+        decode = self.codes.decode
+        return tuple(decode(code) for code in self._row_codes(row))
+
+    def items(self) -> Iterator[Tuple[Tuple[str, str, str, str], object]]:
+        """Yields the IDs (subject, session, sequence, run) and sequence of
+        every run, in the order they were added"""
+        for row, seq in enumerate(self._seqs):
+            if seq is not None:
+                yield self._row_key(row), seq
+
+    def sequence_rows(self, seq_id) -> Iterator[Tuple[str, str, str, object]]:
+        """Yields subject, session and run IDs and the sequence of every run
+        of a sequence ID"""
+        code = self.codes.lookup(seq_id)
+        decode = self.codes.decode
+        for row in self._seq_rows.get(code, ()):
+            yield (decode(self._subjects[row]), decode(self._sessions[row]),
+                   decode(self._run_ids[row]), self._seqs[row])
+
+    def sequence_count(self, seq_id) -> int:
+        """Returns the number of runs of a sequence ID"""
+        return len(self._seq_rows.get(self.codes.lookup(seq_id), ()))
+
+    def session_tree(self, subject_id, session_id) -> dict:
+        """Returns {seq_id: {run_id: sequence}} for a session"""
+        tree = dict()
+        sessions = self._session_rows.get(self.codes.lookup(subject_id), {})
+        decode = self.codes.decode
+        for row in sessions.get(self.codes.lookup(session_id), ()):
+            runs = tree.setdefault(decode(self._seq_ids[row]), dict())
+            runs[decode(self._run_ids[row])] = self._seqs[row]
+        return tree
+
+    def sessions(self, subject_id=None) -> Iterator[Tuple[str, str]]:
+        """Yields the subject and session IDs of every session, or of the
+        sessions of a subject"""
+        decode = self.codes.decode
+        if subject_id is None:
+            subjects = self._session_rows.items()
+        else:
+            code = self.codes.lookup(subject_id)
+            subjects = [(code, self._session_rows.get(code, {}))]
+        for subject, sessions in subjects:
+            for session in sessions:
+                yield decode(subject), decode(session)
+
+    def has_id(self, value, level: str) -> bool:
+        """Checks if a subject (level 'subject') or sequence ID exists"""
+        rows = self._session_rows if level == 'subject' else self._seq_rows
+        return self.codes.lookup(value) in rows
+
+    def subject_ids(self) -> Iterator[str]:
+        """Yields every subject ID"""
+        decode = self.codes.decode
+        return (decode(code) for code in self._session_rows)
+
+    def sequence_ids(self) -> Iterator[str]:
+        """Yields every sequence ID"""
+        decode = self.codes.decode
+        return (decode(code) for code in self._seq_rows)
+
+
+class FlatView(Mapping):
+    """Read-only view of a CompactIndex, in the form of
+    BaseDataset._flat_map i.e. {(subject, session, seq, run): sequence}"""
+
+    def __init__(self, index: CompactIndex):
+        self._index = index
+
+    def __getitem__(self, key):
+        seq = self._index.get(*key)
+        if seq is None:
+            raise KeyError(key)
+        return seq
+
+    def __contains__(self, key):
+        return self._index.get(*key) is not None
+
+    def __iter__(self):
+        return (key for key, _ in self._index.items())
+
+    def __len__(self):
+        return len(self._index)
+
+    def items(self):
+        return self._index.items()
+
+
+class TreeView(Mapping):
+    """Read-only view of a CompactIndex, in the form of
+    BaseDataset._tree_map i.e. {subject: {session: {seq: {run: sequence}}}}.
+    The branch of a subject is built when it is accessed, and is read-only
+    at every level, as changes to it would not reach the index."""
+
+    def __init__(self, index: CompactIndex):
+        self._index = index
+
+    def __getitem__(self, subject_id):
+        if not self._index.has_id(subject_id, 'subject'):
+            raise KeyError(subject_id)
+        branch = dict()
+        for _, session_id in self._index.sessions(subject_id):
+            tree = self._index.session_tree(subject_id, session_id)
+            branch[session_id] = MappingProxyType(
+                {seq_id: MappingProxyType(runs)
+                 for seq_id, runs in tree.items()})
+        return MappingProxyType(branch)
+
+    def __iter__(self):
+        return self._index.subject_ids()
+
+    def __len__(self):
+        return len(self._index._session_rows)
+
+
+class SequenceRunsView(Mapping):
+    """Read-only view of a CompactIndex, in the form of
+    BaseDataset._seqs_map i.e. {seq: {(subject, session, run)}}"""
+
+    def __init__(self, index: CompactIndex):
+        self._index = index
+
+    def __getitem__(self, seq_id):
+        runs = {(subject_id, session_id, run_id)
+                for subject_id, session_id, run_id, _ in
+                self._index.sequence_rows(seq_id)}
+        if not runs:
+            raise KeyError(seq_id)
+        return runs
+
+    def __iter__(self):
+        return self._index.sequence_ids()
+
+    def __len__(self):
+        return len(self._index._seq_rows)
+
+
+class SessionSequencesView(Mapping):
+    """Read-only view of a CompactIndex, in the form of
+    BaseDataset._sess_map i.e. {session: {seq}}. The map is derived from
+    all the rows, and is cached until a run is added or removed."""
+
+    def __init__(self, index: CompactIndex):
+        self._index = index
+        self._cache = None
+        self._version = None
+
+    def _sessions(self):
+        if self._version == self._index.version:
+            return self._cache
+        index = self._index
+        sessions = dict()
+        for session_rows in index._session_rows.values():
+            for session, rows in session_rows.items():
+                sessions.setdefault(session, set()).update(
+                    index._seq_ids[row] for row in rows)
+        decode = index.codes.decode
+        self._cache = {decode(session): frozenset(decode(code)
+                                                  for code in codes)
+                       for session, codes in sessions.items()}
+        self._version = index.version
+        return self._cache
+
+    def __getitem__(self, session_id):
+        return self._sessions()[session_id]
+
+    def __iter__(self):
+        return iter(self._sessions())
+
+    def __len__(self):
+        return len(self._sessions())
+
+
+class IdSetView(Set):
+    """Read-only view of the subject IDs or the sequence IDs of a
+    CompactIndex, in the form of BaseDataset._subj_ids and _seq_ids"""
+
+    def __init__(self, index: CompactIndex, level: str):
+        self._index = index
+        self._level = level
+
+    def __contains__(self, value):
+        return self._index.has_id(value, self._level)
+
+    def __iter__(self):
+        if self._level == 'subject':
+            return self._index.subject_ids()
+        return self._index.sequence_ids()
+
+    def __len__(self):
+        if self._level == 'subject':
+            return len(self._index._session_rows)
+        return len(self._index._seq_rows)
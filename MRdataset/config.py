@@ -32,6 +32,108 @@ VALID_BIDS_DATATYPES = [
 
 SUPPORTED_BIDS_DATATYPES = ['func', 'anat', 'dwi', 'fmap']
 
+#: DICOM tags read from each slice in fast-read mode. These are all the tags
+#: required to validate a slice (is_valid_inclusion), compare its session
+#: info and the parameters that vary across slices e.g. EchoTime. Only the
+#: reference slice of a folder is read in full.
+FAST_READ_TAGS = [
+    # dicom2nifti checks for a valid imaging dicom
+    'SeriesInstanceUID',
+    'InstanceNumber',
+    'ImageOrientationPatient',
+    'ImagePositionPatient',
+    'SharedFunctionalGroupsSequence',
+    'PerFrameFunctionalGroupsSequence',
+    # localizer, phantom, sbref, moco and derived series
+    'SeriesDescription',
+    'ImageType',
+    'PatientID',
+    'PatientSex',
+    'PatientAge',
+    # session info
+    'SequenceName',
+    'ProtocolName',
+    'SeriesNumber',
+    'StudyInstanceUID',
+    'ContentDate',
+    # parameters that may vary across slices
+    'EchoTime',
+    'EchoNumbers',
+]
+
+#: Parameters that may vary across the slices of a single series, e.g. the
+#: echoes of a multi-echo sequence. Slices are grouped by these parameters.
+VARIABLE_PARAMETERS = ['EchoTime', 'EchoNumber']
+
+#: DICOM tags that identify a series, to look up its inclusion decision
+SERIES_KEY_TAGS = ['SeriesInstanceUID', 'ImageType']
+
+#: DICOM tags read from the slices of a series after its first slice, in
+#: fast-read mode. These are the series key, the session info, the variable
+#: parameters and the tags checked for a valid imaging slice. See
+#: scanner.scan_header and dicom_utils.is_valid_imaging_slice
+SCAN_TAGS = [
+    'ImageType',
+    'PatientID',
+    'EchoTime',
+    'EchoNumbers',
+    'StudyInstanceUID',
+    'SeriesInstanceUID',
+    'InstanceNumber',
+    'ImagePositionPatient',
+    'ImageOrientationPatient',
+]
+
+#: Options that only change how the files of a dataset are read, not which
+#: runs are read or how they are stored. These may be changed when a saved
+#: dataset is refreshed, see common.update_dataset
+UPDATE_OPTIONS = [
+    'walk_threads',
+    'n_jobs',
+    'executor',
+    'use_cache',
+    'fast_read',
+    'sampling_patience',
+    'prefetch',
+    'prefetch_size',
+    'fadvise',
+]
+
+#: Options of import_dataset that only apply to DICOM datasets. These are
+#: not passed to the datasets of other formats, see common._create_dataset
+DICOM_ONLY_OPTIONS = [
+    'n_jobs',
+    'executor',
+    'use_cache',
+    'fast_read',
+    'sampling_patience',
+    'prefetch',
+    'prefetch_size',
+    'fadvise',
+]
+
+#: Number of bytes read from each slice by the header scanner. If the tags
+#: are not within these bytes, the slice is read with pydicom.
+SCAN_BUFFER_SIZE = 32 * 1024
+
+#: Values larger than this are not loaded in fast-read mode, until accessed
+FAST_READ_DEFER_SIZE = '1 KB'
+
+#: Parameters that vary from run to run even when the protocol is the same
+#: e.g. the position of the slices, or the shim. These are not part of the
+#: protocol of a run, see flyweight.ParameterPool. The demographics of the
+#: subject are left out as well.
+RUN_SPECIFIC_PARAMETERS = [
+    'ImagePositionPatient',
+    'SliceLocation',
+    'ShimSetting',
+    'SAR',
+    'WindowCenter',
+    'WindowWidth',
+    'SmallestImagePixelValue',
+    'LargestImagePixelValue',
+]
+
 
 class MRException(Exception):
     """
@@ -119,3 +221,17 @@ def previous_log_fpath(folder, name):
     Return the path to the previous run log file
     """
     return Path(folder) / f'{name}_previous_run_log.json'
+
+
+def rejected_log_fpath(folder, name):
+    """
+    Return the path to the log of folders rejected in the previous run
+    """
+    return Path(folder) / f'{name}_rejected_folders.json'
+
+
+def header_cache_fpath(folder, name):
+    """
+    Return the path to the on-disk cache of dicom headers
+    """
+    return Path(folder) / f'{name}_header_cache.sqlite'
@@ -1,5 +1,11 @@
 import json
+import os
+import struct
+import warnings
 from abc import ABC
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
 from itertools import islice
 from pathlib import Path
 from typing import Tuple, List
@@ -10,10 +16,22 @@ from pydicom.errors import InvalidDicomError
 
 from MRdataset import logger
 from MRdataset.base import BaseDataset
-from MRdataset.config import previous_log_fpath
-from MRdataset.dicom_utils import (is_valid_inclusion,
-                                   is_dicom_file)
-from MRdataset.utils import (folders_with_min_files, read_json, valid_dirs)
+from MRdataset.cache import HeaderCache
+from MRdataset.config import (previous_log_fpath, rejected_log_fpath,
+                              header_cache_fpath, FAST_READ_TAGS,
+                              FAST_READ_DEFER_SIZE, SCAN_TAGS,
+                              SCAN_BUFFER_SIZE, SERIES_KEY_TAGS)
+from MRdataset.scanner import scan_header, scan_buffer, ScannedHeader
+from MRdataset.lazy import SequenceHandle, file_stat
+from MRdataset.dicom_utils import (is_dicom_file, get_exclusion_reason,
+                                   get_series_key, raise_warning,
+                                   get_session_info, get_variable_params,
+                                   slice_signature, get_study_date,
+                                   is_valid_imaging_slice, EXCLUSION_FLAGS)
+from MRdataset.utils import (read_json, valid_dirs, folder_fingerprint,
+                             folder_signature, stratified_order,
+                             prefetch_files, parse_date, is_excluded_subject,
+                             check_n_jobs)
 
 
 # A dataset is a collection of subjects
@@ -50,6 +68,72 @@ class DicomDataset(BaseDataset, ABC):
         Whether to print verbose output on console. Default is False.
     ds_format : str
         The format of the dataset. Default is 'dicom'. Choose one of ['dicom']
+    walk_threads : int
+        Number of threads used to discover folders in the data source.
+        Default is 1. Use more threads on network/parallel filesystems.
+    n_jobs : int
+        Number of worker processes used to read the dicom folders. Default
+        is 1, i.e. folders are read in this process. Use -1 for all cores.
+    executor : concurrent.futures.Executor
+        A user-supplied executor to read the dicom folders with. If
+        provided, n_jobs is ignored.
+    use_cache : bool
+        Whether to cache the sequence read from each folder in a SQLite
+        database in output_dir. Folders whose files are unchanged since the
+        last import are not read again. Default is False.
+    fast_read : bool
+        Whether to read only the tags required to compare the slices in a
+        folder. Explicit VR little endian headers are scanned directly from
+        a single buffer per file (see scanner.py), others are read with
+        pydicom, see config.FAST_READ_TAGS. The header of the first slice of
+        each series, which is validated and becomes the sequence, is always
+        read in full. Default is False.
+    prefetch : int
+        Number of files read ahead of the parser by a small pool of
+        threads, within each folder. Default is 0, i.e. files are read one
+        at a time. Useful on spinning disks and network filesystems.
+    prefetch_size : int
+        Number of bytes prefetched from the beginning of each file. In
+        fast-read mode, the header is scanned from these bytes directly.
+        Default is config.SCAN_BUFFER_SIZE.
+    fadvise : bool
+        Whether the prefetching threads advise the kernel that the whole
+        file will be needed (posix_fadvise WILLNEED). Default is False.
+    sampling_patience : int
+        If provided, the slices in a folder are read in stratified order
+        (see utils.stratified_order), and reading stops once this many
+        consecutive slices have not shown a new combination of the variable
+        parameters e.g. EchoTime. Default is None, i.e. all the slices are
+        read. With sampling, the slice counts in the slice_signatures of
+        each sequence only cover the slices that were read.
+    shard : tuple
+        Index and number of shards e.g. (0, 8). Only the folders assigned to
+        this shard are read, see BaseDataset. Default is None.
+    shard_by : str
+        Whether folders are assigned to shards one 'folder' at a time, or
+        by 'subject' i.e. top-level directory. Default is 'folder'.
+    compact : bool
+        Whether to store the runs in compact form, see BaseDataset. Default
+        is False.
+    lazy : bool
+        Whether to store a handle for each run instead of the sequence, see
+        BaseDataset. The sequence is built again from the header of the
+        reference slice of the series when it is accessed. Default is False.
+    cache_size : int
+        Maximum number of sequences built from handles kept in memory, in
+        lazy mode. Default is 128.
+    dedup : bool
+        Whether to intern the parameters of the runs, so that equal
+        parameters are shared by all the runs, see BaseDataset. Default is
+        False.
+
+    The exclude_subjects, begin and end options in the config are checked
+    against the PatientID and StudyDate of the first slice of each series.
+    If the subject is excluded, or the study is outside the dates, the
+    other slices of the series are skipped without parsing their header in
+    full, in fast-read mode or not, see _read_slice.
+    These options are part of the signature of each folder, so the folders
+    are read again by update() if they change.
     """
 
     def __init__(self,
@@ -60,16 +144,48 @@ class DicomDataset(BaseDataset, ABC):
                  verbose=False,
                  output_dir=None,
                  min_count=1,
+                 walk_threads=1,
+                 n_jobs=1,
+                 executor=None,
+                 use_cache=False,
+                 fast_read=False,
+                 sampling_patience=None,
+                 prefetch=0,
+                 prefetch_size=SCAN_BUFFER_SIZE,
+                 fadvise=False,
+                 shard=None,
+                 shard_by='folder',
+                 compact=False,
+                 lazy=False,
+                 cache_size=128,
+                 dedup=False,
                  **kwargs):
         """constructor"""
 
         super().__init__(data_source=data_source, name=name,
-                         ds_format='dicom')
+                         ds_format='dicom', shard=shard, shard_by=shard_by,
+                         compact=compact, lazy=lazy, cache_size=cache_size,
+                         dedup=dedup)
         self.data_source = valid_dirs(data_source)
         self.pattern = pattern
         # TODO: Add option to change min_count passing it as an argument
         self.min_count = min_count  # min slice count to be considered a volume
         self.verbose = verbose
+        self.walk_threads = walk_threads
+        check_n_jobs(n_jobs)
+        self.n_jobs = n_jobs
+        self.executor = executor
+        self.fast_read = fast_read
+        if sampling_patience is not None and sampling_patience < 1:
+            raise ValueError('Expected sampling_patience to be a positive '
+                             f'integer. Got {sampling_patience}')
+        self.sampling_patience = sampling_patience
+        if prefetch < 0 or prefetch_size < 1:
+            raise ValueError('Expected non-negative prefetch and positive '
+                             f'prefetch_size. Got {prefetch}, {prefetch_size}')
+        self.prefetch = prefetch
+        self.prefetch_size = prefetch_size
+        self.fadvise = fadvise
         self.config_path = config_path
         self.config_dict = None
 
@@ -91,6 +207,12 @@ class DicomDataset(BaseDataset, ABC):
         self.include_sbref = self.includes.get('sbref', False)
         self.include_derived = self.includes.get('derived', False)
 
+        # These are used to skip subjects and studies outside the dates
+        self.exclude_subjects = {str(subject) for subject in
+                                 self.config_dict.get('exclude_subjects', [])}
+        self.begin = parse_date(self.config_dict.get('begin', None))
+        self.end = parse_date(self.config_dict.get('end', None))
+
         # variables specific to this class
         self._key_vars.update(['pattern', 'min_count', 'include_phantoms'])
 
@@ -109,15 +231,58 @@ class DicomDataset(BaseDataset, ABC):
             self._process_whole_folder = read_json(self._previous_log_path)
         else:
             self._process_whole_folder = dict()
+        # reasons to skip the folders whose series were all rejected in the
+        #   previous run, see _set_rejected_status
+        rejected_path = rejected_log_fpath(self.output_dir, self.name)
+        if rejected_path.exists():
+            self._rejected_folders = read_json(rejected_path)
+        else:
+            self._rejected_folders = dict()
+        self._migrate_process_log()
+
+        self.use_cache = use_cache
+        self._cache = None
+        self._cache_salt = None
 
         # print('')
 
+    def __getstate__(self):
+        """A user-supplied executor cannot be pickled, it is not retained"""
+        state = super().__getstate__()
+        state['executor'] = None
+        return state
+
+    def __setstate__(self, state):
+        """Datasets saved before the rejected folders were logged
+        separately are migrated, see _migrate_process_log"""
+        super().__setstate__(state)
+        if '_rejected_folders' not in state:
+            self._rejected_folders = dict()
+        if 'use_cache' not in state:
+            self.use_cache = self._cache is not None
+        self._migrate_process_log()
+
+    def _migrate_process_log(self):
+        """
+        Moves the reasons to skip a folder out of the previous-run log. They
+        used to be stored in place of the bool status of the folder, and are
+        now kept in _rejected_folders, so that the previous-run log only
+        holds bools as before.
+        """
+        for folder, status in list(self._process_whole_folder.items()):
+            if isinstance(status, list):
+                self._rejected_folders.setdefault(folder, status)
+                del self._process_whole_folder[folder]
+
     def merge(self, other):
-        """Merges two dicom datasets"""
-        self._merge(other)
+        """Merges two dicom datasets, see BaseDataset._merge"""
+        conflicts = self._merge(other)
         self._process_whole_folder = {
             **self._process_whole_folder, **other._process_whole_folder}
+        self._rejected_folders = {
+            **self._rejected_folders, **other._rejected_folders}
         # self.save_process_log()
+        return conflicts
 
     def load(self):
         """
@@ -132,26 +297,162 @@ class DicomDataset(BaseDataset, ABC):
         #     self._reload_saved()
         #     return
 
-        for directory in self.data_source:
-            # find all the sub-folders with at least min_count files
-            sub_folders = folders_with_min_files(directory, self.pattern,
-                                                 self.min_count)
-            for folder in sub_folders:
-                # process each folder
-                seq = self._process_slice_collection(folder)
-                if seq is None:
-                    self._process_whole_folder[str(folder)] = False
-                    logger.info(f'Unable to process {folder}. Skipping it.')
-                else:
-                    self.add(subject_id=seq.subject_id,
-                             session_id=seq.session_id,
-                             run_id=seq.run_id, seq_id=seq.name, seq=seq)
+        # process each folder, possibly in parallel
+        for folder, signature, sequences in self._iter_folders():
+            self._add_folder(folder, signature, sequences)
 
         # saving a copy for quicker reload
         # self.save()
         # dump the log to json file
         # self.save_process_log()
 
+    def _open_cache(self):
+        """Opens the header cache if use_cache is set, see _read_folder.
+        The options are read each time, as update_dataset may change them"""
+        if not self.use_cache:
+            self._cache = None
+            return
+        if self._cache is None:
+            self._cache = HeaderCache(header_cache_fpath(self.output_dir,
+                                                         self.name))
+        # options that change the sequences read from a folder, a change
+        #   in any of them invalidates the cached sequences
+        self._cache_salt = json.dumps([self.include_phantom,
+                                       self.include_moco,
+                                       self.include_sbref,
+                                       self.include_derived,
+                                       self.use_echo_numbers,
+                                       self.sampling_patience,
+                                       sorted(self.exclude_subjects),
+                                       str(self.begin), str(self.end)])
+
+    def _read_folders(self, sub_folders):
+        """
+        Reads the sequences from each folder, see _process_folders. The
+        header cache is opened before reading the folders, and closed once
+        all of them are read.
+
+        Parameters
+        ----------
+        sub_folders : Iterable[Tuple[Path, List[Path]]]
+            Folders and the dicom files found in each folder
+
+        Yields
+        ------
+        tuple
+            folder, its signature and the list of sequences read from it
+        """
+        self._open_cache()
+        try:
+            for folder, signature, sequences in self._process_folders(
+                    sub_folders):
+                if not sequences:
+                    logger.info(f'Unable to process {folder}. Skipping it.')
+                yield folder, signature, sequences
+        finally:
+            if self._cache is not None:
+                self._cache.close()
+
+    def _folder_signature(self, folder, files):
+        """See BaseDataset._folder_signature. The signature also depends on
+        the exclude_subjects, begin and end options, if any is set, as
+        these decide which series are read from the folder."""
+        salt = ''
+        if self.exclude_subjects or self.begin or self.end:
+            salt = json.dumps([sorted(self.exclude_subjects),
+                               str(self.begin), str(self.end)])
+        return folder_signature(folder, files, salt=salt)
+
+    def _forget_folder(self, folder):
+        """Removes the runs read from a folder, and its previous-run status"""
+        super()._forget_folder(folder)
+        self._restore_folder_status(folder, (None, None))
+
+    def _folder_status(self, folder):
+        """
+        Returns the previous-run status of a folder, i.e. whether all its
+        files must be read (see _set_folder_status), and the reasons it was
+        rejected (see _set_rejected_status). Either is None if not known.
+        """
+        return (self._process_whole_folder.get(str(folder), None),
+                self._rejected_folders.get(str(folder), None))
+
+    def _restore_folder_status(self, folder, status):
+        """Sets the previous-run status of a folder, see _folder_status"""
+        for log, value in zip((self._process_whole_folder,
+                               self._rejected_folders), status):
+            if value is None:
+                log.pop(str(folder), None)
+            else:
+                log[str(folder)] = value
+
+    def _process_folders(self, sub_folders):
+        """
+        Processes each folder to find the dicom slices. If more than one job
+        (or a user-supplied executor) is requested, the folders are spread
+        across a pool of workers. Folders are submitted as the results are
+        consumed, with at most twice as many folders in flight as workers
+        (or cores, for a user-supplied executor), so that the folders are
+        still streamed from the walk. In either case, the results are
+        yielded in the same order as the input folders.
+
+        Parameters
+        ----------
+        sub_folders : Iterable[Tuple[Path, List[Path]]]
+            Folders and the dicom files found in each folder
+
+        Yields
+        ------
+        tuple
+            folder, its signature and the list of
+            protocol.DicomImagingSequence read from it
+        """
+        if self.executor is None and self.n_jobs == 1:
+            for folder, files in sub_folders:
+                signature = self._folder_signature(folder, files)
+                yield (folder, signature,
+                       self._process_slice_collection(folder, files))
+            return
+
+        executor = self.executor
+        if executor is None:
+            n_jobs = check_n_jobs(self.n_jobs)
+            executor = ProcessPoolExecutor(max_workers=n_jobs)
+        else:
+            n_jobs = os.cpu_count()
+
+        # workers only need the configuration, not the sequences loaded
+        #   so far. Similarly, only the status of the folder being read is
+        #   shipped, instead of the log for the whole dataset.
+        reader = self._empty_copy()
+        reader.executor = None
+        reader.n_jobs = 1
+        reader._process_whole_folder = dict()
+        reader._rejected_folders = dict()
+        jobs = ((reader, folder, files, self._folder_status(folder))
+                for folder, files in sub_folders)
+        in_flight = deque()
+        try:
+            for job in jobs:
+                in_flight.append(executor.submit(_process_folder_job, job))
+                if len(in_flight) >= 2 * n_jobs:
+                    yield self._folder_result(in_flight.popleft())
+            while in_flight:
+                yield self._folder_result(in_flight.popleft())
+        finally:
+            # folders not started yet, if the consumer stopped early
+            for future in in_flight:
+                future.cancel()
+            if self.executor is None:
+                executor.shutdown()
+
+    def _folder_result(self, future):
+        """Returns the folder, signature and sequences read by a worker, and
+        records the status of the folder in the previous-run log"""
+        folder, signature, sequences, status = future.result()
+        self._restore_folder_status(folder, status)
+        return folder, signature, sequences
+
     def save_process_log(self, output_dir=None):
         """
         Saves the log file to the output directory. This log file contains
@@ -171,24 +472,39 @@ class DicomDataset(BaseDataset, ABC):
         try:
             with open(log_path, 'w') as f:
                 json.dump(self._process_whole_folder, f, indent=4)
+            with open(rejected_log_fpath(output_dir, self.name), 'w') as f:
+                json.dump(self._rejected_folders, f, indent=4)
         except AttributeError as e:
             logger.error(f'Unable to save log file. Got {e}')
 
-    def _filter_dcm_files(self, folder):
+    def _filter_dcm_files(self, folder, files=None):
         """
         Filters the dicom files from the folder. It also checks if the folder
-        was processed before. If it was processed before, it only returns
-        a single file from the folder. Otherwise, it returns all the dicom
-        files from the folder.
+        was processed before. If it was processed before, and all the slices
+        had the same parameters, it only returns a few files from the
+        folder. Otherwise, it returns all the dicom
+        files from the folder, in stratified order if sampling is enabled.
 
         Parameters
         ----------
         folder : Path
             The path to the folder containing the dicom slices
+        files : List[Path]
+            Files in the folder matching the pattern, as found while walking
+            the data source. If None, the folder is globbed again.
         """
-        dcm_files = sorted(folder.glob(self.pattern))
+        if files is None:
+            files = folder.glob(self.pattern)
+        dcm_files = sorted(files)
+        if self.sampling_patience:
+            dcm_files = stratified_order(dcm_files)
         # check if we have processed this folder before
         process_whole = self._process_whole_folder.get(str(folder), True)
+        if (self.fast_read or self.prefetch) and process_whole:
+            # the DICM prefix is checked while reading the file, by the
+            #   header scanner or on the prefetched bytes, so the files
+            #   are not opened twice
+            return dcm_files
         # filter dicom files from the folder
         valid_dicom_files = filter(is_dicom_file, dcm_files)
         # if valid_dicom_files is empty, we cannot process this folder
@@ -205,27 +521,89 @@ class DicomDataset(BaseDataset, ABC):
     def _set_folder_status(self, folder, divergent_slices):
         # update the folder processed status. If more than 1 divergent slice
         #   is found, we need to process whole folder to
-        #   find the varying parameters
+        #   find the varying parameters. This includes folders with more than
+        #   one series, each of which contributes at least one signature
         self._process_whole_folder[str(folder)] = len(divergent_slices) > 1
 
-    def _process_slice_collection(self, folder):
+    def _process_slice_collection(self, folder, files=None):
+        """
+        Processes a collection of dicom slices in a folder. If the header
+        cache is enabled, and none of the files in the folder have changed
+        since the sequences were cached, the cached sequences are returned
+        without reading any of the files. See _read_slice_collection.
+
+        Parameters
+        ----------
+        folder : Path
+            The path to the folder containing the dicom slices
+        files : List[Path]
+            Files in the folder matching the pattern. If None, the folder
+            is globbed again.
+
+        Returns
+        -------
+        List[protocol.DicomImagingSequence]
+            one sequence for each series found in the folder
+        """
+        if self._cache is None:
+            return self._read_slice_collection(folder, files)
+
+        if files is None:
+            files = sorted(folder.glob(self.pattern))
+        fingerprint = folder_fingerprint(files, self._cache_salt)
+        hit, sequences, status = self._cache.get(folder, fingerprint)
+        if hit:
+            if status is not None:
+                self._restore_folder_status(folder, status)
+            return sequences
+
+        sequences = self._read_slice_collection(folder, files)
+        self._cache.put(folder, fingerprint, sequences,
+                        list(self._folder_status(folder)))
+        return sequences
+
+    def _read_slice_collection(self, folder, files=None):
         """
         Processes a collection of dicom slices in a folder. It iterates over
-        all the slices and collects the slices with divergent parameters, for
-        example, EchoTime and Echonumber for multi-echo sequences.
+        all the slices once, and groups them by series. A folder may contain
+        slices from several series e.g. an unsorted PACS export, each series
+        is returned as a separate sequence. Within a series, the slices are
+        grouped by a signature of the parameters that may vary across
+        slices, for example, EchoTime and Echonumber for multi-echo
+        sequences.
 
-        It then processes the divergent slices to find the varying parameters
-        and updates the protocol.DicomImagingSequence object.
+        It then processes the groups to find the varying parameters and
+        updates the protocol.DicomImagingSequence object. The number of
+        slices in each group is available as the slice_signatures attribute
+        of the sequence, a dict from signature to count. Each signature is a
+        tuple of values, in the order of config.VARIABLE_PARAMETERS, see
+        dicom_utils.slice_signature. The counts cover the slices that were
+        read, i.e. only part of the series if sampling_patience stopped the
+        reading early, or if only a few files are read because the folder
+        was uniform in the previous run.
 
         Parameters
         ----------
         folder : Path
             The path to the folder containing the dicom slices
+        files : List[Path]
+            Files in the folder matching the pattern. If None, the folder
+            is globbed again.
+
+        Returns
+        -------
+        List[protocol.DicomImagingSequence]
+            one sequence for each series found in the folder
         """
 
+        if self._is_rejected_folder(folder):
+            logger.info(f'Skipping {folder}, all series were excluded in the '
+                        'previous run')
+            return []
+
         # within a folder, a volume can be multi-echo, so we must read them all
         #   and find a way to capture the echo time information
-        dcm_files = self._filter_dcm_files(folder)
+        dcm_files = self._filter_dcm_files(folder, files)
         # run some basic validation of these dcm slice collection
         #   session_info must match, parameter values must also match in general
         # However, for certain sequences, the parameter may vary
@@ -234,102 +612,412 @@ class DicomDataset(BaseDataset, ABC):
         #   all the slices and then process them to find the varying
         #   parameters.
 
-        # collect all the slices with diverging parameters
-        divergent_slices = list()
-        first_slice = None
-        localizer_flag = False
+        # slices are grouped by series, identified by the session info i.e.
+        #   subject_id, session_id, run_id. Within a series, the slices are
+        #   grouped by the signature of the variable parameters
+        series = dict()
+        # inclusion decision for each series, keyed by SeriesInstanceUID and
+        #   ImageType. None if the series is included, otherwise the reason
+        #   to exclude it e.g. 'MOCO'
+        decisions = dict()
+        # number of consecutive slices without a new series or a new
+        #   combination of the variable parameters, used to stop sampling
+        num_unchanged = 0
         # iterate over all the slices, check if it is a valid dicom file
-        for dcm_path in dcm_files:
-            try:
-                dicom = dcmread(dcm_path, stop_before_pixels=True)
-            except (InvalidDicomError, PermissionError) as e:
-                logger.info(f'Invalid DICOM file at {dcm_path}. Got {e}')
+        if self.prefetch:
+            # files are read ahead in a thread pool, while the headers read
+            #   so far are parsed
+            dcm_files = prefetch_files(dcm_files, depth=self.prefetch,
+                                       buffer_size=self.prefetch_size,
+                                       fadvise=self.fadvise)
+        else:
+            dcm_files = ((dcm_path, None) for dcm_path in dcm_files)
+        for dcm_path, data in dcm_files:
+            dicom = self._read_slice(dcm_path, decisions, series, data)
+            if dicom is None:
                 continue
 
-            # skip localizer, phantom, scouts, sbref, etc
-            if not is_valid_inclusion(dicom, self.include_phantom,
-                                      self.include_moco, self.include_sbref,
-                                      self.include_derived,
-                                      folder=dcm_path.parent,
-                                      suppress_warnings=localizer_flag):
-                localizer_flag = True
+            # The first valid slice of each series is the reference, which
+            #   becomes the sequence. Only the variable parameters are read
+            #   from the other slices.
+            session_info = get_session_info(dicom)
+            group = series.get(session_info, None)
+            if group is None:
+                group = series[session_info] = {
+                    'sequence': DicomImagingSequence(dicom=dicom,
+                                                     path=folder),
+                    'reference': dcm_path,
+                    'signatures': Counter(),
+                    'divergent': dict()
+                }
+
+            # we only compare the parameters that are subject to
+            #   variation e.g. EchoTime. Some parameters e.g. SliceLocation
+            #   are different for each slice, so they are not included.
+            values = get_variable_params(dicom)
+            signature = slice_signature(values)
+            group['signatures'][signature] += 1
+            if group['signatures'][signature] == 1:
+                group['divergent'][signature] = values
+                num_unchanged = 0
                 continue
 
-            # until the first slice is found, we cannot compare
-            #   other slices with it. So, we collect the first slice
-            #   and then compare other slices with it.
+            num_unchanged += 1
+            if num_unchanged == self.sampling_patience:
+                logger.info(f'No new echo found in {num_unchanged} '
+                            f'consecutive slices. Stop reading {folder}')
+                break
 
-            # Note that we cannot use enumerate and idx ==0 here, because we
-            #   may have to skip some slices
-            if len(divergent_slices) == 0:
-                first_slice = DicomImagingSequence(dicom=dicom, path=folder)
-                # We collect the first slice as a reference to compare
-                #   other slices with, although it is not divergent in
-                #   its true sense
-                divergent_slices.append(first_slice)
+        self._set_folder_status(folder, [signature
+                                         for group in series.values()
+                                         for signature in group['divergent']])
+        self._set_rejected_status(folder, decisions, series)
+        if len(series) > 1:
+            logger.info(f'Found {len(series)} series in {folder}')
+        return [self._finalize_series(group) for group in series.values()]
 
-            else:
-                cur_slice = DicomImagingSequence(dicom=dicom, path=folder)
-
-                # check if the session info is same
-                # Session info includes subject_id, session_id, run_id
-                if (cur_slice.get_session_info()
-                        != first_slice.get_session_info()):
-                    logger.warning(f'Inconsistent session info for {dcm_path}')
-                    continue
-
-                # check if the parameters are same with the slices
-                #   collected so far
-                if len(divergent_slices) > 100:
-                    logger.critical('Too many slices with divergent parameters.'
-                                    ' This should rarely happen.'
-                                    'This would make data reading really slow. '
-                                    'Please check the dataset.')
-                flag = 0
-                for each_slice in divergent_slices:
-                    # we only compare the parameters that are subject to
-                    # variation e.g. EchoTime
-                    #   It is not recommended to compare all parameters as it
-                    #   would be very slow. Also, some parameters are e.g.
-                    #   SliceLocation would be different for each slice.
-                    #   If SliceLocation is also compared, We will end up having
-                    #   all slices in divergent_slices list.
-                    if cur_slice.compare_subset_params(each_slice):
-                        flag = 1
-                        break
-                        # If number of divergent slices is large,
-                        # this would make it faster
-
-                if flag == 0:
-                    divergent_slices.append(cur_slice)
-
-        self._set_folder_status(folder, divergent_slices)
-        # as we also collect the first slice. We can process all slices
-        #   to find the varying parameters. At least one slice would be
-        #   present in divergent_slices.
-        if len(divergent_slices) > 0:
-            # if there are divergent slices, we need to process them
-            #   to find the varying parameters. For now, we just look for
-            #   echo-time and echo-number, but we can extend this to other
-            #   parameters such as flip-angle, etc.
-            echo_times, echo_nums = self._process_echo_times(divergent_slices)
-            first_slice.set_echo_times(echo_times, echo_nums)
-            # TODO: Add support for other parameters
-            # TODO: Calculate number of slices using SliceLocation
-            #   See: https://stackoverflow.com/questions/59458801/how-to-sort-dicom-slices-in-correct-order # noqa
+    def _is_excluded_session(self, dicom):
+        """
+        Checks if the subject of a slice is excluded, or its study date is
+        outside the begin and end dates in the config. Slices without a
+        valid StudyDate are not excluded by date.
+        """
+        if is_excluded_subject(dicom.get('PatientID', None),
+                               self.exclude_subjects):
+            return True
+        study_date = get_study_date(dicom)
+        if study_date is None:
+            return False
+        if self.begin is not None and study_date < self.begin:
+            return True
+        return self.end is not None and study_date > self.end
+
+    def _read_slice(self, dcm_path, decisions, series, data=None):
+        """
+        Reads the header of a slice, and checks if it must be included. The
+        first slice of each series is read in full, as it is validated and
+        becomes the reference for the series. In fast-read mode, only the
+        tags required to compare the slices are read from the other slices.
+        The slices of a rejected series are skipped in either mode, without
+        reading their header in full.
+
+        Parameters
+        ----------
+        dcm_path : Path
+            The path to the dicom slice
+        decisions : dict
+            inclusion decision for each series seen so far
+        series : dict
+            series found so far, keyed by session info
+        data : bytes
+            The first bytes of the file, if prefetched
+
+        Returns
+        -------
+        pydicom.FileDataset or ScannedHeader or None
+            None if the slice is skipped
+        """
+        try:
+            if not self.fast_read and any(decisions.values()):
+                # the header is read in full below, so the series of the
+                #   slice is looked up first, with a cheap scan
+                key = self._read_series_key(dcm_path, data)
+                if decisions.get(key, None) is not None:
+                    return None
+            dicom = self._read_header(dcm_path, data=data)
+            # the remaining slices of a rejected series are skipped, from
+            #   the header that was just read. In fast-read mode, it is a
+            #   cheap scan of a few tags
+            key = get_series_key(dicom)
+            if decisions.get(key, None) is not None:
+                return None
+            if (key not in decisions
+                    or get_session_info(dicom) not in series):
+                # the reference slice becomes the sequence, so all
+                #   the parameters must be read
+                dicom = self._read_full_header(dcm_path, dicom)
+        except (InvalidDicomError, OSError) as e:
+            logger.info(f'Invalid DICOM file at {dcm_path}. Got {e}')
+            return None
+
+        # skip localizer, phantom, scouts, sbref, etc
+        try:
+            if not self._is_included(dicom, decisions, dcm_path):
+                return None
+        except (InvalidDicomError, OSError) as e:
+            logger.info(f'Invalid DICOM file at {dcm_path}. Got {e}')
+            return None
+        return dicom
+
+    def _is_included(self, dicom, decisions, dcm_path):
+        """
+        Checks if a slice must be included, see is_valid_inclusion, and that
+        its session is not excluded, see _is_excluded_session. The
+        outcome is a property of the series, so it is computed once for the
+        first slice of each series and cached in decisions. Every slice is
+        still checked to be a valid imaging dicom, see _is_valid_slice.
+        """
+        key = get_series_key(dicom)
+        if key in decisions:
+            return (decisions[key] is None
+                    and self._is_valid_slice(dcm_path, dicom))
+        reason = get_exclusion_reason(dicom, self.include_phantom,
+                                      self.include_moco,
+                                      self.include_sbref,
+                                      self.include_derived)
+        if reason == 'Invalid':
+            return False
+        if reason in EXCLUSION_FLAGS:
+            raise_warning(reason, dcm_path.parent)
+        elif reason is None and self._is_excluded_session(dicom):
+            logger.warning(f'Skipping series {key[0]} in {dcm_path.parent}, '
+                           'excluded by the exclude_subjects, begin or end '
+                           'options in the config')
+            reason = 'ExcludedSession'
+        decisions[key] = reason
+        return reason is None
+
+    def _is_valid_slice(self, dcm_path, dicom):
+        """
+        Checks if a slice is a valid imaging dicom, from the header already
+        read. A header read by the scanner that fails the check is read in
+        full and checked again, as the scanner skips the functional groups
+        of multi-frame files.
+        """
+        if is_valid_imaging_slice(dicom):
+            return True
+        if isinstance(dicom, ScannedHeader):
+            dicom = self._read_header(dcm_path, full=True)
+            if is_valid_imaging_slice(dicom):
+                return True
+        logger.info(f'Invalid imaging dicom at {dcm_path}. Skipping it.')
+        return False
+
+    def _set_rejected_status(self, folder, decisions, series):
+        """
+        Records the reasons to reject a folder in the log of rejected
+        folders, if no series was found and all the series in it were
+        excluded because of the include_sequence options in the config e.g.
+        moco. The folder is skipped on the next run, unless the
+        corresponding options are changed.
+        """
+        reasons = set(decisions.values())
+        if not series and reasons and reasons.issubset(EXCLUSION_FLAGS):
+            self._rejected_folders[str(folder)] = sorted(reasons)
+        else:
+            self._rejected_folders.pop(str(folder), None)
+
+    def _is_rejected_folder(self, folder):
+        """
+        Checks if a folder was rejected in a previous run, and the options
+        that caused it to be rejected are unchanged.
+        """
+        reasons = self._rejected_folders.get(str(folder), None)
+        if reasons is None:
+            return False
+        return not any(self.includes.get(EXCLUSION_FLAGS.get(reason), False)
+                       for reason in reasons)
+
+    def _finalize_series(self, group):
+        """
+        Sets the varying parameters of a series on its reference sequence,
+        and the number of slices for each signature of the variable
+        parameters.
+
+        Parameters
+        ----------
+        group : dict
+            reference sequence, signature counts and the values of the
+            variable parameters for each signature, for a single series
+
+        Returns
+        -------
+        protocol.DicomImagingSequence
+        """
+        first_slice = group['sequence']
+        # For now, we just look for echo-time and echo-number, but we can
+        #   extend this to other parameters such as flip-angle, etc.
+        echo_times, echo_nums = self._process_echo_times(
+            list(group['divergent'].values()))
+        first_slice.set_echo_times(echo_times, echo_nums)
+        first_slice.slice_signatures = dict(group['signatures'])
+        # the sequence can be built again from this slice and the echoes,
+        #   see _make_handle
+        first_slice.reference_file = group['reference']
+        first_slice.echo_values = (
+            list(echo_times), None if echo_nums is None else list(echo_nums))
+        # TODO: Add support for other parameters
+        # TODO: Calculate number of slices using SliceLocation
+        #   See: https://stackoverflow.com/questions/59458801/how-to-sort-dicom-slices-in-correct-order # noqa
         return first_slice
 
+    def _make_handle(self, folder, signature, seq):
+        """
+        Returns a handle to build the sequence again from the header of its
+        reference slice. The echo times and numbers, collected from all the
+        slices of the series, are kept in the handle. See
+        BaseDataset._make_handle.
+        """
+        state = {'echo_values': seq.echo_values,
+                 'slice_signatures': seq.slice_signatures}
+        return SequenceHandle(folder=folder,
+                              filepath=seq.reference_file,
+                              fingerprint=signature,
+                              subject_id=seq.subject_id,
+                              session_id=seq.session_id,
+                              run_id=seq.run_id,
+                              name=seq.name,
+                              state=state,
+                              file_stat=file_stat(seq.reference_file))
+
+    def _load_sequence(self, handle):
+        """
+        Builds a sequence from the header of the reference slice referred
+        to by a handle, see _make_handle.
+        """
+        folder = Path(handle.folder)
+        try:
+            dicom = self._read_header(Path(handle.filepath), full=True)
+        except (InvalidDicomError, OSError) as e:
+            logger.warning(f'Unable to read {handle.filepath}. Got {e}')
+            return None
+        seq = DicomImagingSequence(dicom=dicom, path=folder)
+        state = handle.state
+        seq.set_echo_times(*state['echo_values'])
+        seq.slice_signatures = state['slice_signatures']
+        seq.reference_file = handle.filepath
+        return seq
+
+    def _read_header(self, dcm_path, full=False, data=None):
+        """
+        Reads the header of a dicom slice, skipping the pixel data. In
+        fast-read mode, only the tags in config.SCAN_TAGS are read, with a
+        single read of config.SCAN_BUFFER_SIZE bytes (see scanner.py). If the
+        file cannot be scanned e.g. implicit VR, the tags in
+        config.FAST_READ_TAGS are read with pydicom instead. If full is
+        True, the whole header is read.
+
+        Parameters
+        ----------
+        dcm_path : Path
+            The path to the dicom slice
+        full : bool
+            Whether to read all the tags, irrespective of fast-read mode.
+        data : bytes
+            The first bytes of the file, if prefetched. These are scanned
+            instead of reading the file again. If the header of the file
+            ends within these bytes, it is parsed from them in any mode, see
+            _parse_buffer.
+
+        Returns
+        -------
+        pydicom.FileDataset or ScannedHeader
+        """
+        if data is not None and data[128:132] != b'DICM':
+            raise InvalidDicomError(f'Missing DICM prefix in {dcm_path}')
+        if full or not self.fast_read:
+            if data is not None:
+                # the header usually ends within the prefetched bytes, no
+                #   need to read the file again
+                dicom = self._parse_buffer(dcm_path, data)
+                if dicom is not None:
+                    return dicom
+            return dcmread(dcm_path, stop_before_pixels=True)
+        if data is not None:
+            header = scan_buffer(data, SCAN_TAGS,
+                                 len(data) < self.prefetch_size, dcm_path)
+        else:
+            header = scan_header(dcm_path, SCAN_TAGS, SCAN_BUFFER_SIZE)
+        if header is not None:
+            return header
+        return dcmread(dcm_path, stop_before_pixels=True,
+                       specific_tags=FAST_READ_TAGS,
+                       defer_size=FAST_READ_DEFER_SIZE)
+
+    def _parse_buffer(self, dcm_path, data):
+        """
+        Parses the header of a slice from its first bytes, read by
+        prefetch_files. If data does not hold the whole file, the header
+        must end within data i.e. the parser must stop at the pixel data
+        before the end of data. Otherwise, None is returned, and the file
+        must be read instead.
+
+        Parameters
+        ----------
+        dcm_path : Path
+            The path to the dicom slice
+        data : bytes
+            The first bytes of the file
+
+        Returns
+        -------
+        pydicom.FileDataset or None
+        """
+        fp = BytesIO(data)
+        if len(data) < self.prefetch_size:
+            # the whole file was prefetched
+            dicom = dcmread(fp, stop_before_pixels=True)
+        else:
+            try:
+                # pydicom warns about a header cut short, which is
+                #   expected here
+                with warnings.catch_warnings():
+                    warnings.simplefilter('ignore')
+                    dicom = dcmread(fp, stop_before_pixels=True)
+            except (EOFError, OSError, struct.error):
+                return None
+            # the parser rewinds to the pixel data, if it got there
+            if fp.tell() >= len(data):
+                return None
+        dicom.filename = str(dcm_path)
+        return dicom
+
+    def _read_series_key(self, dcm_path, data=None):
+        """
+        Returns the key of the series of a slice, see get_series_key. Only
+        the tags in config.SERIES_KEY_TAGS are read, with the header
+        scanner if possible.
+
+        Parameters
+        ----------
+        dcm_path : Path
+            The path to the dicom slice
+        data : bytes
+            The first bytes of the file, if prefetched
+
+        Returns
+        -------
+        tuple
+        """
+        if data is not None:
+            header = scan_buffer(data, SERIES_KEY_TAGS,
+                                 len(data) < self.prefetch_size, dcm_path)
+        else:
+            header = scan_header(dcm_path, SERIES_KEY_TAGS, SCAN_BUFFER_SIZE)
+        if header is None:
+            header = dcmread(dcm_path, stop_before_pixels=True,
+                             specific_tags=SERIES_KEY_TAGS)
+        return get_series_key(header)
+
+    def _read_full_header(self, dcm_path, dicom):
+        """Returns the full header of a slice, read again in fast-read mode"""
+        if self.fast_read:
+            return self._read_header(dcm_path, full=True)
+        return dicom
+
     def _process_echo_times(self, divergent_slices: List) -> Tuple:
         """
-        Finds the set of echo times and echo numbers from the list of
-        slices. However, the echo number is not always available
-        in the dicom header. In that case, we may have to look for a unique
-        set of echo times. Although this is not preferred, but we can use this.
+        Finds the set of echo times and echo numbers from the values of the
+        variable parameters in each group of slices. However, the echo number
+        is not always available in the dicom header. In that case, we may
+        have to look for a unique set of echo times. Although this is not
+        preferred, but we can use this.
 
         Parameters
         ----------
-        divergent_slices : list
-            DicomImagingSequence objects with divergent parameters
+        divergent_slices : List[dict]
+            values of the variable parameters (see config.VARIABLE_PARAMETERS)
+            for each group of slices
 
         Returns
         -------
@@ -342,12 +1030,25 @@ class DicomDataset(BaseDataset, ABC):
         if self.use_echo_numbers:
             echo_dict = dict()
             for i_slice in divergent_slices:
-                enum = i_slice['EchoNumber'].get_value()
+                enum = i_slice['EchoNumber']
                 if enum not in echo_dict:
-                    echo_dict[enum] = i_slice['EchoTime'].get_value()
+                    echo_dict[enum] = i_slice['EchoTime']
             return echo_dict.values(), echo_dict.keys()
         else:
             echo_times = set()
             for i_slice in divergent_slices:
-                echo_times.add(i_slice['EchoTime'].get_value())
+                echo_times.add(i_slice['EchoTime'])
             return echo_times, None
+
+
+def _process_folder_job(job):
+    """
+    Reads a single folder of dicom slices in a worker. Returns the folder,
+    its signature, the sequences read from it, and the updated status of
+    the folder for the previous-run log, see DicomDataset._folder_status.
+    """
+    reader, folder, files, status = job
+    reader._restore_folder_status(folder, status)
+    signature = reader._folder_signature(folder, files)
+    sequences = reader._process_slice_collection(folder, files)
+    return folder, signature, sequences, reader._folder_status(folder)
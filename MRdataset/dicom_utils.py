@@ -1,12 +1,19 @@
 """ Utility functions for dicom files """
 import warnings
+from datetime import date
 from pathlib import Path
 from re import search
-from typing import Union
+from typing import Union, Optional
 
 import dicom2nifti
+import numpy as np
 import pydicom
+from protocol.utils import get_dicom_param_value
+
 from MRdataset import logger
+from MRdataset.config import VARIABLE_PARAMETERS
+from MRdataset.scanner import ScannedHeader
+from MRdataset.utils import parse_date
 
 with warnings.catch_warnings():
     warnings.filterwarnings('ignore')
@@ -79,6 +86,16 @@ def is_dicom_file(filename: Union[str, Path]):
     return False
 
 
+#: Reasons to exclude a series, which can be overridden by including the
+#: corresponding key in the include_sequence section of the config
+EXCLUSION_FLAGS = {
+    'Phantom': 'phantom',
+    'SBRef': 'sbref',
+    'MOCO': 'moco',
+    'Derived': 'derived',
+}
+
+
 def is_valid_inclusion(dicom: pydicom.FileDataset,
                        include_phantom=False,
                        include_moco=False,
@@ -111,9 +128,32 @@ def is_valid_inclusion(dicom: pydicom.FileDataset,
     -------
     bool
     """
+    reason = get_exclusion_reason(dicom, include_phantom, include_moco,
+                                  include_sbref, include_derived)
+    if reason in EXCLUSION_FLAGS:
+        raise_warning(reason, folder, suppress_warnings)
+    return reason is None
+
+
+def get_exclusion_reason(dicom: pydicom.FileDataset,
+                         include_phantom=False,
+                         include_moco=False,
+                         include_sbref=False,
+                         include_derived=False) -> Optional[str]:
+    """
+    Checks whether a dicom slice should be excluded, and why. See
+    is_valid_inclusion for the parameters.
+
+    Returns
+    -------
+    str or None
+        None if the slice is a valid imaging dicom to include. Otherwise,
+        one of 'Invalid', 'NoSeriesDescription', 'NoImageType', or one of
+        the keys of EXCLUSION_FLAGS.
+    """
     if not dicom2nifti.convert_dir._is_valid_imaging_dicom(dicom):
         logger.info('Invalid file')
-        return False
+        return 'Invalid'
 
     # TODO: revisit whether to include localizer or not,
     #  it may have relationship with other modalities
@@ -124,33 +164,77 @@ def is_valid_inclusion(dicom: pydicom.FileDataset,
     image_type = dicom.get('ImageType', None)
 
     if series_desc is None:
-        return False
+        return 'NoSeriesDescription'
 
     series_desc = series_desc.lower()
     if not include_phantom:
         phantom_keys = {'localizer', 'aahead'}
         if any(x in series_desc for x in phantom_keys):
-            raise_warning('Phantom', folder, suppress_warnings)
-            return False
+            return 'Phantom'
         if is_phantom(dicom):
-            raise_warning('Phantom', folder, suppress_warnings)
-            return False
+            return 'Phantom'
     if not include_sbref and 'sbref' in series_desc:
-        raise_warning('SBRef', folder, suppress_warnings)
-        return False
+        return 'SBRef'
 
     if image_type is None:
-        return False
+        return 'NoImageType'
 
     for i in image_type:
         if not include_moco and 'moco' in i.lower():
-            raise_warning('MOCO', folder, suppress_warnings)
-            return False
+            return 'MOCO'
         if not include_derived and 'derived' in i.lower():
-            raise_warning('Derived', folder, suppress_warnings)
-            return False
+            return 'Derived'
 
-    return True
+    return None
+
+
+def is_valid_imaging_slice(dicom: pydicom.FileDataset) -> bool:
+    """
+    Checks whether a slice is a valid imaging dicom, as in dicom2nifti. For a
+    header read by the scanner (see scanner.py), the same tags are checked,
+    except the functional groups of multi-frame files, which the scanner
+    does not read.
+
+    Parameters
+    ----------
+    dicom : pydicom.FileDataset or ScannedHeader
+        header of the slice
+
+    Returns
+    -------
+    bool
+        False if the slice is not valid, or if it may be a multi-frame file
+        that must be read in full to be checked
+    """
+    if not isinstance(dicom, ScannedHeader):
+        return dicom2nifti.convert_dir._is_valid_imaging_dicom(dicom)
+    if 'SeriesInstanceUID' not in dicom or 'InstanceNumber' not in dicom:
+        return False
+    orientation = dicom.get('ImageOrientationPatient', None)
+    position = dicom.get('ImagePositionPatient', None)
+    return (isinstance(orientation, list) and len(orientation) >= 6
+            and isinstance(position, list) and len(position) >= 3)
+
+
+def get_series_key(dicom: pydicom.FileDataset) -> tuple:
+    """
+    Returns the key used to cache inclusion decisions for a series i.e.
+    SeriesInstanceUID and ImageType. The key can be read with a cheap
+    header read, see config.SERIES_KEY_TAGS.
+
+    Parameters
+    ----------
+    dicom : pydicom.FileDataset
+        dicom object read from pydicom.read_file
+
+    Returns
+    -------
+    tuple
+    """
+    image_type = dicom.get('ImageType', None)
+    if image_type is not None:
+        image_type = tuple(image_type)
+    return dicom.get('SeriesInstanceUID', None), image_type
 
 
 def raise_warning(msg: str, path, suppress_warnings=False):
@@ -198,3 +282,101 @@ def is_phantom(dicom: pydicom.FileDataset) -> bool:
     if age == '001D':
         return True
     return False
+
+
+def get_session_info(dicom: pydicom.FileDataset) -> tuple:
+    """
+    Returns the session info of a dicom slice, identical to
+    DicomImagingSequence.get_session_info, without parsing the whole header.
+
+    Parameters
+    ----------
+    dicom : pydicom.FileDataset
+        dicom object read from pydicom.read_file
+
+    Returns
+    -------
+    tuple : subject_id, session_id, run_id
+    """
+    return (str(dicom.get('PatientID', None)),
+            str(dicom.get('StudyInstanceUID', None)),
+            dicom.get('SeriesInstanceUID', None))
+
+
+def get_study_date(dicom: pydicom.FileDataset) -> Optional[date]:
+    """
+    Returns the StudyDate of a dicom slice, or None if it is missing or
+    not a valid date.
+
+    Parameters
+    ----------
+    dicom : pydicom.FileDataset
+        dicom object read from pydicom.read_file
+
+    Returns
+    -------
+    datetime.date or None
+    """
+    try:
+        return parse_date(dicom.get('StudyDate', None))
+    except (TypeError, ValueError):
+        return None
+
+
+def get_variable_params(dicom: pydicom.FileDataset,
+                        params=VARIABLE_PARAMETERS) -> dict:
+    """
+    Reads the values of the parameters that may vary across slices of a
+    series e.g. EchoTime.
+
+    Parameters
+    ----------
+    dicom : pydicom.FileDataset
+        dicom object read from pydicom.read_file
+    params : List[str]
+        names of the parameters, see config.VARIABLE_PARAMETERS
+
+    Returns
+    -------
+    dict : parameter name to value, None if the value is not available
+    """
+    return {name: get_dicom_param_value(dicom, name) for name in params}
+
+
+def slice_signature(values: dict, decimals=3) -> tuple:
+    """
+    Returns a hashable signature for the values of the variable parameters
+    of a slice. Numeric values are rounded to the given decimals, so that
+    tiny differences e.g. from floating point conversions do not split a
+    group of slices. Slices are grouped by exact equality of their
+    signatures, which is stricter than protocol.compare_subset_params in two
+    ways. Missing values (None) are a value of their own, not a wildcard
+    that matches anything. Values that differ by less than the tolerance of
+    protocol, but round to different numbers e.g. 30.0004 and 30.0006,
+    have different signatures.
+
+    Parameters
+    ----------
+    values : dict
+        parameter name to value, see get_variable_params
+    decimals : int
+        number of decimals to round the numeric values to
+
+    Returns
+    -------
+    tuple
+    """
+    signature = []
+    for value in values.values():
+        if isinstance(value, (list, tuple, pydicom.multival.MultiValue)):
+            value = tuple(_round(v, decimals) for v in value)
+        else:
+            value = _round(value, decimals)
+        signature.append(value)
+    return tuple(signature)
+
+
+def _round(value, decimals):
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return float(np.round(value, decimals=decimals))
+    return value
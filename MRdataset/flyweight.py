@@ -0,0 +1,168 @@
+"""
+Deduplication of the parameters of the runs of a dataset. The runs of a
+sequence ID usually share the same protocol, i.e. the same values for all
+their acquisition parameters, yet each run holds its own parameter objects.
+The pool interns the parameters so that equal parameters are stored once and
+shared by all the runs, and counts the runs of each distinct protocol per
+sequence ID.
+"""
+from typing import Dict, Iterable, Optional, Tuple
+
+from protocol import BaseSequence
+
+from MRdataset.config import RUN_SPECIFIC_PARAMETERS
+
+
+def parameter_key(name: str, param) -> Optional[tuple]:
+    """
+    Returns a key that is equal for parameters that are interchangeable,
+    i.e. of the same class with the same attributes, or None if the
+    parameter has no attributes to compare.
+
+    Parameters
+    ----------
+    name : str
+        name of the parameter in the sequence e.g. 'EchoTime'
+    param : protocol.BaseParameter
+        the parameter
+    """
+    try:
+        state = vars(param)
+    except TypeError:
+        return None
+    return type(param), name, repr(sorted(state.items()))
+
+
+class ParameterPool:
+    """
+    Interns the parameters of the runs added to a dataset, and counts the
+    runs of each distinct protocol per sequence ID. The protocol of a run is
+    the set of its parameters, except the demographics of the subject and
+    the parameters that change from run to run e.g. the position of the
+    slices. Only the parameters of the protocol are interned.
+
+    The interned parameters are shared by many runs, and must not be
+    modified in place. Replace the run instead, see BaseDataset.replace.
+    Each shared parameter is released once no run refers to it.
+
+    Parameters
+    ----------
+    exclude : Iterable[str]
+        names of the parameters that are not part of the protocol. Default
+        is config.RUN_SPECIFIC_PARAMETERS
+    intern : bool
+        whether to intern the parameters of the runs added. If False, the
+        protocols are only counted, e.g. in lazy mode where the sequences
+        are built only for a while. Default is True.
+    """
+
+    def __init__(self, exclude: Iterable[str] = None, intern: bool = True):
+        if exclude is None:
+            exclude = RUN_SPECIFIC_PARAMETERS
+        self.exclude = frozenset(exclude)
+        self.interning = intern
+        # parameter key -> [the shared parameter, number of runs with it]
+        self._params = dict()
+        # protocol -> [the shared protocol, number of runs with it in all
+        #   the sequences]
+        self._protocols = dict()
+        # seq_id -> protocol -> number of runs
+        self._counts = dict()
+        # key of a run -> its protocol
+        self._run_protocols = dict()
+
+    def _protocol_names(self, seq: BaseSequence):
+        """Returns the names of the parameters of the protocol of seq"""
+        excluded = self.exclude.union(getattr(seq, 'demographics', ()))
+        return sorted(name for name in seq if name not in excluded)
+
+    def signature(self, seq: BaseSequence) -> tuple:
+        """Returns the protocol of a sequence, i.e. the keys of the
+        parameters of its protocol, without interning them"""
+        keys = (parameter_key(name, seq[name])
+                for name in self._protocol_names(seq))
+        return tuple(key for key in keys if key is not None)
+
+    def intern(self, seq: BaseSequence) -> tuple:
+        """
+        Replaces the parameters of the protocol of a sequence with the
+        shared parameters that are equal to them, and adds the others to
+        the pool. Returns the protocol of the sequence. Each parameter is
+        referred to once more, until released, see release.
+        """
+        signature = list()
+        for name in self._protocol_names(seq):
+            param = seq[name]
+            key = parameter_key(name, param)
+            if key is None:
+                continue
+            shared = self._params.get(key, None)
+            if shared is None:
+                shared = self._params[key] = [param, 0]
+            shared[1] += 1
+            if shared[0] is not param:
+                seq[name] = shared[0]
+            signature.append(key)
+        return tuple(signature)
+
+    def release(self, signature: tuple):
+        """Releases the parameters of a protocol returned by intern, and
+        drops the parameters no longer referred to"""
+        for key in signature:
+            shared = self._params[key]
+            shared[1] -= 1
+            if not shared[1]:
+                del self._params[key]
+
+    def add(self, key: Tuple[str, str, str, str], seq: BaseSequence):
+        """Interns the parameters of a run, unless interning is off, and
+        counts it towards its protocol"""
+        if key in self._run_protocols:
+            return
+        if self.interning:
+            signature = self.intern(seq)
+        else:
+            signature = self.signature(seq)
+        # equal protocols are stored once, and shared by the runs
+        shared = self._protocols.setdefault(signature, [signature, 0])
+        signature = shared[0]
+        shared[1] += 1
+        counts = self._counts.setdefault(key[2], dict())
+        counts[signature] = counts.get(signature, 0) + 1
+        self._run_protocols[key] = signature
+
+    def remove(self, key: Tuple[str, str, str, str]):
+        """Removes a run from the counts of its protocol, and releases its
+        parameters"""
+        signature = self._run_protocols.pop(key, None)
+        if signature is None:
+            return
+        if self.interning:
+            self.release(signature)
+        shared = self._protocols[signature]
+        shared[1] -= 1
+        if not shared[1]:
+            del self._protocols[signature]
+        counts = self._counts[key[2]]
+        _decrement(counts, signature)
+        if not counts:
+            del self._counts[key[2]]
+
+    def count(self, seq_id: str) -> int:
+        """Returns the number of distinct protocols of a sequence ID"""
+        return len(self._counts.get(seq_id, ()))
+
+    def runs_per_protocol(self, seq_id: str) -> Dict[tuple, int]:
+        """Returns the number of runs of each protocol of a sequence ID"""
+        return dict(self._counts.get(seq_id, {}))
+
+    def __len__(self):
+        """Number of distinct parameters in the pool"""
+        return len(self._params)
+
+
+def _decrement(counts: dict, key):
+    """Decrements a count, deleting it when it reaches 0"""
+    counts[key] -= 1
+    if not counts[key]:
+        del counts[key]
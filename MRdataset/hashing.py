@@ -0,0 +1,143 @@
+"""
+Hierarchical content hashes of the runs of a dataset. Each run is hashed
+from its IDs and the values of its parameters, and the hash of every node of
+the tree, i.e. sequence, session, subject and the dataset itself, is the sum
+of the hashes of the runs below it. Since the sum does not depend on the
+order of the runs, the hashes are updated in constant time as runs are
+added or removed, and two datasets are compared by descending only into the
+nodes whose hashes differ.
+"""
+import hashlib
+from typing import Dict, List, Tuple
+
+from protocol import BaseSequence
+
+from MRdataset.columnar import normalize_value
+from MRdataset.indexes import DECIMALS
+
+# hashes are summed modulo 2**128
+_BITS = 128
+_MODULUS = 1 << _BITS
+# depth of the runs in the tree: subject, session, sequence and run
+_DEPTH = 4
+
+
+def _canonical(value):
+    """Returns a representation of a normalized value that is the same in
+    every process, i.e. with sets sorted"""
+    if isinstance(value, frozenset):
+        return sorted(repr(v) for v in value)
+    if isinstance(value, tuple):
+        return [_canonical(v) for v in value]
+    return value
+
+
+def run_hash(key: Tuple[str, str, str, str], seq: BaseSequence) -> int:
+    """
+    Returns the hash of a run, from its IDs and the values of all the
+    parameters of its sequence. Numbers are rounded to as many decimals as
+    in the parameter indexes.
+
+    Parameters
+    ----------
+    key : tuple
+        subject_id, session_id, seq_id and run_id of the run
+    seq : protocol.BaseSequence
+        Instance of the sequence
+    """
+    params = [(name, _canonical(normalize_value(seq[name].get_value(),
+                                                DECIMALS)))
+              for name in sorted(seq)]
+    content = repr((key, params)).encode('utf-8')
+    digest = hashlib.blake2b(content, digest_size=_BITS // 8).digest()
+    return int.from_bytes(digest, 'big')
+
+
+class ContentHashes:
+    """
+    Hashes of every node of the tree of a dataset, keyed by the path to the
+    node e.g. () for the dataset, (subject_id, session_id) for a session
+    and (subject_id, session_id, seq_id, run_id) for a run.
+    """
+
+    def __init__(self):
+        # path -> (hash, number of runs below)
+        self._nodes = dict()
+        # path -> names of the children of the node
+        self._children = dict()
+
+    def add(self, key: Tuple[str, str, str, str], seq: BaseSequence):
+        """Adds the hash of a run to the run and all the nodes above it"""
+        if key in self._nodes:
+            return
+        self._update(key, run_hash(key, seq), 1)
+
+    def remove(self, key: Tuple[str, str, str, str]):
+        """Subtracts the hash of a run from all the nodes above it"""
+        node = self._nodes.get(key, None)
+        if node is not None:
+            self._update(key, -node[0], -1)
+
+    def _update(self, key, value, count):
+        for depth in range(_DEPTH, -1, -1):
+            path = key[:depth]
+            total, runs = self._nodes.get(path, (0, 0))
+            runs += count
+            if runs:
+                self._nodes[path] = ((total + value) % _MODULUS, runs)
+                if depth < _DEPTH and count > 0:
+                    self._children.setdefault(path, set()).add(key[depth])
+            else:
+                # prune the nodes left without runs
+                self._nodes.pop(path, None)
+                self._children.pop(path, None)
+                if depth:
+                    self._children[key[:depth - 1]].discard(key[depth - 1])
+
+    def hash_of(self, path: tuple = ()) -> int:
+        """Returns the hash of a node, 0 if it does not exist"""
+        return self._nodes.get(path, (0, 0))[0]
+
+    def __len__(self):
+        """Number of runs"""
+        return self._nodes.get((), (0, 0))[1]
+
+    def _runs_below(self, path) -> List[tuple]:
+        """Returns the paths of all the runs below a node"""
+        if len(path) == _DEPTH:
+            return [path]
+        runs = list()
+        for name in self._children.get(path, ()):
+            runs.extend(self._runs_below(path + (name,)))
+        return runs
+
+    def diff(self, other: 'ContentHashes') -> Dict[str, List[tuple]]:
+        """
+        Compares with the hashes of another dataset, descending only into
+        the nodes whose hashes differ.
+
+        Returns
+        -------
+        dict
+            sorted lists of the 'added' runs, i.e. present here but not in
+            other, the 'removed' runs, present only in other, and the
+            'changed' runs, present in both but with different hashes.
+        """
+        added, removed, changed = list(), list(), list()
+        pending = [()]
+        while pending:
+            path = pending.pop()
+            if self.hash_of(path) == other.hash_of(path):
+                continue
+            if len(path) == _DEPTH:
+                changed.append(path)
+                continue
+            mine = self._children.get(path, set())
+            theirs = other._children.get(path, set())
+            for name in mine - theirs:
+                added.extend(self._runs_below(path + (name,)))
+            for name in theirs - mine:
+                removed.extend(other._runs_below(path + (name,)))
+            pending.extend(path + (name,) for name in mine & theirs)
+        return {'added': sorted(added), 'removed': sorted(removed),
+                'changed': sorted(changed)}
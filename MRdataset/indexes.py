@@ -0,0 +1,110 @@
+"""
+Secondary indexes on the values of the parameters of the runs of a sequence
+ID, to find the runs with a given value e.g. EchoTime 30 without scanning
+the whole dataset. Each index maps a value to the set of runs with that
+value. The numeric values are also kept sorted, so that range queries visit
+only the values in the range.
+"""
+from bisect import bisect_left, bisect_right, insort
+from typing import Set, Tuple
+
+from protocol import BaseSequence
+
+from MRdataset.columnar import normalize_value
+
+# numbers are rounded to as many decimals before indexing, as in
+#   protocol.NumericParameter
+DECIMALS = 3
+
+
+class ParameterIndex:
+    """
+    Index of the runs of a sequence ID by the value of a parameter. Runs
+    where the parameter is missing are not indexed.
+
+    Parameters
+    ----------
+    name : str
+        name of the parameter e.g. 'EchoTime'
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        # value -> {(subject, session, run)}
+        self._runs = dict()
+        # (subject, session, run) -> value, so that a run is removed without
+        #   its sequence, which may be gone or changed on disk in lazy mode
+        self._values = dict()
+        # numeric values in ascending order, for range queries
+        self._sorted = list()
+
+    def add(self, key: Tuple[str, str, str], seq: BaseSequence):
+        """Indexes a run by the value of the parameter in seq"""
+        self.remove(key)
+        value = value_of(seq, self.name)
+        if value is None:
+            return
+        runs = self._runs.get(value, None)
+        if runs is None:
+            runs = self._runs[value] = set()
+            if isinstance(value, float):
+                insort(self._sorted, value)
+        runs.add(key)
+        self._values[key] = value
+
+    def remove(self, key: Tuple[str, str, str]):
+        """Removes a run from the index, by the value it was indexed with"""
+        value = self._values.pop(key, None)
+        if value is None:
+            return
+        runs = self._runs[value]
+        runs.discard(key)
+        if not runs:
+            del self._runs[value]
+            if isinstance(value, float):
+                del self._sorted[bisect_left(self._sorted, value)]
+
+    def equal(self, value) -> Set[Tuple[str, str, str]]:
+        """Returns the runs with the given value"""
+        return self._runs.get(normalize_value(value, DECIMALS), set())
+
+    def between(self, low=None, high=None) -> Set[Tuple[str, str, str]]:
+        """Returns the runs with a numeric value such that
+        low <= value <= high. Either bound may be None"""
+        start = 0 if low is None else bisect_left(self._sorted,
+                                                  round(low, DECIMALS))
+        stop = len(self._sorted) if high is None else bisect_right(
+            self._sorted, round(high, DECIMALS))
+        runs = set()
+        for value in self._sorted[start:stop]:
+            runs.update(self._runs[value])
+        return runs
+
+    def match(self, predicate) -> Set[Tuple[str, str, str]]:
+        """Returns the runs matching a predicate, see BaseDataset.find"""
+        if isinstance(predicate, slice):
+            return self.between(predicate.start, predicate.stop)
+        return self.equal(predicate)
+
+
+def value_of(seq: BaseSequence, name: str):
+    """Returns the normalized value of a parameter of a sequence, or None if
+    it is missing"""
+    if name not in seq:
+        return None
+    return normalize_value(seq[name].get_value(), DECIMALS)
+
+
+def matches(seq: BaseSequence, name: str, predicate) -> bool:
+    """Checks if a parameter of a sequence matches a predicate, without an
+    index. See BaseDataset.find"""
+    value = value_of(seq, name)
+    if value is None:
+        return False
+    if not isinstance(predicate, slice):
+        return value == normalize_value(predicate, DECIMALS)
+    if not isinstance(value, float):
+        return False
+    low, high = predicate.start, predicate.stop
+    return ((low is None or value >= round(low, DECIMALS))
+            and (high is None or value <= round(high, DECIMALS)))
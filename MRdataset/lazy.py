@@ -0,0 +1,127 @@
+"""
+Lightweight handles that stand in for the sequences of a lazy dataset. A
+handle holds the IDs of a run and a reference to the file the sequence was
+built from, so that the sequence can be built again when it is needed. The
+sequences built from handles are kept in a cache of bounded size.
+"""
+import os
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Optional, Tuple
+
+
+class SequenceHandle:
+    """
+    Reference to the sequence of a run, stored instead of the sequence in a
+    lazy dataset. See BaseDataset._materialize.
+
+    Parameters
+    ----------
+    folder : Path
+        folder the sequence was read from
+    filepath : Path
+        representative file of the sequence e.g. the reference dicom slice
+        or the BIDS sidecar
+    fingerprint : str
+        signature of the folder when the sequence was read, see
+        utils.folder_signature
+    subject_id, session_id, run_id, name : str
+        IDs of the run, the name is the sequence ID
+    state : dict
+        anything else needed to build the sequence e.g. echo times that are
+        collected from all the slices of a series
+    file_stat : tuple
+        size and modification time (ns) of filepath when the sequence was
+        read, see file_stat. Used to detect that the file has changed, with
+        a single stat of the file.
+    """
+    __slots__ = ('folder', 'filepath', 'fingerprint', 'subject_id',
+                 'session_id', 'run_id', 'name', 'state', 'file_stat')
+
+    def __init__(self, folder: Path, filepath: Path, fingerprint: str,
+                 subject_id: str, session_id: str, run_id: str, name: str,
+                 state: Optional[dict] = None,
+                 file_stat: Optional[Tuple[int, int]] = None):
+        self.folder = folder
+        self.filepath = filepath
+        self.fingerprint = fingerprint
+        self.subject_id = subject_id
+        self.session_id = session_id
+        self.run_id = run_id
+        self.name = name
+        self.state = state
+        self.file_stat = file_stat
+
+    def is_stale(self) -> bool:
+        """Checks if the file has changed since the sequence was read. A
+        missing file is not reported here, it fails to be read instead"""
+        if self.file_stat is None:
+            return False
+        current = file_stat(self.filepath)
+        return current is not None and current != self.file_stat
+
+    @property
+    def key(self):
+        """subject_id, session_id, seq_id and run_id of the run"""
+        return self.subject_id, self.session_id, self.name, self.run_id
+
+    def __eq__(self, other):
+        if not isinstance(other, SequenceHandle):
+            return NotImplemented
+        return all(getattr(self, name) == getattr(other, name)
+                   for name in self.__slots__)
+
+    def __hash__(self):
+        return hash((self.key, self.fingerprint))
+
+    def __repr__(self):
+        return f'SequenceHandle({self.name}, {self.filepath})'
+
+
+def file_stat(filepath) -> Optional[Tuple[int, int]]:
+    """Returns the size and the modification time (ns) of a file, or None
+    if it cannot be read"""
+    try:
+        stat = os.stat(filepath)
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+
+class LRUCache:
+    """
+    Cache that keeps the most recently used items, up to a maximum number.
+
+    Parameters
+    ----------
+    maxsize : int
+        maximum number of items
+    """
+
+    def __init__(self, maxsize: int):
+        if maxsize < 1:
+            raise ValueError(f'Expected a positive cache size. Got {maxsize}')
+        self.maxsize = maxsize
+        self._items = OrderedDict()
+
+    def get(self, key, default=None) -> Any:
+        """Returns an item, and marks it as the most recently used"""
+        try:
+            self._items.move_to_end(key)
+        except KeyError:
+            return default
+        return self._items[key]
+
+    def put(self, key, value):
+        """Stores an item, evicting the least recently used if full"""
+        self._items[key] = value
+        self._items.move_to_end(key)
+        if len(self._items) > self.maxsize:
+            self._items.popitem(last=False)
+
+    def pop(self, key, default=None):
+        """Removes an item"""
+        return self._items.pop(key, default)
+
+    def __len__(self):
+        return len(self._items)
@@ -0,0 +1,307 @@
+"""
+Lightweight scanner for DICOM headers in explicit VR little endian. It reads
+a single bounded buffer from each file and walks the elements of the data
+set straight from a memoryview, without creating a pydicom Dataset. Files
+that are unusual in any way e.g. implicit VR, big endian, deflated, or a
+header larger than the buffer, are left to pydicom.
+"""
+import struct
+from pathlib import Path
+from typing import Union, Optional, Iterable
+
+from pydicom.datadict import tag_for_keyword
+from pydicom.errors import InvalidDicomError
+
+#: Transfer syntaxes that can be scanned, i.e. explicit VR little endian.
+#: Compressed pixel data does not change the encoding of the header.
+SCANNABLE_TRANSFER_SYNTAXES = {
+    '1.2.840.10008.1.2.1',  # Explicit VR Little Endian
+    '1.2.840.10008.1.2.4.50',  # JPEG Baseline
+    '1.2.840.10008.1.2.4.51',  # JPEG Extended
+    '1.2.840.10008.1.2.4.57',  # JPEG Lossless
+    '1.2.840.10008.1.2.4.70',  # JPEG Lossless, first-order prediction
+    '1.2.840.10008.1.2.4.80',  # JPEG-LS Lossless
+    '1.2.840.10008.1.2.4.81',  # JPEG-LS Lossy
+    '1.2.840.10008.1.2.4.90',  # JPEG 2000 Lossless
+    '1.2.840.10008.1.2.4.91',  # JPEG 2000
+    '1.2.840.10008.1.2.5',  # RLE Lossless
+}
+
+# VRs with a 2-byte reserved field and a 4-byte length in explicit VR
+_LONG_VRS = {b'OB', b'OD', b'OF', b'OL', b'OV', b'OW', b'SQ', b'SV', b'UC',
+             b'UN', b'UR', b'UT', b'UV'}
+_TEXT_VRS = {'AE', 'AS', 'CS', 'DA', 'DS', 'DT', 'IS', 'LO', 'LT', 'PN', 'SH',
+             'ST', 'TM', 'UC', 'UI', 'UR', 'UT'}
+# text VRs that can not hold multiple values
+_SINGLE_VALUE_VRS = {'LT', 'ST', 'UR', 'UT'}
+_BINARY_VRS = {'US': 'H', 'SS': 'h', 'UL': 'I', 'SL': 'i', 'FL': 'f',
+               'FD': 'd'}
+
+_UNDEFINED_LENGTH = 0xFFFFFFFF
+_ITEM = 0xFFFEE000
+_ITEM_DELIMITER = 0xFFFEE00D
+_SEQUENCE_DELIMITER = 0xFFFEE0DD
+_TRANSFER_SYNTAX = 0x00020010
+
+_unpack_tag = struct.Struct('<HH').unpack_from
+_unpack_short = struct.Struct('<H').unpack_from
+_unpack_long = struct.Struct('<I').unpack_from
+
+
+class _Fallback(Exception):
+    """Raised when a header cannot be scanned, and pydicom must be used"""
+
+
+class ScannedElement:
+    """
+    A data element read by the scanner. Similar to pydicom's DataElement,
+    the decoded value is available as the value attribute.
+    """
+    __slots__ = ('tag', 'VR', 'value')
+
+    def __init__(self, tag, vr, value):
+        self.tag = tag
+        self.VR = vr
+        self.value = value
+
+    def __repr__(self):
+        return f'ScannedElement({self.tag:08X}, {self.VR}, {self.value!r})'
+
+
+class ScannedHeader:
+    """
+    The elements read from a dicom header by scan_header. Supports the
+    subset of the pydicom Dataset interface used while reading slices:
+    get(keyword) returns the value of an element, while get(tag) returns
+    the element itself, for a tag given as an int or a (group, element)
+    tuple.
+
+    Parameters
+    ----------
+    elements : dict
+        tag (int) to ScannedElement
+    filename : Path
+        The path to the file that was scanned
+    """
+
+    def __init__(self, elements: dict, filename: Path = None):
+        self._elements = elements
+        self.filename = filename
+
+    def get(self, key, default=None):
+        """Returns the value for a keyword, or the element for a tag"""
+        if isinstance(key, str):
+            element = self._elements.get(tag_for_keyword(key), None)
+            return default if element is None else element.value
+        if isinstance(key, tuple):
+            key = (key[0] << 16) | key[1]
+        return self._elements.get(key, default)
+
+    def __contains__(self, key):
+        return self.get(key, None) is not None
+
+    def __len__(self):
+        return len(self._elements)
+
+
+def scan_header(filename: Union[str, Path],
+                keywords: Iterable[str],
+                buffer_size: int = 32 * 1024) -> Optional[ScannedHeader]:
+    """
+    Reads the given elements from the header of a dicom file. The file is
+    read once, up to buffer_size bytes. The elements are parsed until the
+    first tag past the largest requested tag, so only the beginning of the
+    header is parsed.
+
+    Parameters
+    ----------
+    filename : str | Path
+        path to the dicom file
+    keywords : Iterable[str]
+        keywords of the elements to read e.g. SeriesInstanceUID. All the
+        elements must be in the data set, not in the file meta information.
+    buffer_size : int
+        maximum number of bytes read from the file
+
+    Returns
+    -------
+    ScannedHeader or None
+        None if the file cannot be scanned e.g. implicit VR, or the
+        requested elements are not within buffer_size bytes. Read the file
+        with pydicom instead.
+
+    Raises
+    ------
+    InvalidDicomError
+        If the file does not have the DICM prefix after the preamble
+    """
+    with open(filename, 'rb') as fp:
+        data = fp.read(buffer_size)
+    return scan_buffer(data, keywords, is_complete=len(data) < buffer_size,
+                       filename=filename)
+
+
+def scan_buffer(data: bytes,
+                keywords: Iterable[str],
+                is_complete: bool = True,
+                filename: Union[str, Path] = None) -> Optional[ScannedHeader]:
+    """
+    Reads the given elements from the beginning of a dicom file, already
+    read into memory, see scan_header.
+
+    Parameters
+    ----------
+    data : bytes
+        the first bytes of the dicom file
+    keywords : Iterable[str]
+        keywords of the elements to read e.g. SeriesInstanceUID
+    is_complete : bool
+        whether data holds the whole file. If not, the requested elements
+        must be followed by an element past the requested range, within
+        data.
+    filename : str | Path
+        path to the dicom file, used in error messages
+
+    Returns
+    -------
+    ScannedHeader or None
+        None if the header cannot be scanned, see scan_header
+    """
+    if data[128:132] != b'DICM':
+        raise InvalidDicomError(f'File is missing DICOM File Meta '
+                                f'Information header or the DICM prefix: '
+                                f'{filename}')
+    tags = {tag_for_keyword(keyword) for keyword in keywords}
+    if None in tags:
+        raise ValueError(f'Expected valid DICOM keywords. Got {keywords}')
+
+    buffer = memoryview(data)
+    try:
+        offset, transfer_syntax = _scan_file_meta(buffer, 132)
+        if transfer_syntax not in SCANNABLE_TRANSFER_SYNTAXES:
+            return None
+        elements = _scan_dataset(buffer, offset, tags, is_complete)
+    except _Fallback:
+        return None
+    finally:
+        buffer.release()
+    return ScannedHeader(elements,
+                         filename=None if filename is None else Path(filename))
+
+
+def _read_element_header(buffer, offset):
+    """Returns tag, VR, value length and the offset of the value"""
+    if offset + 8 > len(buffer):
+        raise _Fallback
+    group, elem = _unpack_tag(buffer, offset)
+    tag = (group << 16) | elem
+    if group == 0xFFFE:
+        # item and delimiters have no VR
+        return tag, None, _unpack_long(buffer, offset + 4)[0], offset + 8
+    vr = bytes(buffer[offset + 4:offset + 6])
+    if vr in _LONG_VRS:
+        if offset + 12 > len(buffer):
+            raise _Fallback
+        return tag, vr, _unpack_long(buffer, offset + 8)[0], offset + 12
+    if not vr.isalpha() or not vr.isupper():
+        # not explicit VR after all
+        raise _Fallback
+    return tag, vr, _unpack_short(buffer, offset + 6)[0], offset + 8
+
+
+def _scan_file_meta(buffer, offset):
+    """Skips the file meta information, returns the transfer syntax"""
+    transfer_syntax = None
+    while offset + 8 <= len(buffer):
+        if _unpack_short(buffer, offset)[0] != 0x0002:
+            return offset, transfer_syntax
+        tag, vr, length, offset = _read_element_header(buffer, offset)
+        if length == _UNDEFINED_LENGTH or offset + length > len(buffer):
+            raise _Fallback
+        if tag == _TRANSFER_SYNTAX:
+            transfer_syntax = _decode(buffer[offset:offset + length], 'UI')
+        offset += length
+    raise _Fallback
+
+
+def _scan_dataset(buffer, offset, tags, is_complete):
+    """Walks the top-level elements, and decodes the requested ones"""
+    elements = dict()
+    last_tag = max(tags)
+    while offset < len(buffer):
+        if offset + 8 > len(buffer) and is_complete:
+            break
+        tag, vr, length, offset = _read_element_header(buffer, offset)
+        if tag > last_tag:
+            return elements
+        if vr == b'SQ' or length == _UNDEFINED_LENGTH:
+            offset = _skip_sequence(buffer, offset, length)
+            continue
+        if offset + length > len(buffer):
+            raise _Fallback
+        if tag in tags:
+            vr = vr.decode('ascii')
+            elements[tag] = ScannedElement(
+                tag, vr, _decode(buffer[offset:offset + length], vr))
+        offset += length
+    if not is_complete:
+        # the header may continue past the buffer
+        raise _Fallback
+    return elements
+
+
+def _skip_sequence(buffer, offset, length):
+    """Returns the offset past a sequence, of defined or undefined length"""
+    if length != _UNDEFINED_LENGTH:
+        if offset + length > len(buffer):
+            raise _Fallback
+        return offset + length
+    while True:
+        tag, _, item_length, offset = _read_element_header(buffer, offset)
+        if tag == _SEQUENCE_DELIMITER:
+            return offset
+        if tag != _ITEM:
+            raise _Fallback
+        if item_length != _UNDEFINED_LENGTH:
+            offset += item_length
+            continue
+        # item of undefined length, walk its elements
+        while True:
+            tag, _, item_length, offset = _read_element_header(buffer,
+                                                               offset)
+            if tag == _ITEM_DELIMITER:
+                break
+            offset = _skip_sequence(buffer, offset, item_length)
+
+
+def _decode(value, vr):
+    """Decodes a value, the same way as pydicom for the common VRs"""
+    if vr in _BINARY_VRS:
+        fmt = _BINARY_VRS[vr]
+        size = struct.calcsize(fmt)
+        values = [v[0] for v in struct.iter_unpack(
+            '<' + fmt, value[:len(value) - len(value) % size])]
+        return values[0] if len(values) == 1 else values
+    if vr not in _TEXT_VRS:
+        return bytes(value)
+
+    try:
+        text = bytes(value).decode('ascii')
+    except UnicodeDecodeError:
+        # the character set is needed to decode the value
+        raise _Fallback
+    text = text.rstrip('\0 ')
+    if not text:
+        return None if vr in {'DS', 'IS'} else ''
+
+    values = [text] if vr in _SINGLE_VALUE_VRS else text.split('\\')
+    try:
+        if vr == 'DS':
+            values = [float(v) for v in values]
+        elif vr == 'IS':
+            values = [int(float(v)) for v in values]
+        elif vr == 'CS':
+            values = [v.strip(' ') for v in values]
+    except ValueError:
+        raise _Fallback
+    return values[0] if len(values) == 1 else values
@@ -0,0 +1,154 @@
+"""
+Sinks that write the runs yielded by iter_import to disk one at a time, so
+that a dataset can be processed without holding all of it in memory.
+"""
+import json
+import shelve
+from pathlib import Path
+from typing import Union, Iterable, Iterator, Tuple
+
+from protocol import BaseSequence, UnspecifiedType
+
+
+def sequence_to_dict(seq: BaseSequence) -> dict:
+    """
+    Returns the values of all the parameters of a sequence, keyed by the
+    parameter name. Unspecified values are returned as None.
+
+    Parameters
+    ----------
+    seq : protocol.BaseSequence
+        sequence e.g. read from a DICOM folder
+
+    Returns
+    -------
+    dict
+    """
+    params = dict()
+    for name in sorted(seq):
+        value = seq[name].get_value()
+        if isinstance(value, UnspecifiedType):
+            value = None
+        params[name] = value
+    return params
+
+
+def _to_json(value):
+    """Converts values that are not JSON serializable e.g. numpy types"""
+    if hasattr(value, 'item'):
+        return value.item()
+    if isinstance(value, (set, tuple)):
+        return list(value)
+    return str(value)
+
+
+class JsonLinesSink:
+    """
+    Writes each run as a single line of JSON, with the subject, session,
+    sequence and run identifiers, and the values of all the parameters.
+    Each line is written as soon as the run is received.
+
+    Parameters
+    ----------
+    filepath : str | Path
+        path to the JSON Lines file e.g. dataset.jsonl
+    mode : str
+        'w' to overwrite the file, or 'a' to append to it
+    """
+
+    def __init__(self, filepath: Union[str, Path], mode='w'):
+        if mode not in ('w', 'a'):
+            raise ValueError(f"Expected mode 'w' or 'a'. Got {mode}")
+        self.filepath = Path(filepath)
+        self.count = 0
+        self._fp = open(self.filepath, mode, encoding='utf-8')
+
+    def write(self, subject_id, session_id, seq_id, run_id, seq):
+        """Writes a single run"""
+        record = {
+            'subject_id': subject_id,
+            'session_id': session_id,
+            'seq_id': seq_id,
+            'run_id': run_id,
+            'path': str(getattr(seq, 'path', None)),
+            'params': sequence_to_dict(seq),
+        }
+        self._fp.write(json.dumps(record, default=_to_json) + '\n')
+        self.count += 1
+
+    def write_all(self, runs: Iterable[Tuple]) -> int:
+        """Writes all the runs e.g. from iter_import, returns the count"""
+        for run in runs:
+            self.write(*run)
+        self._fp.flush()
+        return self.count
+
+    def close(self):
+        """Closes the file"""
+        self._fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ShelveSink:
+    """
+    Stores each run in a shelve database on disk, keyed by the subject,
+    session, sequence and run identifiers. Unlike JsonLinesSink, the
+    sequences are stored as objects, and can be read back with read_shelve.
+
+    Parameters
+    ----------
+    filepath : str | Path
+        path to the shelve database
+    """
+
+    def __init__(self, filepath: Union[str, Path]):
+        self.filepath = Path(filepath)
+        self.count = 0
+        self._db = shelve.open(str(self.filepath), flag='c')
+
+    def write(self, subject_id, session_id, seq_id, run_id, seq):
+        """Writes a single run"""
+        key = json.dumps([subject_id, session_id, seq_id, run_id])
+        self._db[key] = seq
+        self.count += 1
+
+    def write_all(self, runs: Iterable[Tuple]) -> int:
+        """Writes all the runs e.g. from iter_import, returns the count"""
+        for run in runs:
+            self.write(*run)
+        self._db.sync()
+        return self.count
+
+    def close(self):
+        """Closes the database"""
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def read_shelve(filepath: Union[str, Path]) -> Iterator[Tuple]:
+    """
+    Reads back the runs stored by ShelveSink, one at a time.
+
+    Parameters
+    ----------
+    filepath : str | Path
+        path to the shelve database
+
+    Yields
+    ------
+    tuple
+        subject_id, session_id, seq_id, run_id and the sequence
+    """
+    with shelve.open(str(filepath), flag='r') as db:
+        for key in db:
+            yield (*json.loads(key), db[key])
@@ -1,3 +1,4 @@
+import shutil
 import tempfile
 import typing as tp
 from pathlib import Path
@@ -10,7 +11,7 @@ from hypothesis.strategies import SearchStrategy
 
 from MRdataset.dicom import DicomDataset
 from MRdataset.tests.simulate import make_compliant_test_dataset, \
-    make_vertical_test_dataset
+    make_vertical_test_dataset, make_echo_dataset
 
 THIS_DIR = Path(__file__).parent.resolve()
 
@@ -43,6 +44,29 @@ def derived_dicom_file(tmp_path):
     return Path(THIS_DIR / 'resources/derived.dcm').resolve()
 
 
+@pytest.fixture
+def echo_dataset(tmp_path):
+    """
+    Yields a function that simulates a dataset of multi-echo series (see
+    make_echo_dataset), and returns its folder along with the arguments of
+    import_dataset to read it. The simulated datasets are removed in
+    teardown, even if the test fails.
+    """
+    folders = list()
+
+    def make(num_subjects=3, echo_times=(30, 60)):
+        fake_ds_dir = make_echo_dataset(num_subjects=num_subjects,
+                                        echo_times=echo_times)
+        folders.append(fake_ds_dir)
+        kwargs = dict(config_path=THIS_DIR / 'resources/mri-config.json',
+                      output_dir=tmp_path, name='test_dataset')
+        return fake_ds_dir, kwargs
+
+    yield make
+    for folder in folders:
+        shutil.rmtree(folder, ignore_errors=True)
+
+
 param_strategy: tp.Final[SearchStrategy[Tuple]] = st.tuples(
     st.text(min_size=1, max_size=10),
     st.integers(min_value=2, max_value=10),
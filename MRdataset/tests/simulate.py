@@ -157,6 +157,29 @@ def make_multi_echo_dataset(num_subjects,
     return dest_dir
 
 
+def make_echo_dataset(num_subjects=2, num_slices=4,
+                      echo_times=(30,)) -> Path:
+    """Creates a dataset of multi-echo series, using valid.dcm as template"""
+    template = pydicom.dcmread(THIS_DIR / 'resources/valid.dcm')
+    dest_dir = Path(tempfile.mkdtemp()).resolve()
+    for subj in range(num_subjects):
+        study_uid = pydicom.uid.generate_uid()
+        series_uid = pydicom.uid.generate_uid()
+        for i in range(num_slices):
+            for j, echo_time in enumerate(echo_times):
+                dicom = template.copy()
+                dicom.PatientID = f'sub-{subj:02d}'
+                dicom.StudyInstanceUID = study_uid
+                dicom.SeriesInstanceUID = series_uid
+                dicom.InstanceNumber = i * len(echo_times) + j + 1
+                dicom.EchoTime = echo_time
+                dicom.EchoNumbers = j + 1
+                output_path = dest_dir / f'sub-{subj:02d}'
+                output_path.mkdir(exist_ok=True, parents=True)
+                dicom.save_as(output_path / f'{dicom.InstanceNumber:04d}.dcm')
+    return dest_dir
+
+
 def setup_directories(src):
     src_dir = Path(src).resolve()
     if not src_dir.exists():
@@ -0,0 +1,49 @@
+"""Tests for the on-disk header cache"""
+import shutil
+from pathlib import Path
+
+import MRdataset.dicom
+from MRdataset import import_dataset
+from MRdataset.cache import HeaderCache
+from MRdataset.tests.simulate import make_echo_dataset
+
+THIS_DIR = Path(__file__).parent.resolve()
+
+
+def test_header_cache(tmp_path):
+    cache = HeaderCache(tmp_path / 'cache.sqlite')
+    assert cache.get('/some/folder', 'abc') == (False, None, None)
+    cache.put('/some/folder', 'abc', {'EchoTime': 30}, True)
+    assert cache.get('/some/folder', 'abc') == (True, {'EchoTime': 30}, True)
+    # fingerprint has changed
+    assert cache.get('/some/folder', 'xyz') == (False, None, None)
+    cache.close()
+
+
+def test_import_with_cache(tmp_path, monkeypatch):
+    fake_ds_dir = make_echo_dataset(num_subjects=2, echo_times=(30, 60))
+    kwargs = dict(config_path=THIS_DIR / 'resources/mri-config.json',
+                  output_dir=tmp_path, name='test_dataset', use_cache=True)
+    mrd = import_dataset(fake_ds_dir, **kwargs)
+    assert (tmp_path / 'test_dataset_header_cache.sqlite').is_file()
+
+    def fail(*args, **kwargs):
+        raise AssertionError('cached folders must not be read again')
+
+    with monkeypatch.context() as m:
+        m.setattr(MRdataset.dicom, 'dcmread', fail)
+        mrd_cached = import_dataset(fake_ds_dir, **kwargs)
+    assert mrd == mrd_cached
+
+    # a new file in the folder invalidates the cached sequence
+    folder = fake_ds_dir / 'sub-00'
+    shutil.copy(folder / '0001.dcm', folder / '9999.dcm')
+    reads = []
+    original = MRdataset.dicom.dcmread
+    with monkeypatch.context() as m:
+        m.setattr(MRdataset.dicom, 'dcmread',
+                  lambda path, **kw: reads.append(path) or original(path, **kw))
+        mrd_updated = import_dataset(fake_ds_dir, **kwargs)
+    assert mrd == mrd_updated
+    assert reads and all(Path(path).parent == folder for path in reads)
+    shutil.rmtree(fake_ds_dir)
@@ -0,0 +1,47 @@
+"""Tests for the columnar storage of the parameters of a dataset"""
+import pickle
+
+import numpy as np
+import pytest
+
+from MRdataset import import_dataset
+
+
+@pytest.mark.parametrize('compact', [False, True])
+def test_columns(echo_dataset, compact):
+    fake_ds_dir, kwargs = echo_dataset(num_subjects=3)
+    mrd = import_dataset(fake_ds_dir, compact=compact, **kwargs)
+    with pytest.raises(ValueError):
+        mrd.columns('any')
+    mrd.enable_columns(['RepetitionTime', 'FlipAngle', 'EchoTime',
+                        'PhaseEncodingDirection'])
+
+    seq_id = mrd.get_sequence_ids()[0]
+    columns = mrd.columns(seq_id)
+    runs = list(mrd.traverse_horizontal(seq_id))
+    assert len(columns) == len(runs)
+    assert sorted(columns.rows()) == sorted(r[:3] for r in runs)
+    assert columns.values('RepetitionTime').dtype == np.float64
+
+    for name in ('RepetitionTime', 'EchoTime', 'PhaseEncodingDirection'):
+        value, count = columns.mode(name)
+        expected = [run[3][name].get_value() for run in runs]
+        if isinstance(expected[0], list):
+            expected = [tuple(v) for v in expected]
+        assert count == expected.count(value)
+        assert not columns.differs(name, runs[0][3][name]).any()
+    assert columns.differs('FlipAngle', 45).all()
+
+    # columns are kept up to date as runs are added and removed
+    subj, sess, run, seq = runs[0]
+    seq = pickle.loads(pickle.dumps(seq))
+    seq['FlipAngle']._value = 45
+    mrd.add('sub-99', sess, seq_id, run, seq)
+    assert columns.rows(columns.differs('FlipAngle', 90)) == [
+        ('sub-99', sess, run)]
+    mrd._remove_run('sub-99', sess, seq_id, run)
+    assert len(columns) == len(runs)
+    assert not columns.differs('FlipAngle', 90).any()
+
+    loaded = pickle.loads(pickle.dumps(mrd))
+    assert loaded.columns(seq_id).mode('FlipAngle') == (90.0, len(runs))
@@ -1,4 +1,5 @@
 """Tests for functions in common.py"""
+import json
 import os
 import pickle
 import shutil
@@ -6,16 +7,20 @@ from pathlib import Path
 
 # use hypothesis to generate multiple test cases
 import hypothesis.strategies as st
+import pydicom
 import pytest
 from hypothesis import given, settings, HealthCheck
 
 from MRdataset import import_dataset, save_mr_dataset, load_mr_dataset, \
-    BaseDataset
+    BaseDataset, update_dataset, iter_import, merge_shards, merge_datasets
 from MRdataset.common import find_dataset_using_ds_format
 from MRdataset.config import MRException, MRdatasetWarning, \
     DatasetEmptyException
+from MRdataset.bids import BidsDataset
 from MRdataset.dicom import DicomDataset
-from MRdataset.tests.simulate import make_compliant_test_dataset
+from MRdataset.sinks import JsonLinesSink, ShelveSink, read_shelve
+from MRdataset.tests.simulate import make_compliant_test_dataset, \
+    make_echo_dataset, make_compliant_bids_dataset
 
 THIS_DIR = Path(__file__).parent.resolve()
 
@@ -115,6 +120,185 @@ def test_load_mr_dataset():
     return
 
 
+def test_update_dataset(tmp_path):
+    """Test update_dataset after adding and removing folders"""
+    fake_ds_dir = make_echo_dataset(num_subjects=3, echo_times=(30, 60))
+    kwargs = dict(config_path=THIS_DIR / 'resources/mri-config.json',
+                  output_dir=tmp_path, name='test_dataset')
+    mrd = import_dataset(fake_ds_dir, **kwargs)
+    save_mr_dataset(tmp_path / 'test.mrds.pkl', mrd)
+
+    # nothing has changed
+    mrd2 = update_dataset(tmp_path / 'test.mrds.pkl')
+    assert mrd == mrd2
+
+    shutil.rmtree(fake_ds_dir / 'sub-01')
+    new_ds_dir = make_echo_dataset(num_subjects=1, echo_times=(40,))
+    shutil.move(str(new_ds_dir / 'sub-00'), str(fake_ds_dir / 'sub-05'))
+    mrd2 = update_dataset(tmp_path / 'test.mrds.pkl')
+
+    expected = import_dataset(fake_ds_dir, **kwargs)
+    assert mrd2 == expected
+    assert mrd2._tree_map.keys() == expected._tree_map.keys()
+    assert mrd2._seqs_map == expected._seqs_map
+    assert mrd2._sess_map == expected._sess_map
+    assert len(mrd2._manifest) == 3
+
+    # a slice rewritten in place, under the same name
+    save_mr_dataset(tmp_path / 'test.mrds.pkl', mrd2)
+    for filepath in sorted((fake_ds_dir / 'sub-05').iterdir()):
+        dicom = pydicom.dcmread(filepath)
+        dicom.EchoTime = 50
+        dicom.save_as(filepath)
+        stat = filepath.stat()
+        os.utime(filepath, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    mrd3 = update_dataset(tmp_path / 'test.mrds.pkl')
+    assert mrd3 == import_dataset(fake_ds_dir, **kwargs)
+    assert mrd3 != mrd2
+
+    # options that change the runs read, or how they are stored
+    for option in [dict(shard=(0, 2)), dict(compact=True), dict(lazy=True)]:
+        with pytest.raises(ValueError):
+            update_dataset(mrd3, **option)
+    assert mrd3.is_complete and mrd3.shard is None and not mrd3.compact
+    # options that change how the files are read take effect
+    header_cache = tmp_path / 'test_dataset_header_cache.sqlite'
+    assert not header_cache.exists()
+    new_ds_dir = make_echo_dataset(num_subjects=1, echo_times=(40,))
+    shutil.move(str(new_ds_dir / 'sub-00'), str(fake_ds_dir / 'sub-06'))
+    mrd4 = update_dataset(mrd3, use_cache=True, fast_read=True)
+    assert mrd4 == import_dataset(fake_ds_dir, **kwargs)
+    assert mrd4.use_cache and mrd4.fast_read and header_cache.is_file()
+    shutil.rmtree(fake_ds_dir)
+
+
+def test_dicom_only_options(tmp_path, monkeypatch):
+    """Test DICOM-only options are not passed to BIDS datasets"""
+    fake_ds_dir = make_compliant_bids_dataset(2, 2.0, 10, 90.0)
+    kwargs = dict(ds_format='bids', output_dir=tmp_path, name='test_dataset',
+                  config_path=THIS_DIR / 'resources/bids-config.json')
+    mrd = import_dataset(fake_ds_dir, **kwargs)
+    warnings = list()
+    monkeypatch.setattr('MRdataset.common.logger.warning', warnings.append)
+    received = list()
+    original = BidsDataset.__init__
+    monkeypatch.setattr(BidsDataset, '__init__',
+                        lambda self, *args, **kw: received.append(kw)
+                        or original(self, *args, **kw))
+
+    assert import_dataset(fake_ds_dir, n_jobs=4, fast_read=True,
+                          prefetch=2, **kwargs) == mrd
+    assert len(warnings) == 1
+    assert 'n_jobs, fast_read, prefetch' in warnings[0]
+    assert not set(received[0]) & {'n_jobs', 'fast_read', 'prefetch',
+                                   'executor', 'use_cache'}
+    # the defaults of the options are not reported
+    warnings.clear()
+    import_dataset(fake_ds_dir, **kwargs)
+    save_mr_dataset(tmp_path / 'test.mrds.pkl', mrd)
+    update_dataset(tmp_path / 'test.mrds.pkl', walk_threads=2, n_jobs=1)
+    assert not warnings
+    shutil.rmtree(fake_ds_dir)
+
+
+def test_iter_import(tmp_path):
+    """Test iter_import yields the same runs as import_dataset"""
+    fake_ds_dir = make_echo_dataset(num_subjects=3, echo_times=(30, 60))
+    kwargs = dict(config_path=THIS_DIR / 'resources/mri-config.json',
+                  output_dir=tmp_path, name='test_dataset')
+    mrd = import_dataset(fake_ds_dir, **kwargs)
+    runs = list(iter_import(fake_ds_dir, **kwargs))
+    assert {run[:4] for run in runs} == set(mrd._flat_map)
+    for *key, seq in runs:
+        assert seq == mrd._flat_map[tuple(key)]
+
+    with JsonLinesSink(tmp_path / 'test.jsonl') as sink:
+        assert sink.write_all(iter_import(fake_ds_dir, **kwargs)) == 3
+    lines = (tmp_path / 'test.jsonl').read_text().splitlines()
+    assert len(lines) == 3
+    record = json.loads(lines[0])
+    assert record['subject_id'] in mrd.subjects()
+    assert record['params']['EchoTime'] == [30, 60]
+
+    with ShelveSink(tmp_path / 'test.shelf') as sink:
+        sink.write_all(runs)
+    stored = {tuple(key): seq
+              for *key, seq in read_shelve(tmp_path / 'test.shelf')}
+    assert stored == mrd._flat_map
+    shutil.rmtree(fake_ds_dir)
+
+
+def test_merge_shards(tmp_path):
+    """Test sharded imports merge back into the complete dataset"""
+    fake_ds_dir = make_echo_dataset(num_subjects=6, echo_times=(30, 60))
+    kwargs = dict(config_path=THIS_DIR / 'resources/mri-config.json',
+                  output_dir=tmp_path, name='test_dataset')
+    mrd = import_dataset(fake_ds_dir, **kwargs)
+    for shard_by in ['folder', 'subject']:
+        shards = [import_dataset(fake_ds_dir, shard=(i, 3),
+                                 shard_by=shard_by, **kwargs)
+                  for i in range(3)]
+        assert all(not shard.is_complete for shard in shards)
+        assert sum(len(shard._flat_map) for shard in shards) == \
+               len(mrd._flat_map)
+
+        save_mr_dataset(tmp_path / 'shard.mrds.pkl', shards[1])
+        merged = merge_shards([shards[2], tmp_path / 'shard.mrds.pkl',
+                               shards[0]])
+        assert merged == mrd
+        assert merged.is_complete and merged.shard is None
+        assert len(merged._manifest) == len(mrd._manifest)
+
+    with pytest.raises(ValueError):
+        merge_shards(shards[:2])
+    with pytest.raises(ValueError):
+        merge_shards([shards[0], shards[0], shards[1]])
+    with pytest.raises(ValueError):
+        merge_shards([mrd])
+    partial = merge_shards(shards[:2], allow_partial=True)
+    assert not partial.is_complete
+    with pytest.raises(ValueError):
+        import_dataset(fake_ds_dir, shard=(3, 3), **kwargs)
+    shutil.rmtree(fake_ds_dir)
+
+
+def test_merge_datasets(tmp_path):
+    """Test merging many datasets"""
+    fake_ds_dir = make_echo_dataset(num_subjects=6, echo_times=(30, 60))
+    kwargs = dict(config_path=THIS_DIR / 'resources/mri-config.json',
+                  output_dir=tmp_path, name='test_dataset')
+    mrd = import_dataset(fake_ds_dir, **kwargs)
+    parts = [import_dataset(fake_ds_dir, shard=(i, 5), **kwargs)
+             for i in range(5)]
+    save_mr_dataset(tmp_path / 'part.mrds.pkl', parts[0])
+    paths = [tmp_path / 'part.mrds.pkl'] + parts[1:]
+
+    merged, conflicts = merge_datasets(paths)
+    assert merged == mrd and not conflicts
+    assert merged._tree_map == mrd._tree_map
+    assert merged._seqs_map == mrd._seqs_map
+    assert merged._sess_map == mrd._sess_map
+    # the shard of the first dataset is not inherited
+    assert merged.shard is None and not merged.is_complete
+    merged, _ = merge_datasets([mrd, parts[1]])
+    assert merged.shard is None and not merged.is_complete
+    merged, _ = merge_datasets([mrd, mrd])
+    assert merged.is_complete
+    # inputs are not modified
+    assert sum(len(part._flat_map) for part in parts[1:]) < len(mrd._flat_map)
+
+    # the same runs, with a different flip angle for one subject
+    for dcm_path in (fake_ds_dir / 'sub-01').glob('*.dcm'):
+        dicom = pydicom.dcmread(dcm_path)
+        dicom.FlipAngle = 45
+        dicom.save_as(dcm_path)
+    changed = import_dataset(fake_ds_dir, **kwargs)
+    merged, conflicts = merge_datasets([mrd, changed])
+    assert merged == mrd
+    assert [key[0] for key in conflicts] == ['sub-01']
+    shutil.rmtree(fake_ds_dir)
+
+
 # Test MRException
 def test_mrexception():
     with pytest.raises(MRException) as exc_info:
@@ -0,0 +1,60 @@
+"""Tests for the compact storage of datasets"""
+import pickle
+import shutil
+
+import pytest
+
+from MRdataset import import_dataset, merge_datasets
+from MRdataset.compact import CompactIndex
+
+
+def test_compact_dataset(echo_dataset):
+    fake_ds_dir, kwargs = echo_dataset(num_subjects=3)
+    mrd = import_dataset(fake_ds_dir, **kwargs)
+    compact = import_dataset(fake_ds_dir, compact=True, **kwargs)
+    assert isinstance(compact._index, CompactIndex)
+    assert mrd == compact and compact == mrd
+    assert str(mrd) == str(compact)
+    assert compact.subjects() == mrd.subjects()
+    assert compact.get_sequence_ids() == mrd.get_sequence_ids()
+
+    for seq_id in mrd.get_sequence_ids():
+        assert (sorted(compact.traverse_horizontal(seq_id)) ==
+                sorted(mrd.traverse_horizontal(seq_id)))
+        assert compact._seqs_map[seq_id] == mrd._seqs_map[seq_id]
+        for subj, sess, run, seq in mrd.traverse_horizontal(seq_id):
+            assert compact.get(subj, sess, seq_id, run) is not None
+            assert compact[subj] == mrd[subj]
+            assert compact._sess_map[sess] == mrd._sess_map[sess]
+    assert compact.get('sub-99', 'ses', 'seq', 'run') is None
+
+    # the views share the index once unpickled
+    loaded = pickle.loads(pickle.dumps(compact))
+    assert loaded == mrd
+    loaded.add('sub-99', 'ses', 'seq', 'run', next(iter(mrd._flat_map.values())))
+    assert 'sub-99' in loaded.subjects() and 'sub-99' not in compact.subjects()
+
+    # changes to the branch of a subject would not reach the index
+    subj, sess, seq_id, run = next(iter(mrd._flat_map))
+    with pytest.raises(TypeError):
+        compact[subj][sess][seq_id][run] = None
+    with pytest.raises(TypeError):
+        compact[subj][sess] = dict()
+
+    # the sessions of each sequence are cached until the runs change
+    sessions = compact._sess_map[sess]
+    assert compact._sess_map[sess] is sessions
+    compact.add(subj, sess, 'new-seq', run, mrd.get(subj, sess, seq_id, run))
+    assert compact._sess_map[sess] == sessions | {'new-seq'}
+    compact.remove(subj, sess, 'new-seq', run)
+    assert compact._sess_map[sess] == sessions
+
+    # runs are removed when their folder is removed
+    shutil.rmtree(fake_ds_dir / 'sub-01')
+    compact.update()
+    assert compact.subjects() == ['sub-00', 'sub-02']
+    assert 'sub-01' not in compact._subj_ids
+
+    merged, conflicts = merge_datasets([compact, mrd])
+    assert merged == mrd and not conflicts
+    assert merged._index is not None
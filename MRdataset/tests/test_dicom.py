@@ -2,17 +2,23 @@
 
 """Tests for `MRdataset` package."""
 
+import json
 import shutil
 import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+import MRdataset.dicom
 import hypothesis.strategies as st
+import pydicom
 import pytest
 from hypothesis import given, settings, HealthCheck
 
 from MRdataset import import_dataset
+from MRdataset.dicom import DicomDataset
+from MRdataset.utils import read_json, scan_terminal_folders
 from MRdataset.tests.simulate import make_compliant_test_dataset, \
-    make_multi_echo_dataset
+    make_multi_echo_dataset, make_echo_dataset
 
 THIS_DIR = Path(__file__).parent.resolve()
 
@@ -106,6 +112,304 @@ def test_invalid_output_dir():
                        output_dir=1, name='test_dataset',
                        ds_format='dicom')
 
+
+def test_parallel_load():
+    fake_ds_dir = make_echo_dataset(num_subjects=3, echo_times=(30, 60))
+    kwargs = dict(config_path=THIS_DIR / 'resources/mri-config.json',
+                  output_dir=fake_ds_dir, name='test_dataset')
+    mrd = import_dataset(fake_ds_dir, **kwargs)
+    assert len(mrd.subjects()) == 3
+
+    mrd_jobs = import_dataset(fake_ds_dir, n_jobs=2, **kwargs)
+    assert mrd == mrd_jobs
+    assert mrd._process_whole_folder == mrd_jobs._process_whole_folder
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        mrd_executor = import_dataset(fake_ds_dir, executor=executor,
+                                      **kwargs)
+    assert mrd == mrd_executor
+    with pytest.raises(ValueError):
+        import_dataset(fake_ds_dir, n_jobs=0, **kwargs)
+    shutil.rmtree(fake_ds_dir)
+
+
+def test_parallel_load_is_bounded(monkeypatch):
+    fake_ds_dir = make_echo_dataset(num_subjects=6)
+    pulled = []
+
+    def folders():
+        for folder, files in scan_terminal_folders(fake_ds_dir, '*'):
+            pulled.append(folder)
+            yield folder, files
+
+    monkeypatch.setattr(MRdataset.dicom.os, 'cpu_count', lambda: 1)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        reader = DicomDataset(fake_ds_dir, executor=executor,
+                              config_path=THIS_DIR / 'resources/mri-config.json',
+                              output_dir=fake_ds_dir, name='test_dataset')
+        results = reader._process_folders(folders())
+        # folders are submitted as the results are consumed
+        assert next(results)[0] == fake_ds_dir / 'sub-00'
+        assert len(pulled) == 2
+        assert len(list(results)) == 5
+    shutil.rmtree(fake_ds_dir)
+
+
+def test_fast_read(monkeypatch):
+    fake_ds_dir = make_echo_dataset(num_subjects=2, echo_times=(30, 60, 90))
+    kwargs = dict(config_path=THIS_DIR / 'resources/mri-config.json',
+                  output_dir=fake_ds_dir, name='test_dataset')
+    mrd = import_dataset(fake_ds_dir, **kwargs)
+
+    reads = []
+    original = MRdataset.dicom.dcmread
+    with monkeypatch.context() as m:
+        m.setattr(MRdataset.dicom, 'dcmread',
+                  lambda path, **kw: reads.append(path) or original(path, **kw))
+        mrd_fast = import_dataset(fake_ds_dir, fast_read=True, **kwargs)
+    # only the reference slices are read with pydicom, the others are
+    #   scanned
+    assert len(reads) == 2
+    assert mrd == mrd_fast
+    for seq_id in mrd.get_sequence_ids():
+        for run_a, run_b in zip(mrd.traverse_horizontal(seq_id),
+                                mrd_fast.traverse_horizontal(seq_id)):
+            assert run_a == run_b
+            assert run_b[-1]['EchoTime'].get_value() == [30, 60, 90]
+            assert run_b[-1].slice_signatures == {
+                (30.0, 1.0): 4, (60.0, 2.0): 4, (90.0, 3.0): 4}
+    shutil.rmtree(fake_ds_dir)
+
+
+def test_prefetch():
+    fake_ds_dir = make_echo_dataset(num_subjects=2, echo_times=(30, 60))
+    kwargs = dict(config_path=THIS_DIR / 'resources/mri-config.json',
+                  output_dir=fake_ds_dir, name='test_dataset')
+    mrd = import_dataset(fake_ds_dir, **kwargs)
+    mrd_prefetch = import_dataset(fake_ds_dir, prefetch=4, **kwargs)
+    assert mrd == mrd_prefetch
+    # a buffer too small to scan, falls back to pydicom
+    mrd_fast = import_dataset(fake_ds_dir, prefetch=4, prefetch_size=256,
+                              fast_read=True, **kwargs)
+    assert mrd == mrd_fast
+    shutil.rmtree(fake_ds_dir)
+
+
+def test_prefetch_whole_file(monkeypatch):
+    fake_ds_dir = make_echo_dataset(num_subjects=2, echo_times=(30, 60))
+    kwargs = dict(config_path=THIS_DIR / 'resources/mri-config.json',
+                  output_dir=fake_ds_dir, name='test_dataset')
+    mrd = import_dataset(fake_ds_dir, **kwargs)
+
+    opened = list()
+
+    def spy(fp, *args, **kw):
+        opened.append(fp)
+        return pydicom.dcmread(fp, *args, **kw)
+
+    monkeypatch.setattr('MRdataset.dicom.dcmread', spy)
+    # the slices fit in the prefetched buffer, they are parsed from it
+    mrd_prefetch = import_dataset(fake_ds_dir, prefetch=4, **kwargs)
+    assert mrd == mrd_prefetch
+    assert opened and not any(isinstance(fp, Path) for fp in opened)
+
+    # the slices are larger than the buffer, but their headers fit in it
+    opened.clear()
+    mrd_prefetch = import_dataset(fake_ds_dir, prefetch=4,
+                                  prefetch_size=16 * 1024, **kwargs)
+    assert mrd == mrd_prefetch
+    assert opened and not any(isinstance(fp, Path) for fp in opened)
+    # the headers are cut short, each file is read again
+    opened.clear()
+    mrd_prefetch = import_dataset(fake_ds_dir, prefetch=4,
+                                  prefetch_size=4 * 1024, **kwargs)
+    assert mrd == mrd_prefetch
+    assert sorted(fp for fp in opened if isinstance(fp, Path)) == sorted(
+        fake_ds_dir.glob('*/*.dcm'))
+    shutil.rmtree(fake_ds_dir)
+
+
+def test_mixed_series_folder():
+    fake_ds_dir = make_echo_dataset(num_subjects=1, echo_times=(30, 60))
+    folder = fake_ds_dir / 'sub-00'
+    # add another series to the same folder
+    series_uid = pydicom.uid.generate_uid()
+    for dcm_path in sorted(folder.glob('*.dcm')):
+        dicom = pydicom.dcmread(dcm_path)
+        dicom.SeriesInstanceUID = series_uid
+        dicom.SeriesDescription = 'anat_T1w'
+        dicom.save_as(folder / f'T1w_{dcm_path.name}')
+
+    mrd = import_dataset(fake_ds_dir,
+                         config_path=THIS_DIR / 'resources/mri-config.json',
+                         output_dir=fake_ds_dir, name='test_dataset')
+    assert len(mrd.get_sequence_ids()) == 2
+    assert 'anat_T1w' in mrd.get_sequence_ids()
+    for seq_id in mrd.get_sequence_ids():
+        runs = list(mrd.traverse_horizontal(seq_id))
+        assert len(runs) == 1
+        assert runs[0][-1]['EchoTime'].get_value() == [30, 60]
+    shutil.rmtree(fake_ds_dir)
+
+
+def test_rejected_series_skipped(monkeypatch):
+    fake_ds_dir = make_echo_dataset(num_subjects=2, num_slices=5)
+    # flag all slices of one subject as motion corrected
+    folder = fake_ds_dir / 'sub-01'
+    for dcm_path in folder.glob('*.dcm'):
+        dicom = pydicom.dcmread(dcm_path)
+        dicom.ImageType = ['ORIGINAL', 'PRIMARY', 'M', 'MOCO']
+        dicom.save_as(dcm_path)
+    kwargs = dict(config_path=THIS_DIR / 'resources/mri-config.json',
+                  output_dir=fake_ds_dir, name='test_dataset')
+
+    reads = []
+    original = MRdataset.dicom.dcmread
+    with monkeypatch.context() as m:
+        m.setattr(MRdataset.dicom, 'dcmread',
+                  lambda path, **kw: reads.append((path, kw)) or original(
+                      path, **kw))
+        mrd = import_dataset(fake_ds_dir, **kwargs)
+    assert list(mrd.subjects()) == ['sub-00']
+    # only the first slice is parsed, the series is decided from its
+    #   header and the other slices are skipped after a scan of a few tags
+    assert len([path for path, kw in reads if path.parent == folder]) == 1
+    assert mrd._rejected_folders[str(folder)] == ['MOCO']
+
+    # the rejected folder is skipped on the next run
+    mrd.save_process_log()
+    reads.clear()
+    with monkeypatch.context() as m:
+        m.setattr(MRdataset.dicom, 'dcmread',
+                  lambda path, **kw: reads.append((path, kw)) or original(
+                      path, **kw))
+        mrd_rerun = import_dataset(fake_ds_dir, **kwargs)
+    assert mrd == mrd_rerun
+    assert not [path for path, kw in reads if path.parent == folder]
+
+    # logs that kept the reasons in place of the status are migrated
+    log = read_json(fake_ds_dir / 'test_dataset_previous_run_log.json')
+    log[str(folder)] = ['MOCO']
+    with open(fake_ds_dir / 'test_dataset_previous_run_log.json', 'w') as f:
+        json.dump(log, f)
+    (fake_ds_dir / 'test_dataset_rejected_folders.json').unlink()
+    mrd_migrated = import_dataset(fake_ds_dir, **kwargs)
+    assert mrd_migrated._rejected_folders == {str(folder): ['MOCO']}
+    assert all(isinstance(status, bool)
+               for status in mrd_migrated._process_whole_folder.values())
+    shutil.rmtree(fake_ds_dir)
+
+
+@pytest.mark.parametrize('fast_read', [False, True])
+def test_mixed_folder_reads_each_slice_once(monkeypatch, fast_read):
+    fake_ds_dir = make_echo_dataset(num_subjects=1, num_slices=4)
+    folder = fake_ds_dir / 'sub-00'
+    # a rejected series, read before the accepted one
+    series_uid = pydicom.uid.generate_uid()
+    for dcm_path in sorted(folder.glob('*.dcm')):
+        dicom = pydicom.dcmread(dcm_path)
+        dicom.SeriesInstanceUID = series_uid
+        dicom.ImageType = ['ORIGINAL', 'PRIMARY', 'M', 'MOCO']
+        dicom.save_as(folder / f'0_{dcm_path.name}')
+        dcm_path.rename(folder / f'1_{dcm_path.name}')
+    # a slice of the accepted series that is not a valid imaging dicom
+    invalid = folder / '1_0004.dcm'
+    dicom = pydicom.dcmread(invalid)
+    del dicom.ImagePositionPatient
+    dicom.EchoTime = 90
+    dicom.save_as(invalid)
+
+    reads = []
+    original = MRdataset.dicom.dcmread
+    monkeypatch.setattr(MRdataset.dicom, 'dcmread',
+                        lambda path, **kw: reads.append(path) or original(
+                            path, **kw))
+    mrd = import_dataset(fake_ds_dir, fast_read=fast_read,
+                         config_path=THIS_DIR / 'resources/mri-config.json',
+                         output_dir=fake_ds_dir, name='test_dataset')
+    (_, _, _, seq), = mrd.traverse_horizontal(mrd.get_sequence_ids()[0])
+    # the invalid slice is rejected on its own
+    assert seq['EchoTime'].get_value() == 30
+    assert sum(seq.slice_signatures.values()) == 3
+    # the rejected series is decided from its first slice, the others are
+    #   not parsed with pydicom
+    assert [path.name for path in reads
+            if path.name.startswith('0_')] == ['0_0001.dcm']
+    if not fast_read:
+        # no slice of the accepted series is read twice
+        accepted = [path for path in reads if not path.name.startswith('0_')]
+        assert sorted(accepted) == sorted(set(accepted))
+    shutil.rmtree(fake_ds_dir)
+
+
+def test_sampling_patience(monkeypatch):
+    fake_ds_dir = make_echo_dataset(num_subjects=1, num_slices=30,
+                                    echo_times=(30, 60))
+    kwargs = dict(config_path=THIS_DIR / 'resources/mri-config.json',
+                  output_dir=fake_ds_dir, name='test_dataset')
+    mrd = import_dataset(fake_ds_dir, **kwargs)
+
+    reads = []
+    original = MRdataset.dicom.dcmread
+    with monkeypatch.context() as m:
+        m.setattr(MRdataset.dicom, 'dcmread',
+                  lambda path, **kw: reads.append(path) or original(path, **kw))
+        mrd_sampled = import_dataset(fake_ds_dir, sampling_patience=5,
+                                     **kwargs)
+    assert mrd == mrd_sampled
+    assert len(reads) < 60
+
+    with pytest.raises(ValueError):
+        import_dataset(fake_ds_dir, sampling_patience=0, **kwargs)
+    shutil.rmtree(fake_ds_dir)
+
+
+def test_session_filters(tmp_path, monkeypatch):
+    fake_ds_dir = make_echo_dataset(num_subjects=3, num_slices=5)
+    # a series of an excluded subject, in the folder of another subject
+    for path in sorted((fake_ds_dir / 'sub-01').glob('*.dcm')):
+        shutil.copy(path, fake_ds_dir / 'sub-02' / f'0_{path.name}')
+    config = read_json(THIS_DIR / 'resources/mri-config.json')
+    config['exclude_subjects'] = ['sub-01']
+    (tmp_path / 'config.json').write_text(json.dumps(config))
+    kwargs = dict(config_path=tmp_path / 'config.json',
+                  output_dir=tmp_path, name='test_dataset')
+
+    # the series are screened, not the folders
+    reads = []
+    original = MRdataset.dicom.dcmread
+    with monkeypatch.context() as m:
+        m.setattr(MRdataset.dicom, 'dcmread',
+                  lambda path, **kw: reads.append(path) or original(
+                      path, **kw))
+        mrd = import_dataset(fake_ds_dir, **kwargs)
+    assert sorted(mrd.subjects()) == ['sub-00', 'sub-02']
+    # only the first slice of an excluded series is parsed
+    assert len([path for path in reads if path.parent.name == 'sub-01']) == 1
+    assert [path.name for path in reads
+            if path.name.startswith('0_')] == ['0_0001.dcm']
+
+    # the filters are part of the signature of the folders, so the series
+    #   screened out are read again once the filters change
+    mrd.exclude_subjects = set()
+    summary = mrd.update()
+    assert len(summary['changed']) == 3
+    assert sorted(mrd.subjects()) == ['sub-00', 'sub-01', 'sub-02']
+
+    # the default config does not screen any series
+    mrd = import_dataset(fake_ds_dir, output_dir=tmp_path,
+                         name='test_dataset')
+    assert sorted(mrd.subjects()) == ['sub-00', 'sub-01', 'sub-02']
+
+    # all the studies are before the end date
+    config['exclude_subjects'] = []
+    config['end'] = '2014-01-01'
+    (tmp_path / 'config.json').write_text(json.dumps(config))
+    mrd = import_dataset(fake_ds_dir, **kwargs)
+    assert not list(mrd.subjects())
+    shutil.rmtree(fake_ds_dir)
+
+
 # def get_csa_props_test():
 #     "CSA header looks funny in Pitt 7T (20221130)"
 #     text = "blah = 0x1\nxy\nsAdjData.uiAdjShimMode                = 0x1\na = b"
@@ -0,0 +1,60 @@
+"""Tests for the deduplication of the parameters of the runs of a dataset"""
+import pickle
+
+import pytest
+
+from MRdataset import import_dataset
+
+
+@pytest.mark.parametrize('compact', [False, True])
+def test_dedup(echo_dataset, compact):
+    fake_ds_dir, kwargs = echo_dataset(num_subjects=4)
+    mrd = import_dataset(fake_ds_dir, **kwargs)
+    dedup = import_dataset(fake_ds_dir, dedup=True, compact=compact,
+                           **kwargs)
+    assert dedup == mrd and mrd == dedup
+    assert len(pickle.dumps(dedup)) < len(pickle.dumps(mrd))
+
+    seq_id = mrd.get_sequence_ids()[0]
+    keys = sorted(dedup._flat_map)
+    first, second = dedup.get(*keys[0]), dedup.get(*keys[1])
+    # parameters of the protocol are shared, run specific ones are not
+    assert first['EchoTime'] is second['EchoTime']
+    assert first['ContentTime'] is not second['ContentTime']
+    assert dedup.count_protocols(seq_id) == mrd.count_protocols(seq_id) == 1
+    assert dedup.count_protocols('no-such-sequence') == 0
+
+    # the sharing is kept when pickled
+    loaded = pickle.loads(pickle.dumps(dedup))
+    first, second = loaded.get(*keys[0]), loaded.get(*keys[1])
+    assert first['EchoTime'] is second['EchoTime']
+    assert loaded == mrd and loaded.count_protocols(seq_id) == 1
+
+    # a run with a different protocol is counted, until replaced
+    seq = pickle.loads(pickle.dumps(mrd.get(*keys[0])))
+    seq['FlipAngle']._value = 45
+    previous = dedup.replace(*keys[0], seq)
+    assert dedup.count_protocols(seq_id) == mrd.count_protocols(seq_id) + 1
+    assert dedup.get(*keys[1])['FlipAngle'].get_value() == 90
+    dedup.replace(*keys[0], previous)
+    assert dedup.count_protocols(seq_id) == 1
+    dedup.remove_subject(keys[0][0])
+    assert dedup.count_protocols(seq_id) == 1
+    shared = len(dedup._pool)
+    for key in keys[1:]:
+        dedup.remove(*key)
+    assert dedup.count_protocols(seq_id) == 0
+    # the parameters are released along with the last run using them
+    assert shared and not len(dedup._pool)
+
+
+def test_dedup_lazy(echo_dataset):
+    fake_ds_dir, kwargs = echo_dataset(num_subjects=4)
+    mrd = import_dataset(fake_ds_dir, **kwargs)
+    lazy = import_dataset(fake_ds_dir, dedup=True, lazy=True, **kwargs)
+    assert lazy == mrd
+    # the protocols are counted, but the sequences built for a while are
+    #   not interned
+    seq_id = mrd.get_sequence_ids()[0]
+    assert lazy.count_protocols(seq_id) == 1
+    assert not len(lazy._pool)
@@ -0,0 +1,206 @@
+"""Tests for the indexes of a dataset, and the queries answered by them"""
+import pickle
+
+import pytest
+
+from MRdataset import import_dataset
+
+
+@pytest.mark.parametrize('compact', [False, True])
+def test_find(echo_dataset, compact):
+    fake_ds_dir, kwargs = echo_dataset(num_subjects=3)
+    mrd = import_dataset(fake_ds_dir, compact=compact, **kwargs)
+    seq_id = mrd.get_sequence_ids()[0]
+    everything = {(subj, sess, seq_id, run)
+                  for subj, sess, run, _ in mrd.traverse_horizontal(seq_id)}
+    # without indexes, the runs are checked one at a time
+    unindexed = mrd.find(seq_id, FlipAngle=90, EchoTime=[30, 60])
+    assert unindexed == everything
+
+    mrd.enable_index(['FlipAngle', 'EchoTime', 'RepetitionTime'])
+    assert mrd.find(seq_id, FlipAngle=90, EchoTime=[30, 60]) == everything
+    assert mrd.find(seq_id, FlipAngle=90, PhaseEncodingDirection='COL') \
+        == everything
+    assert mrd.find(seq_id, FlipAngle=slice(80, 100)) == everything
+    assert mrd.find(seq_id, RepetitionTime=slice(None, 2000.001)) \
+        == everything
+    assert not mrd.find(seq_id, FlipAngle=slice(91, None))
+    assert not mrd.find(seq_id, FlipAngle=45)
+    assert not mrd.find('no-such-sequence', FlipAngle=90)
+
+    # indexes are kept up to date as runs are added and removed
+    subj, sess, run, seq = next(mrd.traverse_horizontal(seq_id))
+    seq = pickle.loads(pickle.dumps(seq))
+    seq['FlipAngle']._value = 45
+    mrd.add('sub-99', sess, seq_id, run, seq)
+    assert mrd.find(seq_id, FlipAngle=slice(None, 50)) == {
+        ('sub-99', sess, seq_id, run)}
+    mrd._remove_run('sub-99', sess, seq_id, run)
+    assert not mrd.find(seq_id, FlipAngle=45)
+
+    loaded = pickle.loads(pickle.dumps(mrd))
+    assert loaded.find(seq_id, FlipAngle=90) == everything
+
+
+@pytest.mark.parametrize('compact', [False, True])
+def test_indexed_traversal(echo_dataset, compact):
+    fake_ds_dir, kwargs = echo_dataset(num_subjects=4)
+    mrd = import_dataset(fake_ds_dir, compact=compact, **kwargs)
+    seq_id = mrd.get_sequence_ids()[0]
+    runs = sorted(mrd.traverse_horizontal(seq_id), key=lambda r: r[:3])
+    assert list(mrd.traverse_horizontal(seq_id, sort=True)) == runs
+    assert list(mrd.traverse_horizontal(seq_id, sort=True, offset=1,
+                                        limit=2)) == runs[1:3]
+    assert not list(mrd.traverse_horizontal('no-such-sequence'))
+    with pytest.raises(ValueError):
+        list(mrd.traverse_horizontal(seq_id, offset=-1))
+
+    # a rare sequence, present in two sessions only
+    for subj, sess, run, seq in runs[:2]:
+        mrd.add(subj, sess, 'rare', run + '.rare', seq)
+    pairs = list(mrd.traverse_vertical2(seq_id, 'rare', sort=True))
+    assert [pair[:4] for pair in pairs] == [
+        (subj, sess, run, run + '.rare') for subj, sess, run, _ in runs[:2]]
+    sessions = list(mrd.traverse_vertical_multi(seq_id, 'rare', sort=True))
+    assert [(subj, sess) for subj, sess, _, _ in sessions] == [
+        run[:2] for run in runs[:2]]
+    assert list(mrd.traverse_vertical_multi(seq_id, 'rare', sort=True,
+                                            offset=1)) == sessions[1:]
+    assert not list(mrd.traverse_vertical_multi(seq_id, 'no-such-sequence'))
+
+
+@pytest.mark.parametrize('compact', [False, True])
+def test_add_many(echo_dataset, compact):
+    fake_ds_dir, kwargs = echo_dataset(num_subjects=3)
+    mrd = import_dataset(fake_ds_dir, compact=compact, **kwargs)
+    records = [(*key, seq) for key, seq in mrd._flat_map.items()]
+    seq = records[0][-1]
+    records += [('sub-99', 'ses-01', 'rare', 'run-01', seq),
+                ('sub-99', 'ses-01', 'rare', 'run-01', seq)]
+
+    one_by_one, bulk = mrd._empty_copy(), mrd._empty_copy()
+    for record in records:
+        one_by_one.add(*record)
+    assert bulk.add_many(records) == len(records) - 1
+    assert bulk.add_many(records) == 0
+    for name in ('_flat_map', '_tree_map', '_seqs_map', '_sess_map'):
+        assert dict(getattr(bulk, name)) == dict(getattr(one_by_one, name))
+    assert set(bulk._subj_ids) == set(one_by_one._subj_ids)
+    assert set(bulk._seq_ids) == set(one_by_one._seq_ids)
+
+    # nothing is added if any record is invalid
+    with pytest.raises(TypeError):
+        bulk.add_many([('sub-98', 'ses-01', 'rare', 'run-01', seq),
+                       ('sub-98', 'ses-01', 'rare', 'run-02', 'not-a-seq')])
+    assert 'sub-98' not in bulk.subjects()
+
+    # the maps are rebuilt from _flat_map when unpickled
+    loaded = pickle.loads(pickle.dumps(bulk))
+    for name in ('_tree_map', '_seqs_map', '_sess_map'):
+        assert dict(getattr(loaded, name)) == dict(getattr(bulk, name))
+    assert loaded.subjects() == bulk.subjects()
+    assert loaded.get_sequence_ids() == bulk.get_sequence_ids()
+
+
+@pytest.mark.parametrize('compact, lazy', [(False, False), (True, False),
+                                           (False, True), (True, True)])
+def test_content_hashes(echo_dataset, compact, lazy):
+    fake_ds_dir, kwargs = echo_dataset(num_subjects=3)
+    old = import_dataset(fake_ds_dir, compact=compact, lazy=lazy, **kwargs)
+    new = import_dataset(fake_ds_dir, **kwargs)
+    assert old.content_hash() == new.content_hash()
+    assert new.diff(old) == {'added': [], 'removed': [], 'changed': []}
+    old.enable_hashes()
+    new.enable_hashes()
+    assert old == new
+
+    removed = sorted(new._flat_map)[0]
+    subj, sess, seq_id, run = removed
+    seq = pickle.loads(pickle.dumps(new._flat_map[removed]))
+    new._remove_run(*removed)
+    new.add('sub-99', sess, seq_id, run, seq)
+    changed = sorted(new._flat_map)[0]
+    changed_seq = pickle.loads(pickle.dumps(new._flat_map[changed]))
+    changed_seq['FlipAngle']._value = 45
+    new._remove_run(*changed)
+    new.add(*changed, changed_seq)
+    assert new != old
+    assert new.diff(old) == {'added': [('sub-99', sess, seq_id, run)],
+                             'removed': [removed], 'changed': [changed]}
+
+    # hashes are updated incrementally, and match hashes built at once
+    rebuilt = pickle.loads(pickle.dumps(new))
+    rebuilt._hashes = None
+    assert rebuilt.content_hash() == new.content_hash()
+    new._remove_run('sub-99', sess, seq_id, run)
+    new.add(*removed, seq)
+    new._remove_run(*changed)
+    new.add(*changed, old.get(*changed))
+    assert new.content_hash() == old.content_hash() and new == old
+
+
+@pytest.mark.parametrize('compact', [False, True])
+def test_remove_and_replace(echo_dataset, compact):
+    fake_ds_dir, kwargs = echo_dataset(num_subjects=6)
+    mrd = import_dataset(fake_ds_dir, compact=compact, **kwargs)
+    mrd.enable_columns(['FlipAngle'])
+    mrd.enable_index(['FlipAngle'])
+    mrd.enable_hashes()
+    keys = sorted(mrd._flat_map)
+    seq_id = keys[0][2]
+
+    def expected(remaining):
+        dataset = mrd._empty_copy()
+        dataset.add_many((*key, mrd._flat_map[key]) for key in remaining)
+        return dataset
+
+    assert mrd.remove(*keys[0]) == [keys[0]]
+    assert mrd.remove(*keys[0]) == []
+    assert mrd.remove(*keys[1][:2]) == [keys[1]]
+    assert mrd.remove_subject(keys[2][0]) == [keys[2]]
+    assert mrd.remove_subject('sub-99') == []
+    remaining = keys[3:]
+    reference = expected(remaining)
+    for name in ('_flat_map', '_tree_map', '_seqs_map', '_sess_map'):
+        assert dict(getattr(mrd, name)) == dict(getattr(reference, name))
+    assert mrd.subjects() == reference.subjects()
+    assert mrd.content_hash() == reference.content_hash()
+    assert len(mrd.columns(seq_id)) == len(remaining)
+    with pytest.raises(ValueError):
+        mrd.remove('sub-00', 'ses', run_id='run')
+
+    # a session ID shared by several subjects, e.g. 'ses-01' in BIDS. The
+    #   subjects are added one at a time, by a merge and by unpickling
+    shared = mrd.get(*remaining[0])
+    for subj in ('sub-98', 'sub-99'):
+        mrd.add(subj, 'ses-01', 'shared', 'run-01', shared)
+        mrd.add(subj, 'ses-01', 'shared', 'run-02', shared)
+    other = mrd._empty_copy()
+    other.add_many([('sub-97', 'ses-01', 'shared', 'run-01', shared),
+                    ('sub-99', 'ses-01', 'shared', 'run-03', shared)])
+    mrd.merge(other)
+    mrd = pickle.loads(pickle.dumps(mrd))
+    if not compact:
+        assert mrd._sess_counts == expected(mrd._flat_map)._sess_counts
+        assert mrd._sess_counts[('ses-01', 'shared')] == 3
+    mrd.remove('sub-98', 'ses-01', 'shared', 'run-01')
+    mrd.remove_subject('sub-99')
+    mrd.remove_subject('sub-97')
+    assert 'shared' in mrd._sess_map['ses-01']
+    mrd.remove('sub-98', 'ses-01')
+    assert 'ses-01' not in mrd._sess_map
+    if not compact:
+        assert mrd._sess_counts == expected(mrd._flat_map)._sess_counts
+
+    seq = pickle.loads(pickle.dumps(mrd._flat_map[remaining[0]]))
+    seq['FlipAngle']._value = 45
+    before = mrd.content_hash()
+    previous = mrd.replace(*remaining[0], seq)
+    assert mrd.get(*remaining[0]) is seq
+    assert mrd.find(seq_id, FlipAngle=45) == {remaining[0]}
+    assert mrd.columns(seq_id).mode('FlipAngle') == (90.0, len(keys) - 4)
+    assert mrd.content_hash() != before
+    mrd.replace(*remaining[0], previous)
+    assert mrd.content_hash() == before
+    with pytest.raises(KeyError):
+        mrd.replace(*keys[0], seq)
@@ -0,0 +1,133 @@
+"""Tests for the lazy mode, where runs are stored as handles"""
+import pickle
+import shutil
+from pathlib import Path
+
+import pydicom
+import pytest
+
+from MRdataset import import_dataset
+from MRdataset.dicom import DicomDataset
+from MRdataset.lazy import SequenceHandle, LRUCache
+from MRdataset.tests.simulate import make_compliant_bids_dataset
+
+THIS_DIR = Path(__file__).parent.resolve()
+
+
+@pytest.mark.parametrize('compact', [False, True])
+def test_lazy_dicom(echo_dataset, compact):
+    fake_ds_dir, kwargs = echo_dataset(num_subjects=3)
+    mrd = import_dataset(fake_ds_dir, **kwargs)
+    lazy = import_dataset(fake_ds_dir, lazy=True, cache_size=1,
+                          compact=compact, **kwargs)
+    assert all(isinstance(seq, SequenceHandle)
+               for seq in lazy._flat_map.values())
+    assert lazy.subjects() == mrd.subjects()
+    assert lazy == mrd and mrd == lazy
+
+    for seq_id in mrd.get_sequence_ids():
+        for subj, sess, run, seq in lazy.traverse_horizontal(seq_id):
+            expected = mrd.get(subj, sess, seq_id, run)
+            assert not isinstance(seq, SequenceHandle)
+            assert seq == expected
+            assert seq['EchoTime'].get_value() == [30, 60]
+            assert seq.slice_signatures == expected.slice_signatures
+            assert lazy.get(subj, sess, seq_id, run) == expected
+    # only the most recently used sequence is kept
+    assert len(lazy._sequence_cache) == 1
+
+    loaded = pickle.loads(pickle.dumps(lazy))
+    assert loaded._sequence_cache is None
+    assert loaded == mrd
+
+    # a run whose reference slice is gone cannot be built
+    subj, sess, seq_id, run = next(iter(lazy._flat_map))
+    shutil.rmtree(fake_ds_dir / subj)
+    assert loaded.get(subj, sess, seq_id, run, default='gone') == 'gone'
+
+
+def test_lazy_indexes(echo_dataset, monkeypatch):
+    fake_ds_dir, kwargs = echo_dataset(num_subjects=3)
+    lazy = import_dataset(fake_ds_dir, lazy=True, **kwargs)
+    seq_id = lazy.get_sequence_ids()[0]
+    lazy.enable_index(['RepetitionTime'])
+    every_run = lazy.find(seq_id)
+    # predicates without an index are checked on the built sequences
+    assert lazy.find(seq_id, FlipAngle=90) == every_run
+    assert lazy.find(seq_id, FlipAngle=45) == set()
+
+    # runs are removed from the indexes without building them, even if
+    #   their files are gone or changed
+    shutil.rmtree(fake_ds_dir / 'sub-01')
+    for dcm_path in (fake_ds_dir / 'sub-02').glob('*.dcm'):
+        dicom = pydicom.dcmread(dcm_path)
+        dicom.RepetitionTime = 5000
+        dicom.save_as(dcm_path)
+    built = list()
+    original = DicomDataset._load_sequence
+    monkeypatch.setattr(DicomDataset, '_load_sequence',
+                        lambda self, handle: built.append(handle)
+                        or original(self, handle))
+    lazy.update()
+    # the sequences read from the changed folder are indexed before they
+    #   are replaced with handles
+    assert not built
+    tr = lazy.get(*min(lazy.find(seq_id)))['RepetitionTime'].get_value()
+    assert {key[0] for key in lazy.find(seq_id, RepetitionTime=tr)} == {
+        'sub-00'}
+    assert {key[0] for key in lazy.find(seq_id, RepetitionTime=5000)} == {
+        'sub-02'}
+
+
+def test_lazy_stale_file(echo_dataset, monkeypatch):
+    fake_ds_dir, kwargs = echo_dataset(num_subjects=2)
+    lazy = import_dataset(fake_ds_dir, lazy=True, cache_size=1, **kwargs)
+    handle = next(iter(lazy._flat_map.values()))
+    warnings = list()
+    monkeypatch.setattr('MRdataset.base.logger.warning', warnings.append)
+    signatures = list()
+    original = DicomDataset._folder_signature
+    monkeypatch.setattr(DicomDataset, '_folder_signature',
+                        lambda self, *args: signatures.append(args)
+                        or original(self, *args))
+    for seq in lazy.traverse_horizontal(lazy.get_sequence_ids()[0]):
+        pass
+    # sequences are built without listing their folders again
+    assert not signatures and not warnings
+
+    dicom = pydicom.dcmread(handle.filepath)
+    dicom.RepetitionTime = 5000
+    dicom.save_as(handle.filepath)
+    lazy._sequence_cache = None
+    seq = lazy.get(handle.subject_id, handle.session_id, handle.name,
+                   handle.run_id)
+    assert seq['RepetitionTime'].get_value() == 5000
+    assert len(warnings) == 1 and str(handle.filepath) in warnings[0]
+    assert not signatures
+
+
+def test_lazy_bids():
+    fake_ds_dir = make_compliant_bids_dataset(2, 2.0, 10, 90.0)
+    kwargs = dict(ds_format='bids', output_dir=fake_ds_dir,
+                  config_path=THIS_DIR / 'resources/bids-config.json',
+                  name='test_dataset')
+    mrd = import_dataset(fake_ds_dir, **kwargs)
+    lazy = import_dataset(fake_ds_dir, lazy=True, **kwargs)
+    assert lazy == mrd
+    for seq_id in mrd.get_sequence_ids():
+        for subj, sess, run, seq in lazy.traverse_horizontal(seq_id):
+            assert seq == mrd.get(subj, sess, seq_id, run)
+            assert seq['FlipAngle'].get_value() == 90.0
+    shutil.rmtree(fake_ds_dir)
+
+
+def test_lru_cache():
+    cache = LRUCache(2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1
+    cache.put('c', 3)
+    assert cache.get('b') is None and len(cache) == 2
+    assert cache.get('a') == 1 and cache.get('c') == 3
+    with pytest.raises(ValueError):
+        LRUCache(0)
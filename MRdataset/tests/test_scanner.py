@@ -0,0 +1,63 @@
+"""Tests for the explicit VR little endian header scanner"""
+from pathlib import Path
+
+import pydicom
+import pytest
+from pydicom.dataset import Dataset
+from pydicom.errors import InvalidDicomError
+from pydicom.sequence import Sequence
+from pydicom.uid import ImplicitVRLittleEndian
+
+from MRdataset.scanner import scan_header
+
+THIS_DIR = Path(__file__).parent.resolve()
+VALID_DCM = THIS_DIR / 'resources/valid.dcm'
+
+KEYWORDS = ['ImageType', 'PatientID', 'PatientAge', 'EchoTime', 'EchoNumbers',
+            'StudyInstanceUID', 'SeriesInstanceUID', 'SeriesDescription',
+            'ImagePositionPatient', 'InstanceNumber', 'Rows']
+
+
+def test_scan_header_matches_pydicom():
+    header = scan_header(VALID_DCM, KEYWORDS)
+    dicom = pydicom.dcmread(VALID_DCM, stop_before_pixels=True)
+    assert header is not None
+    for keyword in KEYWORDS:
+        assert header.get(keyword) == dicom.get(keyword)
+    # tags return the element, as for pydicom datasets
+    assert header.get((0x18, 0x81)).value == 30.0
+    assert header.get('SliceThickness', 'missing') == 'missing'
+
+
+def test_scan_header_skips_sequences(tmp_path):
+    dicom = pydicom.dcmread(VALID_DCM)
+    item = Dataset()
+    item.ReferencedSOPInstanceUID = '1.2.3'
+    item.is_undefined_length_sequence_item = True
+    dicom.ReferencedImageSequence = Sequence([item, Dataset()])
+    dicom['ReferencedImageSequence'].is_undefined_length = True
+    dicom.save_as(tmp_path / 'sequence.dcm')
+
+    header = scan_header(tmp_path / 'sequence.dcm', KEYWORDS)
+    assert header.get('EchoTime') == 30.0
+    assert header.get('SeriesInstanceUID') == dicom.SeriesInstanceUID
+
+
+def test_scan_header_falls_back(tmp_path):
+    # header is larger than the buffer
+    assert scan_header(VALID_DCM, KEYWORDS, buffer_size=512) is None
+
+    # implicit VR is left to pydicom
+    dicom = pydicom.dcmread(VALID_DCM)
+    dicom.file_meta.TransferSyntaxUID = ImplicitVRLittleEndian
+    dicom.is_implicit_VR = True
+    dicom.save_as(tmp_path / 'implicit.dcm')
+    assert scan_header(tmp_path / 'implicit.dcm', KEYWORDS) is None
+
+
+def test_scan_header_invalid_file(tmp_path):
+    (tmp_path / 'notes.txt').write_text('not a dicom file')
+    with pytest.raises(InvalidDicomError):
+        scan_header(tmp_path / 'notes.txt', KEYWORDS)
+    with pytest.raises(ValueError):
+        scan_header(VALID_DCM, ['NotAKeyword'])
@@ -2,6 +2,7 @@ import json
 import os
 import re
 import tempfile
+import time
 from pathlib import Path
 
 import pytest
@@ -9,11 +10,16 @@ from hypothesis import given, strategies as st, settings
 from hypothesis.strategies import characters
 from pydicom import dcmread
 
-from MRdataset.dicom_utils import is_dicom_file, is_valid_inclusion
+from MRdataset import utils
+
+from MRdataset.dicom_utils import is_dicom_file, is_valid_inclusion, \
+    slice_signature
 from MRdataset.utils import convert2ascii, read_json, \
     is_folder_with_no_subfolders, find_terminal_folders, \
     check_mrds_extension, valid_dirs, \
-    folders_with_min_files  # Import your function from the correct module
+    folders_with_min_files, files_in_terminal_folders, \
+    scan_terminal_folders, stratified_order, prefetch_files, \
+    parse_shard, shard_of  # Import your function from the correct module
 
 
 def test_valid_dicom_file(tmp_path=None):
@@ -88,6 +94,15 @@ def test_invalid_inclusion_derived(derived_dicom_file):
     assert result is False
 
 
+def test_slice_signature():
+    signature = slice_signature({'EchoTime': 2.4601, 'EchoNumber': 1})
+    assert signature == (2.46, 1.0)
+    assert signature == slice_signature({'EchoTime': 2.46, 'EchoNumber': 1})
+    assert signature != slice_signature({'EchoTime': 4.9, 'EchoNumber': 2})
+    assert slice_signature({'EchoTime': [2.46, 4.9], 'EchoNumber': None}) \
+        == ((2.46, 4.9), None)
+
+
 def test_invalid_inclusion(invalid_dicom_file):
     dcm = dcmread(invalid_dicom_file)  # Replace with the actual path
     result = is_valid_inclusion(dcm)
@@ -329,6 +344,157 @@ def test_find_folders_with_min_files():
         assert set(terminal_folders) == expected
 
 
+def test_files_in_terminal_folders():
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        root = Path(tmpdirname).resolve()
+        expected = dict()
+        for idx, num_files in zip(range(4), [2, 3, 0, 4]):
+            folder = root / f"level1" / f"folder{idx}"
+            folder.mkdir(parents=True)
+            files = []
+            for count in range(num_files):
+                file = folder / f"file{count}.dcm"
+                file.touch()
+                files.append(file)
+            (folder / "notes.txt").touch()
+            if num_files >= 2:
+                expected[folder] = files
+
+        result = dict(files_in_terminal_folders(root, "*.dcm", min_count=2))
+        assert result == expected
+        # folders are yielded in a deterministic (sorted) order
+        assert list(result.keys()) == sorted(expected.keys())
+
+
+def test_scan_terminal_folders_lists_all_files():
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        root = Path(tmpdirname)
+        folder = root / "folder1" / "folder2"
+        folder.mkdir(parents=True)
+        (folder / "b.dcm").touch()
+        (folder / "a.json").touch()
+        # files in non-terminal folders are ignored
+        (root / "folder1" / "c.dcm").touch()
+
+        result = list(scan_terminal_folders(root))
+        assert result == [(folder, [folder / "a.json", folder / "b.dcm"])]
+
+
+def test_scan_terminal_folders_prune():
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        root = Path(tmpdirname)
+        for subject in ["sub-01", "sub-02"]:
+            (root / subject / "anat").mkdir(parents=True)
+            (root / subject / "anat" / "a.json").touch()
+        # every sub-folder is pruned, so the root is not a terminal folder
+        (root / "dataset_description.json").touch()
+
+        def prune(folder):
+            return folder.name == "sub-01"
+
+        for threads in [1, 4]:
+            result = list(scan_terminal_folders(root, threads=threads,
+                                                prune=prune))
+            assert result == [(root / "sub-02" / "anat",
+                               [root / "sub-02" / "anat" / "a.json"])]
+            result = list(scan_terminal_folders(root, threads=threads,
+                                                prune=lambda f: True))
+            assert result == []
+
+
+def test_shard_of():
+    root = Path("/data")
+    folders = [root / f"sub-{i:02d}" / "anat" for i in range(50)]
+    shards = [shard_of(folder, root, 4) for folder in folders]
+    assert set(shards) == {0, 1, 2, 3}
+    # same assignment on every call
+    assert shards == [shard_of(folder, root, 4) for folder in folders]
+    # all the folders of a subject are in the same shard
+    assert shard_of(root / "sub-01" / "anat", root, 4, by="subject") == \
+           shard_of(root / "sub-01" / "func", root, 4, by="subject")
+
+    assert parse_shard("3/8") == (3, 8)
+    for value in ["8/8", "-1/8", "0/0", "1", "a/b"]:
+        with pytest.raises(ValueError):
+            parse_shard(value)
+
+
+@given(st.integers(min_value=0, max_value=300))
+def test_stratified_order_is_a_permutation(num_items):
+    items = list(range(num_items))
+    result = stratified_order(items)
+    assert sorted(result) == items
+    if num_items > 2:
+        assert result[:3] == [0, num_items - 1, (num_items - 1) // 2]
+
+
+def test_prefetch_files(tmp_path):
+    files = list()
+    for i in range(20):
+        filepath = tmp_path / f'{i:02d}.dcm'
+        filepath.write_bytes(bytes([i]) * 100)
+        files.append(filepath)
+    files.append(tmp_path / 'missing.dcm')
+
+    result = list(prefetch_files(files, depth=4, buffer_size=10,
+                                 fadvise=True))
+    assert [filepath for filepath, _ in result] == files
+    assert result[3][1] == bytes([3]) * 10
+    # files that cannot be read are yielded without data
+    assert result[-1][1] is None
+
+    # the consumer may stop early
+    for filepath, data in prefetch_files(files, depth=4):
+        break
+    assert filepath == files[0] and len(data) == 100
+
+    # the threads are reused by later calls
+    executors = dict(utils._PREFETCH_EXECUTORS)
+    assert list(prefetch_files(files, depth=4, buffer_size=10)) == result
+    assert utils._PREFETCH_EXECUTORS == executors
+
+
+def test_scan_terminal_folders_concurrent():
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        root = Path(tmpdirname)
+        for i in range(3):
+            for j in range(4):
+                folder = root / f"sub-{i}" / f"ses-{j}" / "anat"
+                folder.mkdir(parents=True)
+                for k in range(j):
+                    (folder / f"file{k}.dcm").touch()
+        (root / "empty").mkdir()
+
+        expected = list(scan_terminal_folders(root, "*.dcm"))
+        result = list(scan_terminal_folders(root, "*.dcm", threads=4))
+        assert result == expected
+        assert len(result) == 13
+
+        # the consumer may stop early
+        walker = scan_terminal_folders(root, "*.dcm", threads=4)
+        assert next(walker) == expected[0]
+        walker.close()
+
+
+def test_scan_terminal_folders_concurrent_is_bounded(tmp_path, monkeypatch):
+    for i in range(50):
+        (tmp_path / f"sub-{i:02d}").mkdir()
+    listed = []
+
+    def scan_folder(folder, *args):
+        listed.append(folder)
+        return _scan_folder(folder, *args)
+
+    _scan_folder = utils._scan_folder
+    monkeypatch.setattr(utils, '_scan_folder', scan_folder)
+    walker = scan_terminal_folders(tmp_path, "*.dcm", threads=2)
+    assert next(walker)[0] == tmp_path / "sub-00"
+    # only the next few folders are listed ahead of the consumer
+    time.sleep(0.1)
+    assert len(listed) <= 1 + 2 * 2
+    walker.close()
+
+
 # Define a strategy for generating valid paths (strings)
 @st.composite
 def valid_paths(draw):
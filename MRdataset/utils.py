@@ -1,13 +1,22 @@
+import hashlib
 import json
+import os
 import re
 import tempfile
+import threading
 import time
 import unicodedata
 import uuid
+from collections import deque
+from datetime import date, datetime
 from collections.abc import Iterable
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import fnmatch
+from itertools import islice
 from pathlib import Path
-from typing import Union, List, Optional
+from typing import Union, List, Optional, Iterator, Tuple, Callable
 
+from MRdataset import logger
 from MRdataset.config import MRDS_EXT
 
 
@@ -34,6 +43,58 @@ def timestamp() -> str:
     return time_string
 
 
+def parse_date(value: Union[str, date, None]) -> Optional[date]:
+    """
+    Parses a date from the config file, or from a DICOM DA value.
+
+    Parameters
+    ----------
+    value : str | date | None
+        date in ISO format e.g. 2014-03-12 or 2014-03-12T13:37:27+00:00, or
+        in DICOM format e.g. 20140312
+
+    Returns
+    -------
+    datetime.date or None
+        None if value is None or empty
+
+    Raises
+    ------
+    ValueError
+        If the value is not a valid date
+    """
+    if value is None or isinstance(value, date):
+        return value
+    value = str(value).strip()
+    if not value:
+        return None
+    if value.isdigit():
+        return datetime.strptime(value, '%Y%m%d').date()
+    return datetime.fromisoformat(value).date()
+
+
+def is_excluded_subject(subject_id: str, exclude_subjects: set) -> bool:
+    """
+    Checks if a subject is listed in the exclude_subjects option of the
+    config. A BIDS subject label matches with or without the sub- prefix
+    e.g. sub-210098 matches 210098.
+
+    Parameters
+    ----------
+    subject_id : str
+        subject identifier e.g. PatientID, or the name of a BIDS folder
+    exclude_subjects : set
+        identifiers of the subjects to exclude
+    """
+    if not exclude_subjects or subject_id is None:
+        return False
+    subject_id = str(subject_id)
+    if subject_id in exclude_subjects:
+        return True
+    return (subject_id.startswith('sub-')
+            and subject_id[len('sub-'):] in exclude_subjects)
+
+
 def folders_with_min_files(root: Union[Path, str],
                            pattern: Optional[str] = "*.dcm",
                            min_count=3) -> List[Path]:
@@ -55,21 +116,473 @@ def folders_with_min_files(root: Union[Path, str],
     -------
     List of folders
     """
+    for folder, _ in files_in_terminal_folders(root, pattern, min_count):
+        yield folder
+
+
+def files_in_terminal_folders(root: Union[Path, str],
+                              pattern: Optional[str] = "*.dcm",
+                              min_count=3,
+                              threads=1,
+                              prune: Callable[[Path], bool] = None
+                              ) -> Iterator[Tuple[Path, List[Path]]]:
+    """
+    Returns all the terminal folders with at least min_count of files
+    matching the pattern, along with the list of those files. Each folder
+    is listed exactly once, so the files need not be globbed again.
+    One at a time via generator.
 
+    Parameters
+    ----------
+    root : Path | str
+        filepath pointing to the root folder
+    pattern : str
+        pattern to filter files
+    min_count : int
+        size representing the number of files in folder
+        matching the input pattern
+    threads : int
+        number of threads used to list folders concurrently. Default is 1,
+        i.e. the folders are listed one at a time
+    prune : Callable[[Path], bool]
+        if provided, sub-folders for which prune returns True are skipped
+        along with everything below them, without being listed
+
+    Yields
+    ------
+    tuple
+        folder path and sorted list of files matching the pattern
+    """
     if not isinstance(root, (Path, str)):
         raise ValueError('root must be a Path-like object (str or Path)')
 
+    root = Path(root)
     if not root.exists():
         raise ValueError('Root folder does not exist')
-    root = Path(root).resolve()
+    root = root.resolve()
+
+    for folder, files in scan_terminal_folders(root, pattern, threads, prune):
+        if len(files) >= min_count:
+            yield folder, files
 
-    terminals = find_terminal_folders(root)
 
-    for folder in terminals:
-        if len([file_ for file_ in folder.rglob(pattern)]) >= min_count:
-            yield folder
+def _scan_folder(folder: Path,
+                 pattern: Optional[str] = None,
+                 prune: Callable[[Path], bool] = None
+                 ) -> Tuple[List[Path], Optional[List[Path]]]:
+    """
+    Lists a folder once using os.scandir, and splits the entries into
+    sub-folders and files matching the pattern. Both lists are sorted by
+    name to keep the order of traversal deterministic.
+
+    Parameters
+    ----------
+    folder : Path
+        filepath pointing to the folder
+    pattern : str
+        pattern to filter files. If None, all files are returned
+    prune : Callable[[Path], bool]
+        if provided, sub-folders for which prune returns True are dropped.
+        If every sub-folder is dropped, files is None, as the folder is
+        not a terminal folder.
+    """
+    sub_dirs, files = [], []
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                continue
+            if is_dir:
+                sub_dirs.append(entry.name)
+            elif pattern is None or fnmatch(entry.name, pattern):
+                files.append(entry.name)
+    sub_dirs = [folder / name for name in sorted(sub_dirs)]
+    files = [folder / name for name in sorted(files)]
+    if sub_dirs and prune is not None:
+        sub_dirs = [sub_dir for sub_dir in sub_dirs if not prune(sub_dir)]
+        if not sub_dirs:
+            files = None
+    return sub_dirs, files
+
+
+def scan_terminal_folders(root: Union[Path, str],
+                          pattern: Optional[str] = None,
+                          threads: int = 1,
+                          prune: Callable[[Path], bool] = None
+                          ) -> Iterator[Tuple[Path, List[Path]]]:
+    """
+    Walks the folder tree in a single pass, and yields every terminal
+    folder (i.e. a folder with no sub-folders) along with the files in it
+    matching the pattern. Each directory is listed exactly once.
+
+    Parameters
+    ----------
+    root: str | Path
+        filepath pointing to the folder
+    pattern : str
+        pattern to filter files. If None, all files are returned
+    threads : int
+        number of threads used to list folders concurrently. If greater
+        than 1, sibling sub-trees are listed at the same time, which helps
+        on network/parallel filesystems where listing a folder is dominated
+        by latency. The order of the folders is the same in either case.
+    prune : Callable[[Path], bool]
+        if provided, sub-folders for which prune returns True are skipped
+        along with everything below them, without being listed. For
+        example, to skip excluded subjects.
+
+    Yields
+    ------
+    tuple
+        folder path and sorted list of files matching the pattern
+    """
+    if threads > 1:
+        yield from _scan_terminal_folders_concurrent(root, pattern, threads,
+                                                     prune)
+        return
+
+    stack = [Path(root)]
+    while stack:
+        folder = stack.pop()
+        try:
+            sub_dirs, files = _scan_folder(folder, pattern, prune)
+        except OSError as exc:
+            logger.warning(f'Unable to list folder {folder}. Got {exc}')
+            continue
 
-    return
+        if sub_dirs:
+            # reversed, so that folders are popped in sorted order
+            stack.extend(reversed(sub_dirs))
+        elif files is not None:
+            yield folder, files
+
+
+def _scan_terminal_folders_concurrent(root, pattern, threads, prune=None):
+    """
+    Concurrent version of scan_terminal_folders. Folders are listed by a
+    bounded pool of threads, ahead of the consumer. The consumer walks the
+    folders depth-first in sorted order, and keeps the listings of the next
+    few folders in flight, so terminal folders are streamed as soon as they
+    are found while keeping the order deterministic. About 2 * threads
+    listings are outstanding at any time, so the walk does not run ahead of
+    a slow consumer.
+    """
+    max_pending = 2 * threads
+    executor = ThreadPoolExecutor(max_workers=threads)
+    # folders still to be walked, the next one on top. Each folder has the
+    #   future of its listing, or None if the listing was not submitted yet
+    stack = [[Path(root), None]]
+    pending = 0
+    try:
+        while stack:
+            # submit the listings of the folders walked next, in order
+            for i, entry in enumerate(islice(reversed(stack), max_pending)):
+                # the folder walked next is always listed, even if the
+                #   listings in flight are further down the stack
+                if entry[1] is None and (not i or pending < max_pending):
+                    entry[1] = executor.submit(_scan_folder, entry[0],
+                                               pattern, prune)
+                    pending += 1
+
+            folder, future = stack.pop()
+            pending -= 1
+            try:
+                sub_dirs, files = future.result()
+            except OSError as exc:
+                logger.warning(f'Unable to list folder {folder}. Got {exc}')
+                continue
+
+            if sub_dirs:
+                # reversed, so that folders are popped in sorted order
+                stack.extend([sub_dir, None] for sub_dir in reversed(sub_dirs))
+            elif files is not None:
+                yield folder, files
+    finally:
+        # drop the listings not started yet, if the consumer stopped early
+        for _, future in stack:
+            if future is not None:
+                future.cancel()
+        executor.shutdown(wait=False)
+
+
+def prefetch_files(files: Iterable,
+                   depth: int = 8,
+                   buffer_size: int = 32 * 1024,
+                   threads: int = 4,
+                   fadvise: bool = False
+                   ) -> Iterator[Tuple[Path, Optional[bytes]]]:
+    """
+    Reads the beginning of each file in a bounded pool of threads, ahead of
+    the consumer. At most depth files are read ahead, and the buffers are
+    yielded in the same order as the input files. This overlaps the time
+    spent waiting on the disk or network with parsing the files that were
+    already read. The threads are shared by all the calls in a process.
+
+    Parameters
+    ----------
+    files : Iterable[Path]
+        files to read, in the order they are consumed
+    depth : int
+        maximum number of files read ahead of the consumer
+    buffer_size : int
+        number of bytes read from the beginning of each file
+    threads : int
+        number of threads reading the files
+    fadvise : bool
+        whether to advise the kernel that the whole file will be needed
+        (POSIX_FADV_WILLNEED), so that the rest of the file is read ahead
+        too. Ignored on platforms without posix_fadvise.
+
+    Yields
+    ------
+    tuple
+        path to the file and the bytes read from it, or None if the file
+        could not be read
+    """
+    files = iter(files)
+    executor = _prefetch_executor(max(1, min(threads, depth)))
+    pending = deque()
+
+    def submit(count):
+        for filepath in islice(files, count):
+            pending.append((filepath, executor.submit(
+                _read_prefix, filepath, buffer_size, fadvise)))
+
+    try:
+        submit(max(1, depth))
+        while pending:
+            filepath, future = pending.popleft()
+            submit(1)
+            try:
+                data = future.result()
+            except OSError as exc:
+                logger.info(f'Unable to prefetch {filepath}. Got {exc}')
+                data = None
+            yield filepath, data
+    finally:
+        # the consumer may stop early e.g. while sampling slices
+        for _, future in pending:
+            future.cancel()
+
+
+# thread pools shared by the calls to prefetch_files, keyed by process (a
+#   forked worker cannot use the threads of its parent) and number of threads
+_PREFETCH_EXECUTORS = dict()
+_PREFETCH_LOCK = threading.Lock()
+
+
+def _prefetch_executor(threads: int) -> ThreadPoolExecutor:
+    """Returns the thread pool of this process for prefetching files, so
+    that the threads are reused across folders instead of being started
+    for each folder"""
+    key = os.getpid(), threads
+    with _PREFETCH_LOCK:
+        executor = _PREFETCH_EXECUTORS.get(key, None)
+        if executor is None:
+            executor = ThreadPoolExecutor(max_workers=threads,
+                                          thread_name_prefix='prefetch')
+            _PREFETCH_EXECUTORS[key] = executor
+    return executor
+
+
+def _read_prefix(filepath, buffer_size, fadvise):
+    """Reads the first buffer_size bytes of a file"""
+    with open(filepath, 'rb') as fp:
+        if fadvise and hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(fp.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+        return fp.read(buffer_size)
+
+
+def folder_fingerprint(files: List[Path], salt: str = '') -> str:
+    """
+    Computes a fingerprint of the files in a folder from the path, size,
+    modification time and inode of each file. The files are not opened,
+    so the fingerprint costs a single stat call per file.
+
+    Parameters
+    ----------
+    files : List[Path]
+        files in the folder
+    salt : str
+        additional string to mix into the fingerprint e.g. options that
+        change the way the files are read
+
+    Returns
+    -------
+    str
+        hex digest, which changes if any file is added, removed or modified
+    """
+    digest = hashlib.sha1(salt.encode('utf-8'))
+    for filepath in sorted(files):
+        try:
+            stat = os.stat(filepath)
+            info = f'{stat.st_size}|{stat.st_mtime_ns}|{stat.st_ino}'
+        except OSError:
+            info = 'missing'
+        digest.update(f'{filepath}|{info}\n'.encode('utf-8',
+                                                    'surrogateescape'))
+    return digest.hexdigest()
+
+
+def folder_signature(folder: Path, files: List[Path], salt: str = '') -> str:
+    """
+    Computes the signature of a folder, used to detect the folders that have
+    changed since they were read. The signature changes if any file is
+    added, removed, renamed or rewritten in place, see folder_fingerprint.
+
+    Parameters
+    ----------
+    folder : Path
+        filepath pointing to the folder
+    files : List[Path]
+        files in the folder
+    salt : str
+        options that change what is read from the folder, if any
+
+    Returns
+    -------
+    str
+        hex digest
+    """
+    return folder_fingerprint(files, salt)
+
+
+def stratified_order(items: List) -> List:
+    """
+    Reorders a sorted list, so that every prefix of the result is spread
+    evenly across the original order. The first and last items come first,
+    followed by the middle item, then the quarter points and so on, i.e.
+    the list is bisected breadth-first.
+
+    Parameters
+    ----------
+    items : List
+        items in their natural order e.g. dicom slices sorted by name
+
+    Returns
+    -------
+    List
+        the same items, in stratified order
+
+    Examples
+    --------
+    >>> stratified_order(list(range(9)))
+    [0, 8, 4, 2, 6, 1, 3, 5, 7]
+    """
+    items = list(items)
+    if len(items) < 3:
+        return items
+    order = [0, len(items) - 1]
+    intervals = deque([(0, len(items) - 1)])
+    while intervals:
+        low, high = intervals.popleft()
+        if high - low < 2:
+            continue
+        mid = (low + high) // 2
+        order.append(mid)
+        intervals.append((low, mid))
+        intervals.append((mid, high))
+    return [items[i] for i in order]
+
+
+def parse_shard(value: str) -> Tuple[int, int]:
+    """
+    Parses a shard selector of the form i/N, where N is the number of
+    shards and i is the index of the shard, counting from 0.
+
+    Parameters
+    ----------
+    value : str
+        shard selector e.g. 3/8
+
+    Returns
+    -------
+    tuple
+        index and number of shards
+
+    Raises
+    ------
+    ValueError
+        If the value is not a valid shard selector
+    """
+    try:
+        index, total = (int(v) for v in str(value).split('/'))
+    except ValueError:
+        raise ValueError(f'Expected shard as i/N e.g. 0/8. Got {value}')
+    return check_shard((index, total))
+
+
+def check_shard(shard: Tuple[int, int]) -> Tuple[int, int]:
+    """
+    Validates a shard, given as a tuple of index and number of shards.
+
+    Raises
+    ------
+    ValueError
+        If the number of shards is less than 1, or index is not within
+        [0, N)
+    """
+    try:
+        index, total = shard
+    except (TypeError, ValueError):
+        raise ValueError(f'Expected shard as (index, total). Got {shard}')
+    if total < 1 or not 0 <= index < total:
+        raise ValueError(f'Expected 0 <= index < total and total >= 1 for '
+                         f'shard. Got {shard}')
+    return int(index), int(total)
+
+
+def check_n_jobs(n_jobs: int) -> int:
+    """
+    Validates a number of jobs, and returns the number of workers to use
+    i.e. the number of cores for -1.
+
+    Raises
+    ------
+    ValueError
+        If n_jobs is neither -1 nor a positive integer
+    """
+    if n_jobs == -1:
+        return os.cpu_count()
+    if not isinstance(n_jobs, int) or n_jobs < 1:
+        raise ValueError('Expected n_jobs to be -1 or a positive integer. '
+                         f'Got {n_jobs}')
+    return n_jobs
+
+
+def shard_of(folder: Path, root: Path, total: int, by: str = 'folder') -> int:
+    """
+    Assigns a folder to one of several shards, by hashing its path relative
+    to the data source. The assignment is the same on every machine and
+    every run, so that each job of an array imports a disjoint part of the
+    data source.
+
+    Parameters
+    ----------
+    folder : Path
+        terminal folder in the data source
+    root : Path
+        the data source containing the folder
+    total : int
+        number of shards
+    by : str
+        'folder' to hash the path of the terminal folder, or 'subject' to
+        hash the top-level directory under root, so that all the folders of
+        a subject are in the same shard
+
+    Returns
+    -------
+    int
+        index of the shard, in [0, total)
+    """
+    parts = Path(folder).relative_to(root).parts
+    if by == 'subject':
+        parts = parts[:1]
+    elif by != 'folder':
+        raise ValueError(f"Expected shard_by 'folder' or 'subject'. Got {by}")
+    digest = hashlib.md5('/'.join(parts).encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'little') % total
 
 
 def is_folder_with_no_subfolders(fpath):
@@ -100,24 +613,7 @@ def find_terminal_folders(root):
     root: str | Path
         filepath pointing to the folder
     """
-    try:
-        no_more_subdirs, sub_dirs = is_folder_with_no_subfolders(root)
-    except FileNotFoundError:
-        return []
-
-    if no_more_subdirs:
-        return [root, ]
-
-    terminal = list()
-    for sd1 in sub_dirs:
-        no_more_subdirs2, level2_subdirs = is_folder_with_no_subfolders(sd1)
-        if no_more_subdirs2:
-            terminal.append(sd1)
-        else:
-            for sd2 in level2_subdirs:
-                terminal.extend(find_terminal_folders(sd2))
-
-    return terminal
+    return [folder for folder, _ in scan_terminal_folders(root)]
 
 
 def valid_dirs(folders: Union[List, Path, str]) -> List: